@@ -22,24 +22,34 @@ instances by querying AWS for appropriate instance types.
 
 """
 import concurrent.futures
+import heapq
+import itertools
+import json
+import math
+import os
+import random
+import re
 import time
-from collections import defaultdict, namedtuple
+from collections import Counter, defaultdict, namedtuple, OrderedDict
 from datetime import datetime, timedelta
 from typing import Dict, Optional
 
 from boto.ec2 import connect_to_region
+from boto.exception import EC2ResponseError
 from tornado import gen
 from tornado.concurrent import Future
+from tornado.locks import Condition
 from tornado.platform.asyncio import to_tornado_future
 import tornado.ioloop
 
 from loadsbroker.exceptions import LoadsException
+from loadsbroker.executor import FairExecutor
+from loadsbroker.throttle import Throttle
 from loadsbroker import logger
 
 
-_POPULATED = False
 AWS_REGIONS = (
-    # "ap-northeast-1", "ap-southeast-1", "ap-southeast-2",  # speeding up
+    "ap-northeast-1", "ap-southeast-1", "ap-southeast-2",
     "eu-west-1",
     # "sa-east-1",   # this one times out
     "us-east-1",
@@ -52,6 +62,9 @@ AWS_REGIONS = (
 # virtualization type of the appropriate AMI to use
 AWS_AMI_IDS = {k: {} for k in AWS_REGIONS}
 
+# AMIs looked up for a region are cached for AMI_CACHE_TTL seconds
+AMI_CACHE_TTL = 24 * 3600
+
 
 # How long after est. run times to trigger the reaper
 REAPER_DELTA = timedelta(hours=5)
@@ -59,15 +72,71 @@ REAPER_DELTA = timedelta(hours=5)
 REAPER_FORCE = timedelta(hours=24)
 REAPER_STATE = 'ThirdState'
 
+# Number of instances described per DescribeInstances call
+REFRESH_CHUNK = 100
+
+# Attempts at tagging instances the AWS API doesn't know about yet, with
+# a jittered exponential backoff starting at TAG_BACKOFF seconds
+TAG_ATTEMPTS = 6
+TAG_BACKOFF = 0.5
+_INSTANCE_ID = re.compile(r"i-[0-9a-f]+")
+
+# How instances are allocated for a step: on-demand, spot, or spot with
+# on-demand instances replacing the spot requests left unfulfilled
+ALLOCATION_STRATEGIES = ("on-demand", "spot", "spot-fallback")
+
+# Errors of instance types that can't be allocated right now, in favor
+# of the fallback types
+CAPACITY_ERRORS = ("InsufficientInstanceCapacity", "InstanceLimitExceeded",
+                   "Unsupported")
+
+# Capacities add up fractional instance weights, below this much of an
+# instance they're done
+CAPACITY_EPSILON = 1e-6
+
+# Seconds between checks of spot requests, and status codes of the
+# requests that aren't going to be fulfilled any time soon
+SPOT_INTERVAL = 5
+SPOT_UNFULFILLED = ("capacity-not-available", "capacity-oversubscribed",
+                    "price-too-low", "bad-parameters", "system-error",
+                    "constraint-not-fulfillable", "az-group-constraint",
+                    "placement-group-constraint", "launch-group-constraint")
+
+
+class AMI(namedtuple('AMI', 'id name virtualization_type')):
+    """AMI of a region, as cached."""
+
+
+def _latest_amis(images):
+    """The latest AMIs by virtualization type.
+
+    The last two highest sorted are the pvm and hvm instance id's.
+
+    """
+    # what is this 899.4 ??? XXX
+    # images = sorted([x for x in images if "899.4" in x.name],
+    #                key=lambda x: x.name)[-2:]
+    images = sorted(images, key=lambda x: x.name)[-2:]
+    return {x.virtualization_type: AMI(x.id, x.name, x.virtualization_type)
+            for x in images}
+
+
+def _image_filters(owner_id, use_filters):
+    filters = {}
+    if owner_id is not None and use_filters:
+        filters["owner-id"] = owner_id
+    return filters
+
 
 def populate_ami_ids(aws_access_key_id=None, aws_secret_access_key=None,
                      port=None, owner_id="595879546273", use_filters=True):
     """Populate all the AMI ID's with the latest CoreOS stable info.
 
-    This is a longer blocking operation and should be done on startup.
-    """
-    global _POPULATED
+    This is a longer blocking operation. The :class:`EC2Pool` rather
+    looks up the AMIs of a region when it first needs them, see
+    :class:`AMICache`.
 
+    """
     # see https://github.com/boto/boto/issues/2617
     if port is not None:
         is_secure = port == 443
@@ -86,18 +155,9 @@ def populate_ami_ids(aws_access_key_id=None, aws_secret_access_key=None,
                 aws_secret_access_key=aws_secret_access_key,
                 port=port, is_secure=is_secure)
 
-            filters = {}
-            if owner_id is not None and use_filters:
-                filters["owner-id"] = owner_id
-
-            images = conn.get_all_images(filters=filters)
-
-            # The last two highest sorted are the pvm and hvm instance id's
-            # what is this 899.4 ??? XXX
-            # images = sorted([x for x in images if "899.4" in x.name],
-            #                key=lambda x: x.name)[-2:]
-            images = sorted(images, key=lambda x: x.name)[-2:]
-            AWS_AMI_IDS[region] = {x.virtualization_type: x for x in images}
+            images = conn.get_all_images(
+                filters=_image_filters(owner_id, use_filters))
+            AWS_AMI_IDS[region] = _latest_amis(images)
             logger.debug("%s populated" % region)
         except Exception as exc:
             logger.exception('Could not get all images in %s' % region)
@@ -110,8 +170,6 @@ def populate_ami_ids(aws_access_key_id=None, aws_secret_access_key=None,
     if len(errors) > 0:
         raise errors[0]
 
-    _POPULATED = True
-
 
 def get_ami(region, instance_type):
     """Returns the appropriate AMI to use for a given region + instance type
@@ -123,14 +181,13 @@ def get_ami(region, instance_type):
 
     .. note::
 
-        :func:`populate_ami_ids` must be called first to populate the available
-        AMI's.
+        The AMIs of the region must have been looked up first, by
+        :func:`populate_ami_ids` or :meth:`AMICache.lookup`.
 
     """
-    if not _POPULATED:
-        raise KeyError('populate_ami_ids must be called first')
-
-    instances = AWS_AMI_IDS[region]
+    instances = AWS_AMI_IDS.get(region)
+    if not instances:
+        raise KeyError('The AMIs of %s must be looked up first' % region)
 
     inst_type = "hvm"
     if instance_type[:2] in ["m1", "m2", "c1", "t1"]:
@@ -143,6 +200,103 @@ def get_ami(region, instance_type):
     return instances[inst_type].id
 
 
+class AMICache:
+    """Looks up the AMIs of a region on first use, and persists them to
+    a JSON file for ``ttl`` seconds.
+
+    Lookups are made with ``lookup(region)``, a coroutine returning the
+    images of a region, run once per region at a time.
+
+    :param path: File the AMIs are persisted to, or None to only keep
+                 them in memory.
+
+    """
+    def __init__(self, lookup, path=None, ttl=AMI_CACHE_TTL):
+        self._lookup = lookup
+        self.path = path
+        self.ttl = ttl
+        self._pending = {}
+        self._cache = self._read()
+
+    def _read(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            logger.warning("Ignoring unreadable AMI cache %s.", self.path,
+                           exc_info=True)
+            return {}
+
+    def _write(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, "w") as f:
+                json.dump(self._cache, f, indent=2, sort_keys=True)
+        except OSError:
+            logger.warning("Unable to write the AMI cache %s.", self.path,
+                           exc_info=True)
+
+    def _cached(self, region, stale=False):
+        entry = self._cache.get(region)
+        if entry is None:
+            return None
+        if not stale and time.time() - entry["updated"] > self.ttl:
+            return None
+        return {virt: AMI(*ami) for virt, ami in entry["amis"].items()}
+
+    async def lookup(self, region):
+        """Ensure the AMIs of a region are known and current, and
+        return them.
+
+        Should the lookup fail, AMIs cached past their TTL are used.
+
+        """
+        amis = self._cached(region)
+        if amis is None:
+            pending = self._pending.get(region)
+            if pending is None:
+                pending = gen.convert_yielded(self._refresh(region))
+                self._pending[region] = pending
+                pending.add_done_callback(
+                    lambda _: self._pending.pop(region, None))
+            amis = await pending
+
+        AWS_AMI_IDS[region] = amis
+        return amis
+
+    async def _refresh(self, region):
+        try:
+            logger.debug("Looking up the AMIs of %s.", region)
+            amis = _latest_amis(await self._lookup(region))
+        except Exception:
+            amis = self._cached(region, stale=True)
+            if amis is None:
+                raise
+            logger.warning("Using the expired AMIs cached for %s.", region,
+                           exc_info=True)
+            return amis
+
+        self._cache[region] = {"updated": time.time(),
+                               "amis": {virt: list(ami)
+                                        for virt, ami in amis.items()}}
+        self._write()
+        return amis
+
+
+_DEFAULT_EXECUTOR = None
+
+
+def _default_executor():
+    """Executor shared by the collections created outside of a pool."""
+    global _DEFAULT_EXECUTOR
+    if _DEFAULT_EXECUTOR is None:
+        _DEFAULT_EXECUTOR = FairExecutor()
+    return _DEFAULT_EXECUTOR
+
+
 def available_instance(instance):
     """Returns True if an instance is usable for allocation.
 
@@ -159,20 +313,71 @@ def available_instance(instance):
         return True
 
     if instance.state == "pending":
-        oldest = datetime.today() - timedelta(minutes=2)
-        try:
-            launched = datetime.strptime(instance.launch_time,
-                                         '%Y-%m-%dT%H:%M:%S.%fZ')
-        except ValueError:
-            # Trigger by moto tests as they don't include a timezone
-            launched = datetime.strptime(instance.launch_time,
-                                         '%Y-%m-%dT%H:%M:%S')
-        if oldest < launched:
-            return True
+        return _recently_launched(_launch_time(instance))
 
     return False
 
 
+def _by_region(instances):
+    """Group instances by region."""
+    regions = OrderedDict()
+    for inst in instances:
+        regions.setdefault(inst.region.name, []).append(inst)
+    return regions
+
+
+def _location(key):
+    """Region and availability zone (or None) of a region or zone
+    name."""
+    if key in AWS_REGIONS:
+        return key, None
+    if key[:-1] in AWS_REGIONS:
+        return key[:-1], key
+    raise LoadsException("Unknown region: %s" % key)
+
+
+def _instances_for(capacity, weight=1):
+    """Number of instances of a weight needed to cover a capacity,
+    ignoring rounding leftovers."""
+    return max(math.ceil(capacity / weight - CAPACITY_EPSILON), 0)
+
+
+def distribute(count, weights):
+    """Split ``count`` over the keys of ``weights`` proportionally to
+    their weight, the largest remainders getting the leftover.
+
+    :returns: Ordered mapping of the keys to their share.
+
+    """
+    total = sum(weights.values())
+    if not weights or total <= 0 or min(weights.values()) < 0:
+        raise LoadsException("Invalid weights: %s" % dict(weights))
+    exact = [(key, count * weight / total) for key, weight in weights.items()]
+    shares = OrderedDict((key, int(share)) for key, share in exact)
+    leftover = count - sum(shares.values())
+    for key, _ in sorted(exact, key=lambda x: int(x[1]) - x[1])[:leftover]:
+        shares[key] += 1
+    return shares
+
+
+def _launch_time(instance):
+    try:
+        return datetime.strptime(instance.launch_time,
+                                 '%Y-%m-%dT%H:%M:%S.%fZ')
+    except ValueError:
+        # Trigger by moto tests as they don't include a timezone
+        return datetime.strptime(instance.launch_time, '%Y-%m-%dT%H:%M:%S')
+
+
+def _recently_launched(launched):
+    return datetime.today() - timedelta(minutes=2) < launched
+
+
+# Attributes of an instance's ExtensionState kept when it's released,
+# the others, such as its dnsmasq address, belonging to the run
+RETAINED_STATE = ("docker", "images")
+
+
 class ExtensionState:
     """A bare class that extensions can attach things to that will be
     retained on the instance."""
@@ -187,24 +392,69 @@ class EC2Instance(namedtuple('EC2Instance', 'instance state')):
 class EC2Collection:
     """Create a collection to manage a set of instances.
 
+    A collection can span several regions, ``conns`` then maps each of
+    them to its connection, ``conn`` being the connection of the first.
+
     :type instances: list of :class:`instance.Instance`
 
     """
-    def __init__(self, run_id, uuid, conn, instances, io_loop=None):
+    def __init__(self, run_id, uuid, conn, instances, io_loop=None,
+                 states=None, throttle=None, executor=None,
+                 inventory=None, conns=None, api_executor=None):
         self.run_id = run_id
         self.uuid = uuid
         self.started = False
         self.finished = False
         self.conn = conn
+        self.conns = dict(conns or {conn.region.name: conn})
         self.local_dns = False
         self._env_data = None
         self._command_args = None
-        self._executer = concurrent.futures.ThreadPoolExecutor(len(instances))
+        # SSH and docker sessions can take minutes, EC2 API calls are
+        # kept from queuing behind them on an executor of their own
+        self._executor = executor or _default_executor()
+        self._api_executor = api_executor or self._executor
         self._loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self._throttle = throttle
+        self._inventory = inventory
+
+        # Instances waited on for running, and the coroutine refreshing
+        # their state
+        self._waited = Counter()
+        self._refresher = None
+        self._refreshed = Condition()
 
         self.instances = []
-        for inst in instances:
-            self.instances.append(EC2Instance(inst, ExtensionState()))
+        self.add_instances(instances, states)
+
+    def add_instances(self, instances, states=None):
+        """Add instances to the collection.
+
+        Instances can come with the state extensions attached to them
+        while in an earlier collection.
+
+        :returns: The added :class:`EC2Instance`.
+
+        """
+        states = states or {}
+        added = [EC2Instance(x, states.get(x.id) or ExtensionState())
+                 for x in instances]
+        self.instances.extend(added)
+        return added
+
+    def subset(self, ec2_instances):
+        """A collection of some of the instances of this one, to act on
+        them alone."""
+        subset = EC2Collection(self.run_id, self.uuid, self.conn, [],
+                               self._loop, throttle=self._throttle,
+                               executor=self._executor,
+                               inventory=self._inventory, conns=self.conns,
+                               api_executor=self._api_executor)
+        subset.instances = list(ec2_instances)
+        subset.started = self.started
+        subset.finished = self.finished
+        subset.local_dns = self.local_dns
+        return subset
 
     def debug(self, msg):
         logger.debug('[uuid:%s] %s' % (self.uuid, msg))
@@ -221,6 +471,13 @@ class EC2Collection:
         instance object first, with the other args trailing.
 
         """
+        return self._submit(self._executor, func, *args, **kwargs)
+
+    def _api_execute(self, func, *args, **kwargs):
+        """Execute a blocking EC2 API call on the API executor."""
+        return self._submit(self._api_executor, func, *args, **kwargs)
+
+    def _submit(self, executor, func, *args, **kwargs):
         fut = Future()
 
         def set_fut(future):
@@ -233,10 +490,19 @@ class EC2Collection:
         def _throwback(fut):
             self._loop.add_callback(set_fut, fut)
 
-        exc_fut = self._executer.submit(func, *args, **kwargs)
+        exc_fut = executor.submit((self.run_id, self.uuid), func,
+                                  *args, **kwargs)
         exc_fut.add_done_callback(_throwback)
         return fut
 
+    def _ec2_call(self, region, func, *args, **kwargs):
+        """Execute a blocking EC2 API call for a region, throttled if the
+        collection comes from a pool."""
+        if self._throttle is None:
+            return self._api_execute(func, *args, **kwargs)
+        return self._throttle.call(region, self._api_execute, func,
+                                   *args, **kwargs)
+
     async def map(self, func, delay=0, *args, **kwargs):
         """Execute a blocking func with args/kwargs across all instances."""
         futures = []
@@ -266,31 +532,83 @@ class EC2Collection:
             self.debug("Pruning %d non-responsive instances." % len(dead))
             await self.remove_instances(dead)
 
-    async def wait_for_running(self, interval=5, timeout=600):
-        """Wait for all the instances to be running. Instances unable
-        to load will be removed."""
-        def update_state(inst):
+    async def refresh_states(self, ec2_instances=None):
+        """Refresh the state of pending instances, describing them in
+        chunks of :data:`REFRESH_CHUNK` rather than one by one.
+
+        Defaults to all the pending instances of the collection.
+
+        """
+        if ec2_instances is None:
+            ec2_instances = self.instances
+        pending = _by_region(x.instance for x in ec2_instances
+                             if x.instance.state == "pending")
+        await gen.multi([self._refresh_region(region, instances)
+                         for region, instances in pending.items()])
+
+    async def _refresh_region(self, region, pending):
+        conn = self.conns.get(region, self.conn)
+        for i in range(0, len(pending), REFRESH_CHUNK):
+            chunk = {x.id: x for x in pending[i:i + REFRESH_CHUNK]}
             try:
-                inst.instance.update()
+                updated = await self._ec2_call(region,
+                                               conn.get_only_instances,
+                                               instance_ids=list(chunk))
             except Exception:
                 # Updating state can fail, it happens
-                self.debug('Failed to update instance state: %s' %
-                           inst.instance.id)
-            return inst.instance.state
-
-        end_time = time.time() + 600
-        pending = self.pending_instances()
-
-        while time.time() < end_time and pending:
-            self.debug('%d pending instances.' % len(pending))
-            # Update the state of all the pending instances
-            await gen.multi(
-                [self.execute(update_state, inst) for inst in pending])
-            pending = self.pending_instances()
-
-            # Wait if there's pending to check again
-            if pending:
+                self.debug('Failed to update the state of %d instances.' %
+                           len(chunk))
+                continue
+
+            for inst in updated:
+                if inst.id in chunk:
+                    chunk[inst.id]._update(inst)
+
+    async def _refresh(self, interval):
+        """Refresh the instances waited on every ``interval`` seconds,
+        as long as some are."""
+        try:
+            # Let every waiter of the same batch register first
+            await gen.moment
+            while self._waited:
+                await self.refresh_states(list(self._waited))
+                self._refreshed.notify_all()
                 await self.wait(interval)
+        finally:
+            self._refresher = None
+
+    async def wait_for_instance(self, ec2_instance, interval=5, timeout=600):
+        """Wait for a single instance to be running.
+
+        The states of all the instances waited on are refreshed
+        together, see :meth:`refresh_states`.
+
+        :returns: Whether the instance is running.
+
+        """
+        inst = ec2_instance.instance
+
+        deadline = self._loop.time() + timeout
+        self._waited[ec2_instance] += 1
+        try:
+            while inst.state == "pending" and self._loop.time() < deadline:
+                if self._refresher is None:
+                    self._refresher = gen.convert_yielded(
+                        self._refresh(interval))
+                await self._refreshed.wait(deadline)
+        finally:
+            self._waited[ec2_instance] -= 1
+            if not self._waited[ec2_instance]:
+                del self._waited[ec2_instance]
+
+        return inst.state == "running"
+
+    async def wait_for_running(self, interval=5, timeout=600):
+        """Wait for all the instances to be running. Instances unable
+        to load will be removed."""
+        self.debug('%d pending instances.' % len(self.pending_instances()))
+        await gen.multi([self.wait_for_instance(x, interval, timeout)
+                         for x in self.pending_instances()])
 
         # Remove everything that isn't running by now
         dead = self.dead_instances() + self.pending_instances()
@@ -309,12 +627,16 @@ class EC2Collection:
         for inst in ec2_instances:
             self.instances.remove(inst)
 
-        instance_ids = [x.id for x in instances]
+        await gen.multi([
+            self._remove_region(region, [x.id for x in region_instances])
+            for region, region_instances in _by_region(instances).items()])
 
+    async def _remove_region(self, region, instance_ids):
+        conn = self.conns.get(region, self.conn)
         try:
             # Remove the tags
-            await self.execute(self.conn.create_tags, instance_ids,
-                               {"RunId": "", "Uuid": ""})
+            await self._ec2_call(region, conn.create_tags, instance_ids,
+                                 {"RunId": "", "Uuid": ""})
         except Exception:
             logger.debug("Error detagging instances, continuing.",
                          exc_info=True)
@@ -322,11 +644,265 @@ class EC2Collection:
         try:
             logger.debug("Terminating instances %s" % str(instance_ids))
             # Nuke them
-            await self.execute(self.conn.terminate_instances, instance_ids)
+            await self._ec2_call(region, conn.terminate_instances,
+                                 instance_ids)
+            if self._inventory is not None:
+                self._inventory.discard(instance_ids)
         except Exception:
             logger.debug("Error terminating instances.", exc_info=True)
 
 
+class FreeInstances:
+    """Instances free for allocation, indexed by region, instance type
+    and state.
+
+    Launch times are parsed once as instances are added, and taking an
+    instance out of the index doesn't rebuild any list. Pending
+    instances are also kept in a heap per region and type, newest
+    first, which entries of removed instances are only dropped from as
+    they surface. Instances that are neither running nor recently
+    launched are kept until reaped, but never handed out.
+
+    The time each instance became idle is kept for :meth:`idle`.
+
+    """
+    def __init__(self):
+        # (region, type, state) -> {instance id: instance}
+        self._buckets = defaultdict(OrderedDict)
+        # (region, type, image) -> {instance id: instance}
+        self._images = defaultdict(OrderedDict)
+        # instance id -> ((region, type, state), launch time, images,
+        #                 idle since)
+        self._entries = {}
+        # (region, type) -> heap of (-launch timestamp, seq, instance id)
+        self._pending = defaultdict(list)
+        # pending instance id -> seq of its live heap entry
+        self._pending_seq = {}
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, instance):
+        return instance.id in self._entries
+
+    def add(self, instance, images=(), idle_since=None):
+        """Add an instance, along with the names of the images it
+        holds."""
+        # Re-indexed instances may have changed state since
+        if instance.id in self._entries:
+            self.remove(instance)
+
+        key = (instance.region.name, instance.instance_type, instance.state)
+        images = tuple(images)
+        launched = _launch_time(instance)
+        self._entries[instance.id] = (key, launched, images,
+                                      idle_since or time.time())
+        self._buckets[key][instance.id] = instance
+        for image in images:
+            self._images[key[0], key[1], image][instance.id] = instance
+
+        if key[2] == "pending":
+            seq = self._pending_seq[instance.id] = next(self._seq)
+            heapq.heappush(self._pending[key[:2]],
+                           (-launched.timestamp(), seq, instance.id))
+
+    def remove(self, instance):
+        """Remove an instance."""
+        key, _, images, _ = self._entries.pop(instance.id)
+        del self._buckets[key][instance.id]
+        for image in images:
+            self._images[key[0], key[1], image].pop(instance.id, None)
+
+        # Heaps holding mostly removed entries are compacted
+        if self._pending_seq.pop(instance.id, None) is not None:
+            heap = self._pending[key[:2]]
+            if len(heap) > 2 * len(self._buckets[key]) + 16:
+                heap[:] = [x for x in heap
+                           if self._pending_seq.get(x[2]) == x[1]]
+                heapq.heapify(heap)
+
+    def _available(self, instance):
+        (_, _, state), launched, _, _ = self._entries[instance.id]
+        return state == "running" or (state == "pending" and
+                                      _recently_launched(launched))
+
+    def pop(self, region, inst_type, count, image=None):
+        """Take up to ``count`` available instances of a type out of a
+        region.
+
+        Instances holding ``image`` are taken first, then running ones,
+        then the most recently launched pending ones.
+
+        """
+        picked = []
+        if image is not None:
+            bucket = self._images.get((region, inst_type, image))
+            while bucket and len(picked) < count:
+                inst = bucket[next(iter(bucket))]
+                if self._available(inst):
+                    self.remove(inst)
+                    picked.append(inst)
+                else:
+                    del bucket[inst.id]
+
+        bucket = self._buckets.get((region, inst_type, "running"))
+        while bucket and len(picked) < count:
+            inst = bucket[next(iter(bucket))]
+            self.remove(inst)
+            picked.append(inst)
+
+        # Instances can be added in any order, as sweeps re-index them:
+        # pending ones come newest first, past the newest stalled one
+        # all of them are stalled
+        bucket = self._buckets.get((region, inst_type, "pending"))
+        heap = self._pending.get((region, inst_type))
+        while heap and len(picked) < count:
+            _, seq, inst_id = heap[0]
+            if self._pending_seq.get(inst_id) != seq:
+                heapq.heappop(heap)
+                continue
+            inst = bucket[inst_id]
+            if not self._available(inst):
+                break
+            heapq.heappop(heap)
+            self.remove(inst)
+            picked.append(inst)
+
+        return picked
+
+    def count(self, region=None, inst_type=None, state=None):
+        """Number of instances, overall or matching a region, an
+        instance type and a state."""
+        if region is None:
+            return len(self)
+        return sum(len(bucket) for key, bucket in self._buckets.items()
+                   if key[0] == region and
+                   inst_type in (None, key[1]) and state in (None, key[2]))
+
+    def idle(self, since):
+        """Instances idle since before a given timestamp, longest idle
+        first."""
+        entries = [(entry[3], inst_id)
+                   for inst_id, entry in self._entries.items()
+                   if entry[3] < since]
+        return [self._buckets[self._entries[inst_id][0]][inst_id]
+                for _, inst_id in sorted(entries)]
+
+    def drain(self):
+        """Remove all the instances.
+
+        :returns: The instances, keyed by region.
+
+        """
+        instances = defaultdict(list)
+        for (region, _, _), bucket in self._buckets.items():
+            instances[region].extend(bucket.values())
+        self._buckets.clear()
+        self._images.clear()
+        self._entries.clear()
+        self._pending.clear()
+        self._pending_seq.clear()
+        return instances
+
+
+class Inventory:
+    """In-memory view of the instances of the broker, indexed by id and
+    by their ``RunId`` and ``Uuid`` tags.
+
+    It is replaced region by region by full sweeps, and kept current in
+    between by the pool as it allocates, tags and terminates instances.
+
+    """
+    def __init__(self):
+        # instance id -> instance
+        self._instances = {}
+        # instance id -> (RunId, Uuid) the instance is indexed under
+        self._keys = {}
+        # RunId -> {instance id}
+        self._runs = defaultdict(set)
+        # Uuid -> {instance id}
+        self._steps = defaultdict(set)
+        # region -> time of the last sweep
+        self.updated = {}
+
+    def __len__(self):
+        return len(self._instances)
+
+    def __contains__(self, instance_id):
+        return instance_id in self._instances
+
+    def _unindex(self, instance_id):
+        run_id, uuid = self._keys.pop(instance_id, (None, None))
+        for index, key in ((self._runs, run_id), (self._steps, uuid)):
+            ids = index.get(key)
+            if ids is not None:
+                ids.discard(instance_id)
+                if not ids:
+                    del index[key]
+
+    def _index(self, instance):
+        self._unindex(instance.id)
+        run_id = instance.tags.get("RunId") or None
+        uuid = instance.tags.get("Uuid") or None
+        self._keys[instance.id] = (run_id, uuid)
+        if run_id:
+            self._runs[run_id].add(instance.id)
+        if uuid:
+            self._steps[uuid].add(instance.id)
+
+    def update(self, instances):
+        """Add or refresh instances."""
+        for inst in instances:
+            self._instances[inst.id] = inst
+            self._index(inst)
+
+    def replace(self, region, instances):
+        """Replace all the instances of a region with the result of a
+        sweep."""
+        gone = [inst_id for inst_id, inst in self._instances.items()
+                if inst.region.name == region]
+        self.discard(gone)
+        self.update(instances)
+        self.updated[region] = time.time()
+
+    def tag(self, instance_ids, tags):
+        """Record tags set on instances."""
+        for inst_id in instance_ids:
+            inst = self._instances.get(inst_id)
+            if inst is not None:
+                inst.tags.update(tags)
+                self._index(inst)
+
+    def discard(self, instance_ids):
+        """Forget instances."""
+        for inst_id in instance_ids:
+            if self._instances.pop(inst_id, None) is not None:
+                self._unindex(inst_id)
+
+    def get(self, instance_id):
+        return self._instances.get(instance_id)
+
+    def instances(self):
+        """All the instances."""
+        return list(self._instances.values())
+
+    def run_instances(self, run_id):
+        """Instances tagged for a run."""
+        return [self._instances[x] for x in self._runs.get(run_id, ())]
+
+    def step_instances(self, uuid):
+        """Instances tagged for a step."""
+        return [self._instances[x] for x in self._steps.get(uuid, ())]
+
+    def age(self):
+        """Seconds since the least recent sweep of a region, None
+        before every region was swept."""
+        if set(self.updated) < set(AWS_REGIONS):
+            return None
+        return time.time() - min(self.updated.values())
+
+
 class EC2Pool:
     """Initialize a pool for instance allocation and recycling.
 
@@ -344,6 +920,28 @@ class EC2Pool:
     Uuid
         STEP_ID
 
+    ``warm_pool`` maps ``(region, instance_type)`` to a number of
+    instances to keep running ahead of the runs. These are prepared by
+    the ``warmer`` coroutine, called with an :class:`EC2Collection` of
+    the instances to prepare, and are handed out first by
+    :meth:`request_instances`.
+
+    Instances left idle in the pool for more than ``max_idle`` seconds
+    are terminated by a background reaper, running every
+    ``reap_interval`` seconds. The size of the warm pool for a region
+    and instance type is the floor of running instances the reaper
+    keeps.
+
+    The :class:`Inventory` of the instances is swept again every
+    ``inventory_ttl`` seconds, and updated as the pool allocates, tags
+    and terminates instances in between.
+
+    The AMIs of a region are looked up on first use, and persisted to
+    the ``ami_cache`` JSON file, see :class:`AMICache`.
+
+    Spot requests are given ``spot_timeout`` seconds to be fulfilled
+    before being cancelled.
+
     .. warning::
 
         This instance is **NOT SAFE FOR CONCURRENT USE BY THREADS**.
@@ -352,23 +950,47 @@ class EC2Pool:
     def __init__(self, broker_id, access_key=None, secret_key=None,
                  key_pair="loads", security="loads", max_idle=600,
                  user_data=None, io_loop=None, port=None,
-                 owner_id="595879546273", use_filters=True):
+                 owner_id="595879546273", use_filters=True,
+                 warm_pool=None, warmer=None, reap_interval=60,
+                 executor=None, inventory_ttl=120, ami_cache=None,
+                 spot_timeout=300, session_executor=None):
         self.owner_id = owner_id
         self.use_filters = use_filters
         self.broker_id = broker_id
         self.access_key = access_key
         self.secret_key = secret_key
         self.max_idle = max_idle
+        self.reap_interval = reap_interval
+        self._reaper = None
+        self.inventory = Inventory()
+        self.inventory_ttl = inventory_ttl
+        self._sweeper = None
+        self.spot_timeout = spot_timeout
+        self.spot_interval = SPOT_INTERVAL
         self.key_pair = key_pair
         self.security = security
         self.user_data = user_data
-        self._instances = defaultdict(list)
+        self._instances = FreeInstances()
         self._tag_filters = {"tag:Name": "loads-%s*" % self.broker_id,
                              "tag:Project": "loads"}
         self._conns = {}
         self._recovered = {}
-        self._executor = concurrent.futures.ThreadPoolExecutor(15)
+        # EC2 API calls made for each run
+        self.api_calls = Counter()
+        self.warm_pool = dict(warm_pool or {})
+        self.warmer = warmer
+        self._warm = defaultdict(list)
+        self._warming = None
+        self._rewarm = False
+        # Extension state of the instances that left a collection, by id
+        self._states = {}
+        # EC2 API calls, and the SSH and docker sessions of collections
+        self.executor = executor or FairExecutor()
+        self.session_executor = session_executor or FairExecutor()
         self._loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.throttle = Throttle(self._loop)
+        self.amis = AMICache(self._find_amis, ami_cache)
+        self._image_filters = _image_filters(owner_id, use_filters)
         self.port = port
         # see https://github.com/boto/boto/issues/2617
         if port is not None:
@@ -385,29 +1007,55 @@ class EC2Pool:
         self.ready = Future()
 
     def shutdown(self):
-        """Make sure we shutdown the executor.
+        """Make sure we shutdown the executors.
         """
-        self._executor.shutdown()
+        if self._reaper is not None:
+            self._loop.remove_timeout(self._reaper)
+            self._reaper = None
+        if self._sweeper is not None:
+            self._loop.remove_timeout(self._sweeper)
+            self._sweeper = None
+        self.executor.shutdown()
+        self.session_executor.shutdown()
 
     def _run_in_executor(self, func, *args, **kwargs):
-        return to_tornado_future(self._executor.submit(func, *args, **kwargs))
+        return to_tornado_future(self.executor.submit(
+            ("pool", self.broker_id), func, *args, **kwargs))
+
+    def _ec2_call(self, region, func, *args, **kwargs):
+        """Execute a blocking EC2 API call for a region, throttled."""
+        return self.throttle.call(region, self._run_in_executor, func,
+                                  *args, **kwargs)
 
     def initialize(self):
         """Fully initialize the AWS pool and dependencies, recover existing
         instances, etc.
 
+        The AMIs of a region are only looked up when instances are first
+        allocated in it.
+
         :returns: A future that will require the loop running to retrieve.
 
         """
-        logger.debug("Pulling CoreOS AMI info...")
-        populate_ami_ids(self.access_key, self.secret_key, port=self.port,
-                         owner_id=self.owner_id, use_filters=self.use_filters)
         return self._recover()
 
+    async def _find_amis(self, region):
+        """List the CoreOS images of a region."""
+        conn = await self._region_conn(region)
+        return await self._ec2_call(region, conn.get_all_images,
+                                    filters=self._image_filters)
+
     def _initialized(self, future):
-        # Run the result to ensure we raise an exception if any occurred
-        logger.debug("Finished initializing: %s.", future.result())
+        # The pool is ready even when the recovery failed, the periodic
+        # sweep fills the inventory in later
+        try:
+            logger.debug("Finished initializing: %s.", future.result())
+        except Exception:
+            logger.error("Error recovering instances.", exc_info=True)
         self.ready.set_result(True)
+        self._refill_warm_pool()
+        self._schedule_reaper()
+        self._schedule_sweep()
 
     async def _region_conn(self, region=None):
         if region in self._conns:
@@ -432,19 +1080,50 @@ class EC2Pool:
         else:
             filters = {}
 
-        instances = await self._run_in_executor(
-            conn.get_only_instances,
+        instances = await self._ec2_call(
+            region, conn.get_only_instances,
             filters=filters)
 
+        self.inventory.replace(region, instances)
         return instances
 
+    async def sweep_inventory(self):
+        """Sweep every region to refresh the inventory."""
+        await gen.multi([self._recover_region(x) for x in AWS_REGIONS])
+
+    def _schedule_sweep(self):
+        self._sweeper = self._loop.call_later(self.inventory_ttl,
+                                              self._run_sweep)
+
+    def _run_sweep(self):
+        self._loop.add_future(gen.convert_yielded(self.sweep_inventory()),
+                              self._swept)
+
+    def _swept(self, future):
+        try:
+            future.result()
+        except Exception:
+            logger.error("Error sweeping the inventory.", exc_info=True)
+        if self._sweeper is not None:
+            self._schedule_sweep()
+
+    async def _recover_region_safely(self, region):
+        """Recover the instances of a region, none when it fails, so
+        the sweep can fill its inventory in later."""
+        try:
+            return await self._recover_region(region)
+        except Exception:
+            logger.error("Error recovering the instances of %s.", region,
+                         exc_info=True)
+            return []
+
     async def _recover(self):
         """Recover allocated instances from EC2."""
         recovered_instances = defaultdict(list)
 
         # Recover every region at once
         instancelist = await gen.multi(
-            [self._recover_region(x) for x in AWS_REGIONS])
+            [self._recover_region_safely(x) for x in AWS_REGIONS])
 
         logger.debug("Found %s instances to look at for recovery.",
                      sum(map(len, instancelist)))
@@ -463,7 +1142,7 @@ class EC2Pool:
                 # If this has been 'pending' too long, we put it in the main
                 # instance pool for later reaping
                 if not available_instance(instance):
-                    self._instances[region].append(instance)
+                    self._instances.add(instance)
                     continue
 
                 if tags.get("RunId") and tags.get("Uuid"):
@@ -473,7 +1152,7 @@ class EC2Pool:
                     recovered_instances[inst_key].append(instance)
                     allocated += 1
                 else:
-                    self._instances[region].append(instance)
+                    self._instances.add(instance)
                     not_used += 1
 
         logger.debug("%d instances were allocated to a run" % allocated)
@@ -493,37 +1172,398 @@ class EC2Pool:
         del self._recovered[key]
         return instances
 
-    def _locate_existing_instances(self, count, inst_type, region):
-        """Locates and removes existing available instances if any."""
-        region_instances = self._instances[region]
-        instances = []
-        remaining = []
+    def has_recovered_instances(self, run_id):
+        """Whether instances tagged for a run were recovered, and are
+        still waiting for it."""
+        return any(key[0] == run_id for key in self._recovered)
 
-        for inst in region_instances:
-            if available_instance(inst) and inst_type == inst.instance_type:
-                instances.append(inst)
-            else:
-                remaining.append(inst)
+    def holds_image(self, instance, image):
+        """Whether an instance returned to the pool is known to have an
+        image loaded."""
+        state = self._states.get(instance.id)
+        return image in getattr(state, "images", ())
 
-            if len(instances) >= count:
-                break
+    def _pick(self, instances, count, image=None):
+        """Picks up to ``count`` instances, preferring those that have
+        ``image`` loaded.
+
+        :returns: The picked instances, and the remaining ones.
 
-        # Determine how many were removed, and reconstruct the unallocated
-        # instance list with the instances not used
-        removed = len(instances) + len(remaining)
-        self._instances[region] = region_instances[removed:] + remaining
+        """
+        if image is not None:
+            instances = sorted(instances,
+                               key=lambda x: not self.holds_image(x, image))
+        picked = instances[:count]
+        return picked, [x for x in instances if x not in picked]
+
+    def _locate_existing_instances(self, count, inst_type, region,
+                                   image=None):
+        """Locates and removes existing available instances if any,
+        preferring those that already have ``image``."""
+        if count <= 0:
+            return []
+        return self._instances.pop(region, inst_type, count, image)
+
+    def _locate_warm_instances(self, count, inst_type, region, image=None):
+        """Locates and removes prepared instances from the warm pool,
+        preferring those that already have ``image``."""
+        warm = self._warm[region, inst_type]
+        available = [x for x in warm if available_instance(x)]
+        instances, warm[:] = self._pick(available, count, image)
         return instances
 
-    async def _allocate_instances(self, conn, count, inst_type, region):
-        """Allocate a set of new instances and return them."""
+    def _collection(self, run_id, uuid, conn, instances, conns=None):
+        """Create a collection, restoring the extension state the
+        instances had in their previous collection."""
+        return EC2Collection(run_id, uuid, conn, instances, self._loop,
+                             states=self._pop_states(instances),
+                             throttle=self.throttle,
+                             executor=self.session_executor,
+                             inventory=self.inventory, conns=conns,
+                             api_executor=self.executor)
+
+    def _pop_states(self, instances):
+        return {x.id: self._states.pop(x.id) for x in instances
+                if x.id in self._states}
+
+    def _keep_states(self, collection):
+        """Keep the state of the instances meant to outlive a run, for
+        when they're reused."""
+        for inst in collection.instances:
+            state = ExtensionState()
+            for name in RETAINED_STATE:
+                if hasattr(inst.state, name):
+                    setattr(state, name, getattr(inst.state, name))
+            self._states[inst.instance.id] = state
+
+    def _count_call(self, run_id):
+        if run_id:
+            self.api_calls[run_id] += 1
+
+    async def _tag_instances(self, conn, instances, tags, run_id=None):
+        """Tag instances with as few calls as possible.
+
+        The AWS API may not know about freshly allocated instances yet,
+        or throttle us: the instances that couldn't be tagged are
+        retried with a jittered exponential backoff.
+
+        """
+        instance_ids = [x.id for x in instances]
+        for attempt in range(TAG_ATTEMPTS):
+            if attempt:
+                delay = random.uniform(0, TAG_BACKOFF * 2 ** attempt)
+                await gen.Task(self._loop.add_timeout, time.time() + delay)
+
+            instance_ids = await self._create_tags(conn, instance_ids, tags,
+                                                   run_id)
+            if not instance_ids:
+                return
+
+        raise LoadsException("Unable to tag instances: %s" % instance_ids)
+
+    async def _create_tags(self, conn, instance_ids, tags, run_id=None):
+        """Tag instances in one call, leaving out the ones reported as
+        not found.
+
+        :returns: The ids of the instances to retry.
+
+        """
+        retry = []
+        while instance_ids:
+            self._count_call(run_id)
+            try:
+                await self._ec2_call(conn.region.name, conn.create_tags,
+                                     instance_ids, tags)
+                self.inventory.tag(instance_ids, tags)
+                break
+            except EC2ResponseError as exc:
+                if exc.error_code == "RequestLimitExceeded":
+                    return retry + instance_ids
+                if exc.error_code != "InvalidInstanceID.NotFound":
+                    raise
+
+                # Tag the instances that were found right away
+                missing = set(_INSTANCE_ID.findall(str(exc)))
+                found = [x for x in instance_ids if x not in missing]
+                if len(found) in (0, len(instance_ids)):
+                    return retry + instance_ids
+                retry.extend(x for x in instance_ids if x in missing)
+                instance_ids = found
+        return retry
+
+    def _refill_warm_pool(self):
+        """Top up the warm pool in the background."""
+        if not self.warm_pool:
+            return
+
+        if self._warming is not None:
+            self._rewarm = True
+            return
+
+        self._warming = gen.convert_yielded(self.fill_warm_pool())
+        self._loop.add_future(self._warming, self._warm_pool_filled)
+
+    def _warm_pool_filled(self, future):
+        self._warming = None
+        try:
+            future.result()
+        except Exception:
+            logger.error("Error filling the warm pool.", exc_info=True)
+            return
+
+        if self._rewarm:
+            self._rewarm = False
+            self._refill_warm_pool()
+
+    async def fill_warm_pool(self):
+        """Allocate and prepare instances until the warm pool holds the
+        configured number of instances of every region and type."""
+        await gen.multi([self._fill_warm(region, inst_type, count)
+                         for (region, inst_type), count
+                         in self.warm_pool.items()])
+
+    async def _fill_warm(self, region, inst_type, count):
+        warm = self._warm[region, inst_type]
+        warm[:] = [x for x in warm if available_instance(x)]
+        missing = count - len(warm)
+        if missing <= 0:
+            return
+
+        conn = await self._region_conn(region)
+        instances = self._locate_existing_instances(missing, inst_type,
+                                                    region)
+        if len(instances) < missing:
+            instances.extend(await self._allocate_instances(
+                conn, missing - len(instances), inst_type, region))
+
+        logger.debug("Warming %d %s instances in %s.", len(instances),
+                     inst_type, region)
+        collection = self._collection("", "warm-%s-%s" % (region, inst_type),
+                                      conn, instances)
+        warmed = False
+        try:
+            if self.use_filters:
+                await self._tag_instances(conn, instances, {
+                    "Name": "loads-%s" % self.broker_id,
+                    "Project": "loads",
+                })
+
+            await collection.wait_for_running()
+            if self.warmer is not None:
+                await self.warmer(collection)
+            warmed = True
+        finally:
+            # Instances that failed to warm go back to the free ones,
+            # rather than running untracked
+            self._keep_states(collection)
+            for inst in collection.instances:
+                if warmed:
+                    self._warm[region, inst_type].append(inst.instance)
+                else:
+                    self._instances.add(inst.instance,
+                                        getattr(inst.state, "images", ()))
+
+    async def _allocate_instances(self, conn, count, inst_type, region,
+                                  run_id=None, allocation="on-demand",
+                                  spot_price=None, partial=False,
+                                  placement=None):
+        """Allocate a set of new instances and return them.
+
+        With the ``spot-fallback`` allocation strategy, on-demand
+        instances are allocated for the spot requests that weren't
+        fulfilled. Fewer on-demand instances than requested can be
+        returned if ``partial`` is set.
+
+        The instances are launched in the ``placement`` availability
+        zone if given.
+
+        """
+        if allocation not in ALLOCATION_STRATEGIES:
+            raise LoadsException("Unknown allocation strategy: %s" %
+                                 allocation)
+
+        await self.amis.lookup(region)
         ami_id = get_ami(region, inst_type)
-        reservations = await self._run_in_executor(
-            conn.run_instances,
-            ami_id, min_count=count, max_count=count,
+
+        instances = []
+        if allocation != "on-demand":
+            instances = await self._allocate_spot_instances(
+                conn, count, inst_type, region, ami_id, spot_price, run_id,
+                placement)
+            if allocation == "spot" or len(instances) == count:
+                return instances
+            logger.debug("%d spot instances unfulfilled in %s, allocating "
+                         "on-demand instances.", count - len(instances),
+                         region)
+
+        count -= len(instances)
+        self._count_call(run_id)
+        reservations = await self._ec2_call(
+            region, conn.run_instances,
+            ami_id, min_count=1 if partial else count, max_count=count,
+            key_name=self.key_pair, security_groups=[self.security],
+            user_data=self.user_data, instance_type=inst_type,
+            placement=placement)
+
+        self.inventory.update(reservations.instances)
+        return instances + reservations.instances
+
+    async def _allocate_capacity(self, conn, capacity, weights, region,
+                                 run_id=None, allocation="on-demand",
+                                 spot_price=None, placement=None):
+        """Allocate instances adding up to ``capacity``, from a mix of
+        instance types.
+
+        :param weights: Ordered mapping of the acceptable instance types
+                        to the capacity of one of their instances.
+
+        The first type is asked for the whole capacity. Once a type
+        runs out of capacity, what is left is spread over all the
+        remaining types at once.
+
+        """
+        instances = []
+        candidates = list(weights.items())[:1]
+        fallbacks = list(weights.items())[1:]
+        while capacity > CAPACITY_EPSILON and candidates:
+            share = capacity / len(candidates)
+            counts = [_instances_for(share, weight)
+                      for _, weight in candidates]
+            allocated = await gen.multi([
+                self._allocate_type(conn, count, inst_type, region, run_id,
+                                    allocation, spot_price,
+                                    placement=placement)
+                for (inst_type, _), count in zip(candidates, counts)])
+
+            saturated = []
+            for (inst_type, weight), count, new in zip(candidates, counts,
+                                                       allocated):
+                instances.extend(new)
+                capacity -= len(new) * weight
+                if len(new) < count:
+                    saturated.append(inst_type)
+
+            if saturated:
+                logger.debug("Out of capacity for %s in %s.",
+                             ", ".join(saturated), region)
+            candidates = [x for x in candidates + fallbacks
+                          if x[0] not in saturated]
+            fallbacks = []
+
+        if capacity > CAPACITY_EPSILON:
+            logger.debug("Missing a capacity of %s in %s.", capacity, region)
+        return instances
+
+    async def _allocate_type(self, conn, count, inst_type, region, *args,
+                             **kwargs):
+        """Allocate up to ``count`` instances of a type, none if the type
+        is out of capacity."""
+        try:
+            return await self._allocate_instances(
+                conn, count, inst_type, region, *args, partial=True,
+                **kwargs)
+        except EC2ResponseError as exc:
+            if exc.error_code not in CAPACITY_ERRORS:
+                raise
+            return []
+
+    async def _allocate_spot_instances(self, conn, count, inst_type, region,
+                                       ami_id, spot_price, run_id=None,
+                                       placement=None):
+        """Request spot instances, and return the ones fulfilled within
+        ``spot_timeout`` seconds."""
+        if spot_price is None:
+            raise LoadsException("Spot instances need a spot price.")
+
+        self._count_call(run_id)
+        requests = await self._ec2_call(
+            region, conn.request_spot_instances,
+            str(spot_price), ami_id, count=count,
             key_name=self.key_pair, security_groups=[self.security],
-            user_data=self.user_data, instance_type=inst_type)
+            user_data=self.user_data, instance_type=inst_type,
+            placement=placement)
+
+        instance_ids = await self._fulfill_spot_requests(
+            conn, [x.id for x in requests], run_id)
+        logger.debug("%d of %d spot requests fulfilled in %s.",
+                     len(instance_ids), count, region)
+        if not instance_ids:
+            return []
+
+        instances = await self._get_spot_instances(conn, instance_ids,
+                                                   run_id)
+        self.inventory.update(instances)
+        return instances
+
+    async def _get_spot_instances(self, conn, instance_ids, run_id=None):
+        """Look up the instances launched for spot requests.
+
+        The AWS API may not know about them yet: the lookup is retried
+        with the backoff of :meth:`_tag_instances`, after which the
+        instances are terminated by id, and treated as unfulfilled.
+
+        """
+        region = conn.region.name
+        for attempt in range(TAG_ATTEMPTS):
+            if attempt:
+                delay = random.uniform(0, TAG_BACKOFF * 2 ** attempt)
+                await gen.Task(self._loop.add_timeout, time.time() + delay)
+
+            self._count_call(run_id)
+            try:
+                return await self._ec2_call(region, conn.get_only_instances,
+                                            instance_ids=instance_ids)
+            except EC2ResponseError as exc:
+                if exc.error_code not in ("InvalidInstanceID.NotFound",
+                                          "RequestLimitExceeded"):
+                    raise
+
+        logger.warning("Unable to find spot instances %s in %s, "
+                       "terminating them.", instance_ids, region)
+        self._count_call(run_id)
+        try:
+            await self._ec2_call(region, conn.terminate_instances,
+                                 instance_ids)
+        except Exception:
+            logger.error("Error terminating spot instances %s.",
+                         instance_ids, exc_info=True)
+        return []
+
+    async def _fulfill_spot_requests(self, conn, request_ids, run_id=None):
+        """Wait for spot requests to be fulfilled, then cancel the
+        others.
+
+        :returns: Ids of the instances launched for the requests.
+
+        """
+        region = conn.region.name
+        deadline = time.time() + self.spot_timeout
+        while True:
+            self._count_call(run_id)
+            requests = await self._ec2_call(
+                region, conn.get_all_spot_instance_requests,
+                request_ids=request_ids)
+            waiting = [x for x in requests if x.state == "open" and
+                       getattr(x.status, "code", None)
+                       not in SPOT_UNFULFILLED]
+            if not waiting or time.time() >= deadline:
+                break
+            await gen.Task(self._loop.add_timeout,
+                           time.time() + self.spot_interval)
+
+        unfulfilled = [x.id for x in requests if not x.instance_id]
+        if unfulfilled:
+            self._count_call(run_id)
+            await self._ec2_call(region, conn.cancel_spot_instance_requests,
+                                 unfulfilled)
 
-        return reservations.instances
+            # Requests fulfilled since they were last checked
+            self._count_call(run_id)
+            requests = await self._ec2_call(
+                region, conn.get_all_spot_instance_requests,
+                request_ids=request_ids)
+
+        return [x.instance_id for x in requests if x.instance_id]
 
     async def request_instances(self,
                                 run_id: str,
@@ -534,7 +1574,12 @@ class EC2Pool:
                                 allocate_missing=True,
                                 plan: Optional[str] = None,
                                 owner: Optional[str] = None,
-                                run_max_time: Optional[int] = None):
+                                run_max_time: Optional[int] = None,
+                                image: Optional[str] = None,
+                                allocation="on-demand",
+                                spot_price: Optional[float] = None,
+                                fallback_types: Optional[dict] = None,
+                                distribution: Optional[dict] = None):
         """Allocate a collection of instances.
 
         :param run_id: Run ID for these instances
@@ -550,69 +1595,179 @@ class EC2Pool:
         :param owner: Owner name of the instances
         :param run_max_time: Maximum expected run-time of instances in
             seconds
+        :param image: Name/tag of the docker image the instances will
+            run. Instances that already have it loaded are preferred.
+        :param allocation: How missing instances are allocated, one of
+            :data:`ALLOCATION_STRATEGIES`
+        :param spot_price: Maximum hourly price of spot instances
+        :param fallback_types: Ordered mapping of the instance types
+            acceptable when ``inst_type`` runs out of capacity, to the
+            number of ``inst_type`` instances one of them is worth.
+            ``count`` is then the capacity to allocate.
+        :param distribution: Mapping of regions or availability zones to
+            their weight, to spread the instances over them rather than
+            allocating them in ``region``. Instances are taken from the
+            warm pool and the free instances of a region regardless of
+            their zone.
         :returns: Collection of allocated instances
         :rtype: :class:`EC2Collection`
 
         """
-        if region not in AWS_REGIONS:
-            raise LoadsException("Unknown region: %s" % region)
+        shares = distribute(count, distribution or {region: 1})
+        locations = [_location(x) for x in shares]
 
         # First attempt to recover instances for this run/uuid
-        instances = self._locate_recovered_instances(run_id, uuid)
-        remaining_count = count - len(instances)
+        recovered = self._place(self._locate_recovered_instances(run_id,
+                                                                 uuid),
+                                locations)
 
-        conn = await self._region_conn(region)
+        regions = list(OrderedDict.fromkeys(
+            [x[0] for x in locations] +
+            [x.region.name for x in sum(recovered, [])]))
+        conns = OrderedDict(zip(regions, await gen.multi(
+            [self._region_conn(x) for x in regions])))
 
         # If existing/new are not being allocated, the recovered are
         # already tagged, so we're done.
-        if not allocate_missing:
-            return EC2Collection(run_id, uuid, conn, instances, self._loop)
+        if allocate_missing:
+            tags = self._run_tags(run_id, uuid, plan, owner, run_max_time)
+            recovered = await gen.multi([
+                self._request_location(
+                    conns[location[0]], location[1], share, instances,
+                    run_id, inst_type, image, allocation, spot_price,
+                    fallback_types, owner, tags)
+                for location, share, instances
+                in zip(locations, shares.values(), recovered)])
+
+        instances = sum(recovered, [])
+        return self._collection(run_id, uuid, conns[regions[0]], instances,
+                                conns)
+
+    async def replenish(self, collection, count, inst_type="t1.micro",
+                        region="us-west-2", plan=None, owner=None,
+                        run_max_time=None, image=None,
+                        allocation="on-demand", spot_price=None,
+                        fallback_types=None, distribution=None):
+        """Top a collection back up to ``count`` instances, after some
+        died, allocating them as :meth:`request_instances` does.
+
+        Each region or zone of the ``distribution`` gets back the
+        instances it is missing.
+
+        :returns: The :class:`EC2Instance` added to the collection.
 
-        # Add any more remaining that should be used
-        instances.extend(
-            self._locate_existing_instances(remaining_count, inst_type, region)
-        )
+        """
+        shares = distribute(count, distribution or {region: 1})
+        locations = [_location(x) for x in shares]
+        held = self._place([x.instance for x in collection.instances],
+                           locations)
+
+        weights = OrderedDict([(inst_type, 1)])
+        weights.update(fallback_types or {})
+        missing = [(location, share - sum(weights.get(x.instance_type, 1)
+                                          for x in instances))
+                   for location, share, instances
+                   in zip(locations, shares.values(), held)]
+        missing = [x for x in missing if x[1] > CAPACITY_EPSILON]
+        if not missing:
+            return []
+
+        conns = await gen.multi([self._region_conn(location[0])
+                                 for location, _ in missing])
+        tags = self._run_tags(collection.run_id, collection.uuid, plan, owner,
+                              run_max_time)
+        allocated = await gen.multi([
+            self._request_location(
+                conn, location[1], num, [], collection.run_id, inst_type,
+                image, allocation, spot_price, fallback_types, owner, tags)
+            for conn, (location, num) in zip(conns, missing)])
+
+        for conn in conns:
+            collection.conns.setdefault(conn.region.name, conn)
+        instances = sum(allocated, [])
+        return collection.add_instances(instances, self._pop_states(instances))
+
+    def _run_tags(self, run_id, uuid, plan=None, owner=None,
+                  run_max_time=None):
+        """Tags of the instances of a run's step, None when the pool
+        doesn't use tags."""
+        if not self.use_filters:
+            return None
+
+        tags = {
+            "Name": "loads-{}{}".format(self.broker_id,
+                                        "-" + plan if plan else ""),
+            "Project": "loads",
+            "RunId": run_id,
+            "Uuid": uuid,
+        }
+        if owner:
+            tags["Owner"] = owner
+        if run_max_time is not None:
+            self._tag_for_reaping(tags, run_max_time)
+        return tags
+
+    def _place(self, instances, locations):
+        """Split instances over locations, by availability zone then by
+        region. Instances of no location go to the first one."""
+        placed = [[] for _ in locations]
+        for inst in instances:
+            region, zone = inst.region.name, inst.placement
+            matches = ([i for i, x in enumerate(locations)
+                        if x == (region, zone)] or
+                       [i for i, x in enumerate(locations)
+                        if x == (region, None)] or
+                       [i for i, x in enumerate(locations)
+                        if x[0] == region] or [0])
+            placed[matches[0]].append(inst)
+        return placed
+
+    async def _request_location(self, conn, zone, count, instances, run_id,
+                                inst_type, image, allocation, spot_price,
+                                fallback_types, owner, tags):
+        """Complete the instances of a collection in a region, or one of
+        its availability zones, and tag them."""
+        region = conn.region.name
+
+        # Capacity still missing, the instances held being worth their
+        # type's weight
+        weights = OrderedDict([(inst_type, 1)])
+        weights.update(fallback_types or {})
+        num = count - sum(weights.get(x.instance_type, 1) for x in instances)
+
+        # Prepared instances from the warm pool come first, then any
+        # more remaining that should be used. Both are of ``inst_type``,
+        # worth one each.
+        warm = self._locate_warm_instances(_instances_for(num),
+                                           inst_type, region, image)
+        num -= len(warm)
+        existing = self._locate_existing_instances(_instances_for(num),
+                                                   inst_type, region, image)
+        num -= len(existing)
+        instances.extend(warm + existing)
+        if warm:
+            logger.debug("Using %d warm instances.", len(warm))
+            self._refill_warm_pool()
 
         # Determine if we should allocate more instances
-        num = count - len(instances)
-        if num > 0:
-            new_instances = await self._allocate_instances(
-                conn, num, inst_type, region)
+        if num > CAPACITY_EPSILON:
+            if len(weights) > 1:
+                new_instances = await self._allocate_capacity(
+                    conn, num, weights, region, run_id, allocation,
+                    spot_price, placement=zone)
+            else:
+                new_instances = await self._allocate_instances(
+                    conn, num, inst_type, region, run_id, allocation,
+                    spot_price, placement=zone)
             logger.debug("Allocated instances%s: %s",
                          " (Owner: %s)" % owner if owner else "",
                          new_instances)
             instances.extend(new_instances)
 
         # Tag all the instances
-        if self.use_filters:
-            tags = {
-                "Name": "loads-{}{}".format(self.broker_id,
-                                            "-" + plan if plan else ""),
-                "Project": "loads",
-                "RunId": run_id,
-                "Uuid": uuid,
-            }
-            if owner:
-                tags["Owner"] = owner
-            if run_max_time is not None:
-                self._tag_for_reaping(tags, run_max_time)
-
-            # Sometimes, we can get instance data back before the AWS
-            # API fully recognizes it, so we wait as needed.
-            async def tag_instance(instance):
-                retries = 0
-                while True:
-                    try:
-                        await self._run_in_executor(
-                            conn.create_tags, [instance.id], tags)
-                        break
-                    except:
-                        if retries > 5:
-                            raise
-                    retries += 1
-                    await gen.Task(self._loop.add_timeout, time.time() + 1)
-            await gen.multi([tag_instance(x) for x in instances])
-        return EC2Collection(run_id, uuid, conn, instances, self._loop)
+        if tags is not None:
+            await self._tag_instances(conn, instances, tags, run_id)
+        return instances
 
     def _tag_for_reaping(self,
                          tags: Dict[str, str],
@@ -643,30 +1798,109 @@ class EC2Pool:
         if not collection.instances:
             return
 
-        region = collection.instances[0].instance.region.name
-        instances = [x.instance for x in collection.instances]
-
         # De-tag the Run data on these instances
+        if self.use_filters:
+            regions = _by_region(x.instance for x in collection.instances)
+            conns = await gen.multi([self._region_conn(x) for x in regions])
+            await gen.multi([
+                self._tag_instances(conn, instances,
+                                    {"RunId": "", "Uuid": ""},
+                                    collection.run_id)
+                for conn, instances in zip(conns, regions.values())])
+
+        self._keep_states(collection)
+        for inst in collection.instances:
+            self._instances.add(inst.instance,
+                                getattr(inst.state, "images", ()))
+        self._refill_warm_pool()
+
+    async def _terminate(self, region, instances):
+        """Terminate instances of a region in a single call."""
+        if not instances:
+            return
+
+        for inst in instances:
+            self._states.pop(inst.id, None)
+
+        instance_ids = [x.id for x in instances]
         conn = await self._region_conn(region)
+        await self._ec2_call(region, conn.terminate_instances, instance_ids)
+        self.inventory.discard(instance_ids)
 
-        if self.use_filters:
-            await self._run_in_executor(
-                conn.create_tags,
-                [x.id for x in instances],
-                {"RunId": "", "Uuid": ""})
+    async def terminate_instances(self, instances):
+        """Terminate instances, with a single throttled call per region.
+
+        Free and warm instances among them are taken out of the pool.
+
+        :returns: The ids of the terminated instances.
+
+        """
+        ids = set(x.id for x in instances)
+        for inst in instances:
+            if inst in self._instances:
+                self._instances.remove(inst)
+        for warm in self._warm.values():
+            warm[:] = [x for x in warm if x.id not in ids]
 
-        self._instances[region].extend(instances)
+        await gen.multi([self._terminate(region, region_instances)
+                         for region, region_instances
+                         in _by_region(instances).items()])
+        return [x.id for x in instances]
 
     async def reap_instances(self):
         """Immediately reap all instances."""
         # Remove all the instances before yielding actions
-        all_instances = self._instances
-        self._instances = defaultdict(list)
+        all_instances = self._instances.drain()
+        for (region, _), instances in self._warm.items():
+            all_instances[region].extend(instances)
+        self._warm = defaultdict(list)
 
         for region, instances in all_instances.items():
-            conn = await self._region_conn(region)
+            await self._terminate(region, instances)
 
-            # submit these instances for termination
-            await self._run_in_executor(
-                conn.terminate_instances,
-                [x.id for x in instances])
+    def _schedule_reaper(self):
+        self._reaper = self._loop.call_later(self.reap_interval,
+                                             self._run_reaper)
+
+    def _run_reaper(self):
+        self._loop.add_future(
+            gen.convert_yielded(self.reap_idle_instances()),
+            self._reaped)
+
+    def _reaped(self, future):
+        try:
+            future.result()
+        except Exception:
+            logger.error("Error reaping idle instances.", exc_info=True)
+        if self._reaper is not None:
+            self._schedule_reaper()
+
+    async def reap_idle_instances(self):
+        """Terminate the instances idle for more than ``max_idle``
+        seconds, sparing enough running ones to keep the warm pool
+        floor."""
+        idle = defaultdict(list)
+        for inst in self._instances.idle(time.time() - self.max_idle):
+            idle[inst.region.name, inst.instance_type].append(inst)
+
+        reaped = defaultdict(list)
+        for (region, inst_type), instances in idle.items():
+            running = [x for x in instances if x.state == "running"]
+            free = self._instances.count(region, inst_type, "running")
+            spare = (self.warm_pool.get((region, inst_type), 0) -
+                     len(self._warm[region, inst_type]) -
+                     (free - len(running)))
+
+            # The most recently idle are the ones spared
+            if spare > 0:
+                spared = set(x.id for x in running[-spare:])
+                instances = [x for x in instances if x.id not in spared]
+
+            for inst in instances:
+                self._instances.remove(inst)
+            reaped[region].extend(instances)
+
+        for region, instances in reaped.items():
+            logger.debug("Reaping %d idle instances in %s.",
+                         len(instances), region)
+            await self._terminate(region, instances)
@@ -26,11 +26,11 @@ Complete name of environment variables available in a test container:
     Port of the statsd host.
 
 """
+import math
 import os
-import time
 import concurrent.futures
-from collections import namedtuple
-from datetime import datetime
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
 from functools import partial
 from pprint import pformat
 
@@ -46,12 +46,16 @@ from loadsbroker.db import (
     Database,
     Run,
     Project,
+    INITIALIZING,
     RUNNING,
     TERMINATING,
     COMPLETED,
     setup_database,
 )
 from loadsbroker.exceptions import LoadsException
+from loadsbroker.executor import FairExecutor
+from loadsbroker.imagecache import CACHE_SIZE, ImageCache
+from loadsbroker.scheduler import RunSupervisor, START, STOP, CHECK
 from loadsbroker.extensions import (
     DNSMasq,
     Docker,
@@ -59,8 +63,10 @@ from loadsbroker.extensions import (
     Watcher,
     Ping,
     SSH,
+    SYSCTL_RELOAD,
     ContainerInfo,
 )
+from loadsbroker.ssh import ProvisionScript
 from loadsbroker.webapp.api import _DEFAULTS
 
 import threading
@@ -84,6 +90,11 @@ DNSMASQ_INFO = ContainerInfo(
     "kitcambridge/dnsmasq:latest",
     "https://s3.amazonaws.com/loads-docker-images/dnsmasq.tar.bz2")
 
+BASE_CONTAINERS = [HEKA_INFO, DNSMASQ_INFO, WATCHER_INFO]
+
+# How many of the most recently used step images warm instances get
+RECENT_IMAGES = 5
+
 
 def log_threadid(msg):
     """Log a message, including the thread ID"""
@@ -91,6 +102,53 @@ def log_threadid(msg):
     logger.debug("Msg: %s, ThreadID: %s", msg, thread_id)
 
 
+def _quorum(count, fraction):
+    """Number of instances out of ``count`` that need to be ready for a
+    step to proceed."""
+    if fraction is None:
+        fraction = 1.0
+    fraction = min(max(fraction, 0.0), 1.0)
+    return min(count, max(1, math.ceil(count * fraction)))
+
+
+async def _prepare_instance(docker, collection, ec2_instance, images):
+    """Bring up a single instance: wait for it to be running, then for
+    docker, and load the images on it.
+
+    The progress is kept in ``ec2_instance.state.phase``.
+
+    :returns: Whether the instance is ready.
+
+    """
+    state = ec2_instance.state
+
+    state.phase = "pending"
+    if not await collection.wait_for_instance(ec2_instance):
+        state.phase = "failed"
+        return False
+
+    state.phase = "running"
+    docker.setup_instance(ec2_instance)
+    if not await docker.wait_instance(collection, ec2_instance,
+                                      timeout=360):
+        state.phase = "failed"
+        return False
+
+    # Given up on as a straggler in the meantime
+    if ec2_instance not in collection.instances:
+        return False
+
+    state.phase = "docker"
+    if not await docker.load_images(collection, ec2_instance, images):
+        state.phase = "failed"
+        return False
+
+    if ec2_instance not in collection.instances:
+        return False
+    state.phase = "ready"
+    return True
+
+
 class RunHelpers:
     """Empty object used to reference initialized extensions."""
     pass
@@ -100,7 +158,11 @@ class Broker:
     def __init__(self, name, io_loop, sqluri, ssh_key,
                  heka_options, influx_options, aws_port=None,
                  aws_owner_id="595879546273", aws_use_filters=True,
-                 aws_access_key=None, aws_secret_key=None, initial_db=None):
+                 aws_access_key=None, aws_secret_key=None, initial_db=None,
+                 image_load_concurrency=4, warm_pool=None, max_idle=600,
+                 max_workers=128, ami_cache=None, image_cache=None,
+                 image_cache_url=None, image_cache_size=CACHE_SIZE,
+                 api_workers=16, download_workers=4):
         self.name = name
         logger.debug("loads-broker (%s)", self.name)
 
@@ -139,13 +201,32 @@ class Broker:
                                 owner_id=aws_owner_id,
                                 use_filters=aws_use_filters,
                                 access_key=aws_access_key,
-                                secret_key=aws_secret_key)
+                                secret_key=aws_secret_key,
+                                warm_pool=warm_pool,
+                                warmer=self._warm_collection,
+                                max_idle=max_idle,
+                                executor=FairExecutor(api_workers),
+                                session_executor=FairExecutor(max_workers),
+                                ami_cache=ami_cache)
+
+        # Step images of the latest runs, loaded on warm instances
+        self._recent_images = OrderedDict()
+
+        # Image tarballs served to the instances by the broker
+        self.image_cache = None
+        self.download_executor = FairExecutor(download_workers)
+        if image_cache and image_cache_url:
+            self.image_cache = ImageCache(image_cache, image_cache_url,
+                                          self.download_executor,
+                                          max_size=image_cache_size)
 
         # Utilities used by RunManager
         ssh = SSH(ssh_keyfile=ssh_key)
         self.run_helpers = run_helpers = RunHelpers()
         run_helpers.ping = Ping(self.loop)
-        run_helpers.docker = Docker(ssh)
+        run_helpers.docker = Docker(
+            ssh, load_concurrency=image_load_concurrency,
+            image_cache=self.image_cache)
         run_helpers.dns = DNSMasq(DNSMASQ_INFO, run_helpers.docker)
         run_helpers.heka = Heka(HEKA_INFO, ssh=ssh, options=heka_options,
                                 influx=influx_options)
@@ -155,15 +236,106 @@ class Broker:
 
         self.db = Database(sqluri, echo=True)
 
-        # Run managers keyed by uuid
+        # Run managers keyed by uuid, all sharing the supervisor driving
+        # their steps. Each has a session of its own, so a failed commit
+        # only rolls back the changes of its run
         self._runs = {}
+        self.supervisor = RunSupervisor(self.loop)
 
         # Ensure the db is setup
         if initial_db:
             setup_database(self.db.session(), initial_db)
 
+        # Resume the runs left in-flight once the pool has recovered its
+        # instances
+        self.loop.add_future(self.pool.ready, self._recover_runs)
+
+    def _recover_runs(self, future):
+        """Recover the runs that were in progress when the broker last
+        stopped, re-attaching them to their recovered instances.
+
+        Runs that never started and have no instances left are aborted
+        rather than allocated a new fleet.
+
+        """
+        if future.exception():
+            return
+
+        session = self.db.session()
+        runs = session.query(Run).filter(Run.state != COMPLETED).all()
+        for run in runs:
+            if run.uuid in self._runs:
+                continue
+
+            if run.started_at is None and \
+                    not self.pool.has_recovered_instances(run.uuid):
+                logger.debug("Aborting run %s, no instances were "
+                             "recovered for it.", run.uuid)
+                run.state = COMPLETED
+                run.aborted = True
+                run.completed_at = datetime.utcnow()
+                session.commit()
+                continue
+
+            logger.debug("Recovering run %s", run.uuid)
+            run_session = self.db.session()
+            mgr, future = RunManager.recover_run(
+                run_helpers=self.run_helpers,
+                db_session=run_session,
+                pool=self.pool,
+                io_loop=self.loop,
+                run_uuid=run.uuid,
+                supervisor=self.supervisor)
+            callback = partial(self._run_complete, run_session, mgr)
+            future.add_done_callback(callback)
+            self._runs[run.uuid] = mgr
+
+    async def _warm_collection(self, collection):
+        """Prepare instances for the warm pool: docker is up, and the base
+        images and the most recently used step images are loaded.
+
+        Instances that fail to come up are terminated.
+
+        """
+        images = [(x.name, x.url) for x in BASE_CONTAINERS]
+        images.extend(self._recent_images)
+
+        async def prepare(ec2_instance):
+            try:
+                return await _prepare_instance(self.run_helpers.docker,
+                                               collection, ec2_instance,
+                                               images)
+            except Exception:
+                logger.error("Error warming %s.", ec2_instance.instance.id,
+                             exc_info=True)
+                ec2_instance.state.phase = "failed"
+                return False
+
+        instances = list(collection.instances)
+        results = await gen.multi([prepare(x) for x in instances])
+        await collection.remove_instances(
+            [x for x, ready in zip(instances, results) if not ready])
+
+    def _use_images(self, steps):
+        """Record the images of the steps as the most recently used."""
+        for step in steps:
+            image = (step.container_name, step.container_url)
+            self._recent_images.pop(image, None)
+            self._recent_images[image] = True
+
+        while len(self._recent_images) > RECENT_IMAGES:
+            self._recent_images.popitem(last=False)
+
     def shutdown(self):
         self.pool.shutdown()
+        self.download_executor.shutdown()
+
+    def executor_stats(self):
+        """Instrumentation of the executors doing blocking I/O, by the
+        kind of work they do."""
+        return {"ec2": self.pool.executor.stats(),
+                "sessions": self.pool.session_executor.stats(),
+                "downloads": self.download_executor.stats()}
 
     def get_projects(self, fields=None):
         projects = self.db.session().query(Project).all()
@@ -241,13 +413,15 @@ class Broker:
                 plan_uuid=strategy_id,
                 run_uuid=uuid,
                 additional_env=kwargs,
-                owner=owner)
+                owner=owner,
+                supervisor=self.supervisor)
         except NoResultFound as e:
             raise LoadsException(str(e))
 
         callback = partial(self._run_complete, session, mgr)
         future.add_done_callback(callback)
         self._runs[mgr.run.uuid] = mgr
+        self._use_images(mgr.run.plan.steps)
 
         # create an Influx Database
         if create_db:
@@ -305,7 +479,8 @@ class RunManager:
     """Manages the life-cycle of a load run.
 
     """
-    def __init__(self, run_helpers, db_session, pool, io_loop, run):
+    def __init__(self, run_helpers, db_session, pool, io_loop, run,
+                 supervisor=None):
         self.helpers = run_helpers
         self.run = run
         self._db_session = db_session
@@ -313,12 +488,26 @@ class RunManager:
         self._loop = io_loop
         self._set_links = []
         self._dns_map = {}
-        self.abort = False
+        self._abort = False
         self._state_description = ""
-        # XXX see what should be this time
-        self.sleep_time = 1.5
+        self._supervisor = supervisor or RunSupervisor(io_loop)
+
+        # Set when the run is being recovered after a broker restart
+        self._recovering = False
+
+        # Initialization of each step's collection, and the steps that
+        # were due to start before their collection was ready
+        self._step_inits = {}
+        self._deferred_starts = set()
 
-        self.base_containers = [HEKA_INFO, DNSMASQ_INFO, WATCHER_INFO]
+        # Replacement of the dead instances of steps maintaining their
+        # instance count
+        self._replenishing = {}
+
+        # How often started steps are checked for exited containers
+        self.exit_check_interval = 15
+
+        self.base_containers = list(BASE_CONTAINERS)
 
         # Setup the run environment vars
         self.run_env = BASE_ENV.copy()
@@ -334,9 +523,21 @@ class RunManager:
 
     state_description = property(_get_state, _set_state)
 
+    def _get_abort(self):
+        return self._abort
+
+    def _set_abort(self, abort):
+        self._abort = abort
+        if abort:
+            # Wake the supervisor so the abort is acted on right away
+            self._supervisor.notify()
+
+    abort = property(_get_abort, _set_abort)
+
     @classmethod
     def new_run(cls, run_helpers, db_session, pool, io_loop, plan_uuid,
-                run_uuid=None, additional_env=None, owner=None):
+                run_uuid=None, additional_env=None, owner=None,
+                supervisor=None):
         """Create a new run manager for the given strategy name
 
         This creates a new run for this strategy and initializes it.
@@ -348,6 +549,9 @@ class RunManager:
         :param run_uuid: Use the provided run_uuid instead of generating one
         :param additional_env: Additional env args to use in container set
                                interpolation
+        :param supervisor: The :class:`~loadsbroker.scheduler.RunSupervisor`
+                           driving the run's steps, a private one is used
+                           if not provided
 
         :returns: New RunManager in the process of being initialized,
                   along with a future tracking the run.
@@ -363,16 +567,39 @@ class RunManager:
 
         log_threadid("Committed new session.")
 
-        run_manager = cls(run_helpers, db_session, pool, io_loop, run)
+        run_manager = cls(run_helpers, db_session, pool, io_loop, run,
+                          supervisor)
         if additional_env:
             run_manager.run_env.update(additional_env)
         future = gen.convert_yielded(run_manager.start())
         return run_manager, future
 
     @classmethod
-    def recover_run(cls, run_uuid):
-        """Given a run uuid, fully reconstruct the run manager state"""
-        pass
+    def recover_run(cls, run_helpers, db_session, pool, io_loop, run_uuid,
+                    supervisor=None):
+        """Given a run uuid, fully reconstruct the run manager state
+
+        The run's steps are re-attached to the instances the pool
+        recovered for them. Runs that were already running or
+        terminating only get their docker clients set up again; their
+        images are loaded and their containers are left untouched.
+
+        Additional env args passed when the run was created are not
+        stored, and won't be available to steps started after the
+        recovery.
+
+        :returns: The recovered RunManager, along with a future tracking
+                  the run.
+
+        """
+        logger.debug('Recovering run manager: %s', run_uuid)
+        run = db_session.query(Run).filter(Run.uuid == run_uuid).one()
+
+        run_manager = cls(run_helpers, db_session, pool, io_loop, run,
+                          supervisor)
+        run_manager._recovering = True
+        future = gen.convert_yielded(run_manager.start())
+        return run_manager, future
 
     @property
     def uuid(self):
@@ -382,6 +609,24 @@ class RunManager:
     def state(self):
         return self.run.state
 
+    @property
+    def step_links(self):
+        return self._set_links
+
+    def _instance_options(self, step):
+        """Options of the pool allocating the instances of a step."""
+        return dict(count=step.instance_count,
+                    inst_type=step.instance_type,
+                    region=step.instance_region,
+                    plan=self.run.plan.name,
+                    owner=self.run.owner,
+                    run_max_time=step.run_delay + step.run_max_time,
+                    image=step.container_name,
+                    allocation=step.allocation,
+                    spot_price=step.spot_price,
+                    fallback_types=step.instance_fallbacks,
+                    distribution=step.instance_distribution)
+
     async def _get_steps(self):
         """Request all the step instances needed from the pool
 
@@ -391,16 +636,15 @@ class RunManager:
         """
         logger.debug('Getting steps & collections')
         steps = self.run.plan.steps
+
+        # Once running, a recovered run keeps what it had left
+        allocate_missing = self.state == INITIALIZING
         collections = await gen.multi(
             [self._pool.request_instances(
                 self.run.uuid,
                 s.uuid,
-                count=s.instance_count,
-                inst_type=s.instance_type,
-                region=s.instance_region,
-                plan=self.run.plan.name,
-                owner=self.run.owner,
-                run_max_time=s.run_delay + s.run_max_time)
+                allocate_missing=allocate_missing,
+                **self._instance_options(s))
              for s in steps])
 
         try:
@@ -463,42 +707,28 @@ class RunManager:
         # just in case we're recovering
         await self._get_steps()
 
+        if self._recovering:
+            self._restore_steps()
+
         # Skip if we're running
-        if self.state == RUNNING:
+        if self.state != INITIALIZING:
+            if self._recovering:
+                await self._reattach()
             return
 
-        # Wait for the collections to come up
-        self.state_description = "Waiting for running instances."
-        await gen.multi([x.ec2_collection.wait_for_running()
-                         for x in self._set_links])
+        # Every step's collection goes through its own initialization
+        # pipeline, so that a slow collection doesn't hold up the others
+        self.state_description = "Initializing step collections"
+        for setlink in self._set_links:
+            future = gen.convert_yielded(self._initialize_step(setlink))
+            self._step_inits[setlink] = future
+            self._loop.add_future(future, partial(self._step_initialized,
+                                                  setlink))
 
-        # Setup docker on the collections
-        docker = self.helpers.docker
-        await gen.multi([docker.setup_collection(x.ec2_collection)
-                         for x in self._set_links])
-
-        # Wait for docker on all the collections to come up
-        self.state_description = "Waiting for docker"
-        await gen.multi([docker.wait(x.ec2_collection, timeout=360)
-                         for x in self._set_links])
-
-        # Pull the base containers we need (for heka)
-        self.state_description = "Pulling base container images"
-
-        for container in self.base_containers:
-            logger.debug("Pulling base container " + container.name)
-            await gen.multi(
-                [docker.load_containers(x.ec2_collection, container.name,
-                                        container.url)
-                 for x in self._set_links])
-
-        logger.debug("Pulling containers for this step.")
-        # Pull the appropriate containers for every collection
-        self.state_description = "Pulling step images"
-        await gen.multi(
-            [docker.load_containers(x.ec2_collection, x.step.container_name,
-                                    x.step.container_url)
-             for x in self._set_links])
+        # The run is running as soon as a collection is ready, the steps
+        # of the others start once their collection is ready as well
+        if self._step_inits:
+            await gen.WaitIterator(*self._step_inits.values()).next()
 
         self.state_description = ""
 
@@ -507,6 +737,157 @@ class RunManager:
         self._db_session.commit()
         log_threadid("Now running.")
 
+    async def _initialize_step(self, setlink):
+        """Initialize the collection of a step, up to the point where
+        the step can be started.
+
+        Every instance goes through its own pipeline, so an instance
+        that is slow to boot doesn't hold back the others. Once the
+        step's ``min_ready_fraction`` of instances are ready, the
+        remaining ones get ``straggler_grace`` seconds to catch up.
+        Instances that failed or didn't make it in time are terminated
+        in the background.
+
+        Raises a :exc:`LoadsException` when no instance is ready, or
+        fewer than an explicitly set ``min_ready_fraction``, which aborts
+        the run. Without one, the step waits for all its instances but
+        goes on with those that are ready.
+
+        """
+        collection = setlink.ec2_collection
+        step = setlink.step
+        images = self._step_images(step)
+
+        collection.debug("Initializing instances.")
+        instances = list(collection.instances)
+        quorum = _quorum(len(instances), step.min_ready_fraction)
+        grace = step.straggler_grace or 0
+
+        futures = [gen.convert_yielded(
+            _prepare_instance(self.helpers.docker, collection, x, images))
+            for x in instances]
+        waiter = gen.WaitIterator(*futures)
+        ready = []
+        deadline = None
+
+        while not waiter.done():
+            try:
+                if deadline is None:
+                    is_ready = await waiter.next()
+                else:
+                    is_ready = await gen.with_timeout(deadline, waiter.next())
+            except gen.TimeoutError:
+                break
+            except Exception:
+                logger.error("Error initializing instance.", exc_info=True)
+                is_ready = False
+
+            if is_ready:
+                ready.append(instances[waiter.current_index])
+
+            if deadline is None and len(ready) >= quorum:
+                if len(ready) < len(instances):
+                    collection.debug("%d/%d instances ready, waiting %ds "
+                                     "for the others." %
+                                     (len(ready), len(instances), grace))
+                deadline = self._loop.time() + grace
+
+        unready = [x for x in instances if x not in ready]
+        if unready:
+            collection.debug("Terminating %d instances that failed to "
+                             "initialize in time." % len(unready))
+            for inst in unready:
+                if inst.state.phase != "failed":
+                    inst.state.phase = "straggler"
+            self._in_background(collection.remove_instances(unready),
+                                "terminating unready instances")
+
+        if not ready or (step.min_ready_fraction is not None and
+                         len(ready) < quorum):
+            raise LoadsException("Only %d/%d instances of step %s are "
+                                 "ready." % (len(ready), len(instances),
+                                             step.uuid))
+        collection.debug("Ready")
+
+    def _in_background(self, awaitable, action):
+        """Run ``awaitable`` without waiting for it, logging its errors."""
+        future = gen.convert_yielded(awaitable)
+        self._loop.add_future(future, partial(self._background_done, action))
+        return future
+
+    def _background_done(self, action, future):
+        try:
+            future.result()
+        except Exception:
+            logger.error("Error %s for run %s.", action, self.run.uuid,
+                         exc_info=True)
+
+    def _step_images(self, step):
+        """Names and URLs of the images the instances of a step need."""
+        images = [(x.name, x.url) for x in self.base_containers]
+        images.append((step.container_name, step.container_url))
+        return images
+
+    def _step_initialized(self, setlink, future):
+        """Called when the initialization of a step's collection is done."""
+        try:
+            future.result()
+        except Exception:
+            logger.error("Error initializing step %s, aborting.",
+                         setlink.step.uuid, exc_info=True)
+            self.abort = True
+            return
+
+        # The step's start was deferred while its collection wasn't
+        # ready, so start it right away now
+        if setlink in self._deferred_starts:
+            self._deferred_starts.discard(setlink)
+            self._supervisor.schedule(self, datetime.utcnow(), START,
+                                      setlink)
+
+    def _step_ready(self, setlink):
+        """Indicates if the collection of a step is ready to start."""
+        future = self._step_inits.get(setlink)
+        if future is None:
+            return True
+        return future.done() and future.exception() is None
+
+    def _restore_steps(self):
+        """Restore the step state of a recovered run from the db."""
+        links = sorted(self._set_links,
+                       key=lambda x: (x.step_record.started_at is None,
+                                      x.step_record.started_at))
+        for setlink in links:
+            step_record = setlink.step_record
+            collection = setlink.ec2_collection
+            if not step_record.started_at:
+                continue
+
+            collection.started = True
+            collection.finished = bool(step_record.completed_at)
+            collection.local_dns = bool(self._dns_map)
+
+            if setlink.step.dns_name:
+                ips = [x.instance.ip_address for x in collection.instances]
+                self._dns_map[setlink.step.dns_name] = ips
+
+    async def _reattach(self):
+        """Re-attach docker to the instances of a run that was running.
+
+        Images were already loaded and containers started before the
+        broker restarted, so this only re-creates the docker clients and
+        prunes the instances that no longer respond.
+
+        """
+        self.state_description = "Re-attaching to docker"
+        docker = self.helpers.docker
+        await gen.multi([docker.setup_collection(x.ec2_collection)
+                         for x in self._set_links])
+        await gen.multi([docker.wait(x.ec2_collection, interval=5,
+                                     timeout=60)
+                         for x in self._set_links])
+        self.state_description = ""
+
     async def _shutdown(self):
         # If we aren't terminating, we shouldn't have been called
         if self.state != TERMINATING:
@@ -519,6 +900,15 @@ class RunManager:
         self._db_session.commit()
 
     async def _cleanup(self, exc=False):
+        # Steps still initializing keep working on their collections,
+        # let them finish before the collections are released
+        for future in list(self._step_inits.values()):
+            try:
+                await future
+            except Exception:
+                # Already logged by _step_initialized
+                pass
+
         if exc:
             # Ensure we try and shut them down
             logger.debug("Exception occurred, ensure containers terminated.",
@@ -529,9 +919,26 @@ class RunManager:
                 logger.error("Le sigh, error shutting down instances.",
                              exc_info=True)
 
+        # Replacements still being allocated land in the collections,
+        # wait for them so none are left out of the release
+        for future in list(self._replenishing.values()):
+            try:
+                await future
+            except Exception:
+                # Already logged by _replenished
+                pass
+
         # Ensure we always release the collections we used
         logger.debug("Returning collections")
 
+        try:
+            await gen.multi([
+                x.ec2_collection.execute(self.helpers.ssh.release,
+                                         x.ec2_collection)
+                for x in self._set_links])
+        except Exception:
+            logger.error("Error closing SSH connections.", exc_info=True)
+
         try:
             await gen.multi([self._pool.release_instances(x.ec2_collection)
                              for x in self._set_links])
@@ -539,6 +946,8 @@ class RunManager:
             logger.error("Embarassing, error returning instances.",
                          exc_info=True)
 
+        logger.debug("Run %s made %d EC2 API calls.", self.run.uuid,
+                     self._pool.api_calls.pop(self.run.uuid, 0))
         self._set_links = []
 
     async def _run(self):
@@ -546,66 +955,93 @@ class RunManager:
         if self.state != RUNNING:
             return
 
-        # Main run loop
-        while True:
-            if self.abort:
-                logger.debug("Aborted, exiting run loop.")
-                break
-
-            stop = await self._check_steps()
-            if stop:
-                break
-
-            # Now we sleep for a bit
-            await gen.Task(self._loop.add_timeout, time.time() +
-                           self.sleep_time)
+        # Hand the steps over to the supervisor until they're all done,
+        # or we're aborted
+        await self._supervisor.supervise(self)
+        if self.abort:
+            logger.debug("Aborted, exiting run loop.")
 
         # We're done running, time to terminate
         self.run.state = TERMINATING
         self.run.completed_at = datetime.utcnow()
         self._db_session.commit()
 
-    async def _check_steps(self):
-        """Checks steps for the plan to see if any existing steps
-        have finished, or new ones need to start.
+    def _steps_complete(self):
+        """Indicates if all the steps were started and have finished."""
+        return all(x.ec2_collection.started and x.ec2_collection.finished
+                   for x in self._set_links)
 
-        When all the steps have run and completed, returns False
-        to indicate nothing remains for the plan.
+    def _schedule_step(self, setlink):
+        """Arm the deadlines for the next transition of a step."""
+        step_record = setlink.step_record
+        supervisor = self._supervisor
 
-        """
-        # Bools of collections that were started/finished
-        started = [x.ec2_collection.started for x in self._set_links]
-        finished = [x.ec2_collection.finished for x in self._set_links]
+        if step_record.completed_at or setlink.ec2_collection.finished:
+            return
 
-        # If all steps were started and finished, the run is complete.
-        if all(started) and all(finished):
-            return True
+        if not step_record.started_at:
+            delay = timedelta(seconds=setlink.step.run_delay)
+            supervisor.schedule(self, self.run.started_at + delay, START,
+                                setlink)
+            return
+
+        stop = self._stop_time(setlink)
+        supervisor.schedule(self, stop, STOP, setlink)
+        supervisor.schedule_check(self, setlink, self.exit_check_interval,
+                                  stop)
+
+    def _stop_time(self, setlink):
+        """UTC datetime a started step stops at, past its max run time."""
+        max_time = timedelta(seconds=setlink.step.run_max_time)
+        return setlink.step_record.started_at + max_time
 
-        # Locate all steps that have completed
-        dones = await gen.multi([self._is_done(x) for x in self._set_links])
-        dones = zip(dones, self._set_links)
+    async def _process_deadlines(self, due):
+        """Act on the deadlines that have passed.
+
+        Steps past their max run time, or whose containers have all
+        exited, are stopped. Steps past their run delay are started.
+
+        """
+        stops = {x.setlink for x in due if x.action == STOP}
+        checks = {x.setlink for x in due
+                  if x.action == CHECK and x.setlink not in stops}
+        starts = {x.setlink for x in due if x.action == START and
+                  not x.setlink.ec2_collection.started}
+        supervisor = self._supervisor
+
+        # Steps whose collection isn't ready yet start once it is
+        for setlink in [x for x in starts if not self._step_ready(x)]:
+            setlink.ec2_collection.debug("Not ready, deferring start.")
+            self._deferred_starts.add(setlink)
+            starts.discard(setlink)
+
+        # Locate the checked steps that have completed
+        checks = list(checks)
+        dones = await gen.multi([self._is_done(x) for x in checks])
+        for done, setlink in zip(dones, checks):
+            if done:
+                stops.add(setlink)
+            else:
+                supervisor.schedule_check(self, setlink,
+                                          self.exit_check_interval,
+                                          self._stop_time(setlink))
 
         # Send shutdown to steps that have completed, we can shut them all
         # down in any order so we run in parallel
         async def shutdown(setlink):
+            supervisor.scheduler.cancel_step(setlink)
             try:
                 await self._stop_step(setlink)
             except:
                 logger.error("Exception in shutdown.", exc_info=True)
 
             setlink.step_record.completed_at = datetime.utcnow()
-            self._db_session.commit()
-        await gen.multi([shutdown(s) for done, s in dones if done])
-
-        # Start steps that should be started, ordered by delay
-        starts = list(filter(self._should_start, self._set_links))
-        starts.sort(key=lambda x: x.step.run_delay)
+            supervisor.mark_dirty(self._db_session)
+        await gen.multi([shutdown(s) for s in stops])
 
         # Start steps in order of lowest delay first, to ensure that steps
         # started afterwards can use DNS names/etc from prior steps
-        for setlink in starts:
-            # We tag the collection here since this may not actually run
-            # until another time through this loop due to async nature
+        for setlink in sorted(starts, key=lambda x: x.step.run_delay):
             setlink.ec2_collection.local_dns = bool(self._dns_map)
 
             try:
@@ -615,7 +1051,7 @@ class RunManager:
                 setlink.step_record.failed = True
 
             setlink.step_record.started_at = datetime.utcnow()
-            self._db_session.commit()
+            supervisor.mark_dirty(self._db_session)
 
             # If this collection reg's a dns name, add this collections
             # ip's to the name
@@ -623,37 +1059,51 @@ class RunManager:
                 ips = [x.instance.ip_address for x
                        in setlink.ec2_collection.instances]
                 self._dns_map[setlink.step.dns_name] = ips
-        return False
-
-    async def _start_step(self, setlink):
-        setlink.ec2_collection.started = True
-
-        # Reload sysctl because coreos doesn't reload this right
-        await self.helpers.ssh.reload_sysctl(setlink.ec2_collection)
 
-        # Start Watcher
-        await self.helpers.watcher.start(setlink.ec2_collection,
-                                         self.helpers.docker)
+            # Arm the stop and exit check deadlines for the step
+            self._schedule_step(setlink)
 
-        # Start heka
-        await self.helpers.heka.start(setlink.ec2_collection,
-                                      self.helpers.docker,
-                                      self.helpers.ping,
-                                      "db"+self.run.uuid.replace('-', ''),
-                                      series=setlink.step.docker_series)
+    async def _start_step(self, setlink, collection=None):
+        """Start a step, or only some of its instances given as a
+        ``collection``."""
+        setlink.ec2_collection.started = True
+        collection = collection or setlink.ec2_collection
+
+        helpers = self.helpers
+        database_name = "db"+self.run.uuid.replace('-', '')
+        series = setlink.step.docker_series
+
+        # Reload sysctl because coreos doesn't reload this right, and
+        # upload the heka configs, in a single session per instance.
+        # sysctl fails on keys the kernel doesn't know, which is harmless
+        def provision_script(inst):
+            script = ProvisionScript()
+            script.run("reload sysctl", SYSCTL_RELOAD)
+            helpers.heka.provision(script, inst, database_name,
+                                   series=series)
+            return script
+        await helpers.ssh.provision(collection, provision_script,
+                                    optional=("reload sysctl",))
+
+        # Start Watcher and heka, which are independent
+        await gen.multi([
+            helpers.watcher.start(collection, helpers.docker),
+            helpers.heka.start(collection, helpers.docker, helpers.ping,
+                               database_name, series=series, upload=False)
+        ])
 
         # Startup local DNS if needed
-        if setlink.ec2_collection.local_dns:
+        if collection.local_dns:
             logger.debug("Starting up DNS")
-            await self.helpers.dns.start(setlink.ec2_collection, self._dns_map)
+            await helpers.dns.start(collection, self._dns_map)
 
         # Startup the testers
         env = self.run_env.copy()
         env.update(setlink.step.environment_data)
         env['CONTAINER_ID'] = setlink.step.uuid
-        logger.debug("Starting step: %s", setlink.ec2_collection.uuid)
+        logger.debug("Starting step: %s", collection.uuid)
         await self.helpers.docker.run_containers(
-            setlink.ec2_collection,
+            collection,
             setlink.step.container_name,
             setlink.step.additional_command_args,
             env=env,
@@ -686,7 +1136,8 @@ class RunManager:
             await self.helpers.dns.stop(setlink.ec2_collection)
 
         # Remove anyone that failed to shutdown properly
-        gen.convert_yielded(setlink.ec2_collection.remove_dead_instances())
+        self._in_background(setlink.ec2_collection.remove_dead_instances(),
+                            "removing dead instances")
 
     async def _is_done(self, setlink):
         """Given a StepRecordLink, determine if the collection has
@@ -718,10 +1169,73 @@ class RunManager:
 
         # Remove instances that stopped responding
         await setlink.ec2_collection.remove_dead_instances()
+        if setlink.step.maintain_count:
+            self._maintain_count(setlink)
 
         # Otherwise return whether we should be stopped
         return setlink.step_record.should_stop()
 
+    def _maintain_count(self, setlink):
+        """Replace the dead instances of a step in the background."""
+        if setlink in self._replenishing:
+            return
+
+        future = gen.convert_yielded(self._replenish(setlink))
+        self._replenishing[setlink] = future
+        self._loop.add_future(future, partial(self._replenished, setlink))
+
+    def _replenished(self, setlink, future):
+        del self._replenishing[setlink]
+        try:
+            future.result()
+        except Exception:
+            logger.error("Error replacing the dead instances of step %s.",
+                         setlink.step.uuid, exc_info=True)
+
+    async def _replenish(self, setlink):
+        """Allocate instances replacing the dead ones of a step, bring
+        them up, and start the step on them."""
+        collection = setlink.ec2_collection
+        step = setlink.step
+        added = await self._pool.replenish(collection,
+                                           **self._instance_options(step))
+        if not added:
+            return
+
+        # The step stopped while they were allocated, nobody would
+        # start or release them
+        if collection.finished:
+            await collection.remove_instances(added)
+            return
+
+        collection.debug("Replacing %d dead instances." % len(added))
+        images = self._step_images(step)
+
+        async def prepare(ec2_instance):
+            try:
+                return await _prepare_instance(self.helpers.docker,
+                                               collection, ec2_instance,
+                                               images)
+            except Exception:
+                logger.error("Error initializing instance.", exc_info=True)
+                return False
+
+        ready = await gen.multi([prepare(x) for x in added])
+        failed = [x for x, is_ready in zip(added, ready)
+                  if not is_ready and x in collection.instances]
+        if failed:
+            self._in_background(collection.remove_instances(failed),
+                                "terminating failed replacements")
+
+        replacements = [x for x, is_ready in zip(added, ready) if is_ready]
+        if not replacements or collection.finished:
+            return
+
+        await self._start_step(setlink, collection.subset(replacements))
+        if step.dns_name:
+            self._dns_map[step.dns_name] = [x.instance.ip_address
+                                            for x in collection.instances]
+
     def _instance_debug_info(self, setlink):
         """Return a dict of information describing a link's instances"""
         infos = {}
@@ -752,7 +1266,3 @@ class RunManager:
 
             info['docker_ps'] = ps
         return infos
-
-    def _should_start(self, setlink):
-        """Given a StepRecordLink, determine if the step should be started."""
-        return setlink.step_record.should_start()
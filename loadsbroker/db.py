@@ -12,6 +12,7 @@ from sqlalchemy import (
     Column,
     DateTime,
     Enum,
+    Float,
     Integer,
     String,
     ForeignKey,
@@ -21,11 +22,14 @@ from sqlalchemy.orm import (
     sessionmaker,
     relationship,
     subqueryload,
+    validates,
 )
 from sqlalchemy.pool import StaticPool
 from sqlalchemy.types import TypeDecorator
 
 from loadsbroker import logger
+from loadsbroker.aws import ALLOCATION_STRATEGIES
+from loadsbroker.aws import AWS_REGIONS as EC2_REGIONS
 from loadsbroker.exceptions import LoadsException
 
 
@@ -91,6 +95,17 @@ TERMINATING = 2
 COMPLETED = 3
 
 
+def check_weights(name, weights):
+    """Raises a :exc:`LoadsException` unless ``weights`` maps at least
+    one key to a non-negative number, with a positive total."""
+    if not weights or not hasattr(weights, "values"):
+        raise LoadsException("%s needs at least one weight." % name)
+    values = list(weights.values())
+    if not all(isinstance(x, (int, float)) and not isinstance(x, bool) and
+               x >= 0 for x in values) or sum(values) <= 0:
+        raise LoadsException("Invalid %s weights: %s" % (name, weights))
+
+
 def status_to_text(status):
     """Converts status states to an output-friendly format"""
     if status == INITIALIZING:
@@ -208,10 +223,26 @@ class Step(Base):
     instance_region = Column(Enum(name="InstanceRegion", *AWS_REGIONS),
                              default='us-west-2',
                              doc="Region to spin up instances")
+    instance_distribution = Column(
+        JSONEncodedDict, nullable=True,
+        doc="Regions or availability zones to spread the instances over, "
+            "mapped to their weight. Overrides `instance_region`.")
     instance_type = Column(String, default='t1.micro',
                            doc="Type of instance to use")
     instance_count = Column(Integer, default=1,
                             doc="How many instances to spin up")
+    instance_fallbacks = Column(
+        JSONEncodedDict, nullable=True,
+        doc="Instance types to use when `instance_type` runs out of "
+            "capacity, mapped to how many `instance_type` instances one of "
+            "them is worth")
+    allocation = Column(Enum(name="AllocationStrategy",
+                             *ALLOCATION_STRATEGIES),
+                        default="on-demand",
+                        doc="How instances are allocated: on-demand, spot, "
+                            "or spot with an on-demand fallback")
+    spot_price = Column(Float, nullable=True,
+                        doc="Maximum hourly price of spot instances")
 
     # Test container run data
     container_name = Column(String, doc="Docker container name/tag to use, "
@@ -257,24 +288,85 @@ class Step(Base):
         default=0,
         doc="Delay between launching each instance in this step"
     )
+    maintain_count = Column(
+        Boolean,
+        default=False,
+        doc="Whether dead instances should be replaced while the step "
+            "runs."
+    )
+
+    # Readiness policy
+    min_ready_fraction = Column(
+        Float,
+        nullable=True,
+        doc="Fraction of the instances that need to be ready before the "
+            "step can start. Without one, all the instances are waited "
+            "for, the step starting on those that are ready."
+    )
+    straggler_grace = Column(
+        Integer,
+        default=60,
+        doc="How long to wait for the remaining instances once enough of "
+            "them are ready, in seconds. The stragglers are terminated."
+    )
 
     step_records = relationship("StepRecord", backref="step")
 
     plan_id = Column(Integer, ForeignKey("plan.id"))
 
+    @validates("instance_distribution")
+    def validate_distribution(self, key, distribution):
+        if distribution is not None:
+            check_weights(key, distribution)
+            # Only the regions the pool allocates from
+            unknown = [x for x in distribution if x not in EC2_REGIONS and
+                       x[:-1] not in EC2_REGIONS]
+            if unknown:
+                raise LoadsException("Unknown regions in %s: %s" %
+                                     (key, ", ".join(unknown)))
+        return distribution
+
+    @validates("instance_fallbacks")
+    def validate_fallbacks(self, key, fallbacks):
+        # Capacities are divided by the weights of the fallback types
+        if fallbacks:
+            check_weights(key, fallbacks)
+            if not all(fallbacks.values()):
+                raise LoadsException("Invalid %s weights: %s" %
+                                     (key, fallbacks))
+        return fallbacks
+
+    @validates("allocation")
+    def validate_allocation(self, key, allocation):
+        if allocation is not None and \
+                allocation not in ALLOCATION_STRATEGIES:
+            raise LoadsException("Unknown %s: %s" % (key, allocation))
+        return allocation
+
+    def check_spot_price(self):
+        """Raises a :exc:`LoadsException` when spot instances are
+        allocated without a price to bid."""
+        if self.allocation not in (None, "on-demand") and \
+                self.spot_price is None:
+            raise LoadsException("Spot instances need a spot price.")
+
     @classmethod
     def from_json(cls, **json):
         env_data = json.get("environment_data")
         if env_data and isinstance(env_data, list):
             json["environment_data"] = dict(
                 line.split('=', 1) for line in env_data)
-        return cls(**json)
+        step = cls(**json)
+        # Depends on two columns, checked once both are set
+        step.check_spot_price()
+        return step
 
     def json(self, fields=None):
         return {'uuid': self.uuid, 'name': self.name,
                 'run_delay': self.run_delay,
                 'run_max_time': self.run_max_time,
                 'instance_region': self.instance_region,
+                'instance_distribution': self.instance_distribution,
                 'instance_type': self.instance_type,
                 'container_name': self.container_name,
                 'container_url': self.container_url,
@@ -286,8 +378,14 @@ class Step(Base):
                 'docker_series': self.docker_series,
                 'prune_running': self.prune_running,
                 'node_delay': self.node_delay,
+                'maintain_count': self.maintain_count,
+                'min_ready_fraction': self.min_ready_fraction,
+                'straggler_grace': self.straggler_grace,
                 'plan_id': self.plan_id,
                 'instance_count': self.instance_count,
+                'instance_fallbacks': self.instance_fallbacks,
+                'allocation': self.allocation,
+                'spot_price': self.spot_price,
                 'step_records': [rec.json(fields)
                                  for rec in self.step_records]}
 
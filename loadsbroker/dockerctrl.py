@@ -1,5 +1,10 @@
 """ Interacts with a Docker Daemon on a remote instance"""
+import hashlib
 import random
+import re
+import shlex
+import urllib.request
+from collections import namedtuple
 from typing import (
     Any,
     Dict,
@@ -26,6 +31,159 @@ def split_container_name(container_name):
         return parts, None
 
 
+# Where the digests of the image tarballs imported are recorded on the
+# instances, to skip importing them again
+IMAGE_DIGESTS = "/home/core/.loads/images"
+
+# Seconds between the progress reports of an image download
+PROGRESS_INTERVAL = 2
+
+# Lines of the image loading commands reporting their progress and
+# outcome, followed by the image name and the bytes downloaded or status
+PROGRESS_LINE = "LOADS_PROGRESS"
+DONE_LINE = "LOADS_DONE"
+
+# Statuses of the images loaded, or found already loaded
+LOADED = "loaded"
+SKIPPED = "skipped"
+
+ImageInfo = namedtuple("ImageInfo", "digest size")
+
+_IMPORT_SCRIPT = """\
+name=%(name)s url=%(url)s digest=%(digest)s md5=%(md5)s marker=%(marker)s
+if [ -n "$digest" ] && [ "$(cat "$marker" 2> /dev/null)" = "$digest" ] \\
+    && docker inspect "$name" > /dev/null 2>&1; then
+  echo "%(done)s $name %(skipped)s"; exit 0
+fi
+dir=$(mktemp -d) || exit 1
+mkfifo "$dir/tarball" || exit 1
+trap 'kill $reporter 2> /dev/null; rm -rf "$dir"' EXIT
+bytes() {
+  tr '\\r' '\\n' < "$dir/copied" 2> /dev/null | tail -n 1 | cut -d ' ' -f 1
+}
+# sleep doesn't hold the output open once the reporter is killed
+while sleep %(interval)d > /dev/null; do
+  echo "%(progress)s $name $(bytes)"
+done &
+reporter=$!
+md5sum < "$dir/tarball" | cut -d ' ' -f 1 > "$dir/md5" &
+summer=$!
+{ curl -fsSL "$url"; echo $? > "$dir/curl"; } \\
+    | dd bs=1M status=progress 2> "$dir/copied" \\
+    | tee "$dir/tarball" | docker load
+loaded=$?
+wait $summer
+kill $reporter 2> /dev/null
+echo "%(progress)s $name $(bytes)"
+# curl exits with 23 when docker load stopped reading
+case "$(cat "$dir/curl")" in
+  0|23) ;;
+  *) echo "%(done)s $name download failed"; exit 1 ;;
+esac
+if [ $loaded != 0 ]; then echo "%(done)s $name load failed"; exit 1; fi
+if [ -n "$md5" ] && [ "$(cat "$dir/md5")" != "$md5" ]; then
+  docker rmi "$name" > /dev/null 2>&1
+  echo "%(done)s $name digest mismatch"; exit 1
+fi
+if ! docker inspect "$name" > /dev/null 2>&1; then
+  echo "%(done)s $name image missing"; exit 1
+fi
+if [ -n "$digest" ]; then
+  mkdir -p "$(dirname "$marker")" && echo "$digest" > "$marker"
+fi
+echo "%(done)s $name %(loaded)s"
+"""
+
+_PULL_SCRIPT = """\
+name=%(name)s
+if docker pull "$name"; then
+  echo "%(done)s $name %(loaded)s"
+else
+  echo "%(done)s $name pull failed"; exit 1
+fi
+"""
+
+
+def image_info(container_url, timeout=10):
+    """Fetches the digest and size the server of an image tarball
+    advertises, with a ``HEAD`` request.
+
+    The digest is the ETag of the tarball. Either is ``None`` when the
+    server doesn't send it, or can't be reached.
+
+    """
+    request = urllib.request.Request(container_url, method="HEAD")
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            headers = response.headers
+    except (OSError, ValueError):
+        return ImageInfo(None, None)
+
+    digest = headers.get("ETag")
+    size = headers.get("Content-Length")
+    return ImageInfo(digest.strip('"') if digest else None,
+                     int(size) if size and size.isdigit() else None)
+
+
+def import_command(container_name, container_url, digest=None):
+    """Builds a shell command importing an image tarball.
+
+    The tarball is streamed into ``docker load`` as it downloads,
+    reporting the bytes downloaded every :data:`PROGRESS_INTERVAL`
+    seconds. Its MD5 is computed on the way, and checked against the
+    digest if that's an MD5, as are the ETags of files uploaded in one
+    part to S3: the image is removed should they differ. The import
+    then succeeds if curl and ``docker load`` exited cleanly and docker
+    has an image of that name; the image ID itself isn't checked, no
+    digest of it being advertised.
+
+    Once loaded, the digest is recorded on the instance and the import
+    is skipped while the image and the digest remain the same.
+
+    """
+    digest = digest or ""
+    marker = "%s/%s" % (
+        IMAGE_DIGESTS,
+        hashlib.sha1(container_url.encode("utf-8")).hexdigest())
+    md5 = digest if re.match("^[0-9a-f]{32}$", digest) else ""
+    return _IMPORT_SCRIPT % dict(
+        name=shlex.quote(container_name), url=shlex.quote(container_url),
+        digest=shlex.quote(digest), md5=md5, marker=marker,
+        interval=PROGRESS_INTERVAL, progress=PROGRESS_LINE, done=DONE_LINE,
+        loaded=LOADED, skipped=SKIPPED)
+
+
+def pull_command(container_name):
+    """Builds a shell command pulling an image."""
+    return _PULL_SCRIPT % dict(name=shlex.quote(container_name),
+                               done=DONE_LINE, loaded=LOADED)
+
+
+def load_images_command(images, concurrency=4, digests=None):
+    """Builds a shell command loading several images at once.
+
+    Images with an URL are imported per :func:`import_command`, the
+    others are pulled. Up to ``concurrency`` of them are fetched at the
+    same time.
+
+    :param images: List of ``(container_name, container_url)`` tuples.
+    :param digests: Digests of the image tarballs, keyed by URL.
+
+    """
+    digests = digests or {}
+    commands = []
+    for container_name, container_url in images:
+        if container_url:
+            cmd = import_command(container_name, container_url,
+                                 digests.get(container_url))
+        else:
+            cmd = pull_command(container_name)
+        commands.append(shlex.quote(cmd))
+
+    return "printf '%%s\\0' %s | xargs -0 -n 1 -P %d sh -c" % (
+        " ".join(commands), max(concurrency, 1))
+
+
 class DockerDaemon:
 
     def __init__(self, host, timeout=5):
@@ -80,16 +238,78 @@ class DockerDaemon:
         result = self._client.pull(container_name, stream=True)
         return list(result)
 
-    def import_container(self, client, container_url):
-        """Imports a container from a URL"""
-        stdin, stdout, stderr = client.exec_command(
-            'curl %s | docker load' % container_url)
-        # Wait for termination
-        output = stdout.channel.recv(4096)
-        stdin.close()
-        stdout.close()
-        stderr.close()
-        return output
+    @staticmethod
+    def _run_loads(client, command, images, progress=None):
+        """Runs an image loading command over SSH, streaming its output.
+
+        :param progress: Function called with the name of an image and
+                         the bytes of its tarball downloaded so far.
+        :returns: The status of the images keyed by name, and the rest of
+                  the output.
+
+        """
+        channel = client.get_transport().open_session()
+        try:
+            channel.set_combine_stderr(True)
+            channel.exec_command(command)
+            results = {}
+            output = []
+            for line in channel.makefile("r"):
+                kind, _, rest = line.rstrip("\n").partition(" ")
+                name, _, value = rest.partition(" ")
+                if kind == PROGRESS_LINE and value.isdigit():
+                    if progress:
+                        progress(name, int(value))
+                elif kind == DONE_LINE:
+                    results[name] = value
+                else:
+                    output.append(line)
+            status = channel.recv_exit_status()
+        finally:
+            channel.close()
+
+        for container_name, _ in images:
+            results.setdefault(container_name,
+                               "exited with status %d" % status)
+        return results, "".join(output)
+
+    def import_container(self, client, container_name, container_url,
+                         digest=None, progress=None):
+        """Imports a container from a URL, per
+        :func:`import_command`.
+
+        :returns: The status of the import and the output of the command.
+
+        """
+        images = [(container_name, container_url)]
+        results, output = self._run_loads(
+            client, import_command(container_name, container_url, digest),
+            images, progress)
+        return results[container_name], output
+
+    def load_images(self, client, images, concurrency=4, digests=None,
+                    progress=None):
+        """Imports or pulls several images in a single SSH command,
+        fetching up to ``concurrency`` of them at the same time.
+
+        :param images: List of ``(container_name, container_url)`` tuples.
+        :param digests: Digests of the image tarballs, keyed by URL.
+        :returns: The status of the images keyed by name, either
+                  :data:`LOADED`, :data:`SKIPPED` or the failure, and the
+                  output of the command.
+
+        """
+        return self._run_loads(
+            client, load_images_command(images, concurrency, digests),
+            images, progress)
+
+    @retry(on_exception=lambda exc: isinstance(exc, DOCKER_RETRY_EXC))
+    def get_images(self):
+        """Returns the ids of the images loaded, keyed by their
+        name/tag."""
+        return {tag: image["Id"]
+                for image in self._client.images()
+                for tag in image.get("RepoTags") or []}
 
     @retry(on_exception=lambda exc: isinstance(exc, DOCKER_RETRY_EXC))
     def has_image(self, container_name):
@@ -0,0 +1,126 @@
+"""Blocking I/O Executor
+
+Talking to EC2, to docker and over SSH is done with blocking calls,
+run in threads. Rather than each collection having its own thread pool
+sized after its instances, the broker has a bounded
+:class:`FairExecutor` for each kind of work: EC2 API calls, SSH and
+docker sessions, and image cache downloads. Quick API calls never
+queue behind image transfers taking minutes.
+
+Work is queued per group (a run) and per client (a step's collection)
+within the group, and the threads serve the groups in turn, then the
+clients of a group in turn. A large step can't starve the others, and
+neither can a run with many steps.
+
+"""
+import concurrent.futures
+import threading
+from collections import deque, OrderedDict
+
+
+class FairExecutor:
+    """Bounded thread pool serving its queues in round-robin.
+
+    Futures returned by :meth:`submit` are standard
+    :class:`concurrent.futures.Future` instances.
+
+    """
+    def __init__(self, max_workers=32):
+        self.max_workers = max_workers
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self._lock = threading.Lock()
+        # group -> client -> queue of work items
+        self._groups = OrderedDict()
+        self._active = 0
+        self._queued = 0
+        self._completed = 0
+        self._shutdown = False
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Queue a blocking call.
+
+        :param key: ``(group, client)`` tuple the call is made for.
+        :returns: Future of the call's result.
+
+        """
+        group, client = key
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit after shutdown.")
+            clients = self._groups.setdefault(group, OrderedDict())
+            clients.setdefault(client, deque()).append(
+                (future, fn, args, kwargs))
+            self._queued += 1
+            self._dispatch()
+        return future
+
+    def _next(self):
+        """Pop the next work item, rotating groups and clients."""
+        group, clients = next(iter(self._groups.items()))
+        client, queue = next(iter(clients.items()))
+        item = queue.popleft()
+
+        if queue:
+            clients.move_to_end(client)
+        else:
+            del clients[client]
+
+        if clients:
+            self._groups.move_to_end(group)
+        else:
+            del self._groups[group]
+
+        self._queued -= 1
+        return item
+
+    def _dispatch(self):
+        # Called with the lock held
+        while self._groups and self._active < self.max_workers:
+            self._active += 1
+            self._pool.submit(self._work, self._next())
+
+    def _work(self, item):
+        future, fn, args, kwargs = item
+        outcome = None
+        if future.set_running_or_notify_cancel():
+            try:
+                outcome = (future.set_result, fn(*args, **kwargs))
+            except BaseException as exc:
+                outcome = (future.set_exception, exc)
+
+        # Account for the work before its future resolves
+        with self._lock:
+            self._active -= 1
+            self._completed += 1
+            if not self._shutdown:
+                self._dispatch()
+
+        if outcome:
+            resolve, value = outcome
+            resolve(value)
+
+    def stats(self):
+        """Instrumentation of the work being done and waiting."""
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "active": self._active,
+                "queued": self._queued,
+                "completed": self._completed,
+                "groups": len(self._groups),
+                "clients": sum(len(x) for x in self._groups.values()),
+            }
+
+    def shutdown(self, wait=True):
+        """Cancel the queued work and stop the threads."""
+        with self._lock:
+            self._shutdown = True
+            groups, self._groups = self._groups, OrderedDict()
+            self._queued = 0
+
+        for clients in groups.values():
+            for queue in clients.values():
+                for future, _, _, _ in queue:
+                    future.cancel()
+        self._pool.shutdown(wait)
@@ -7,24 +7,40 @@ the AWS instances as needed to retain their information.
 
 """
 import os
+import socket
+import threading
 import time
 from io import StringIO
 from random import randint
 from string import Template
 from typing import Dict, Optional
-from collections import namedtuple
+from collections import defaultdict, namedtuple
 
 import paramiko.client as sshclient
+from paramiko.ssh_exception import SSHException
 import tornado.ioloop
 from tornado import gen
 from tornado.httpclient import AsyncHTTPClient
 
 from loadsbroker import logger
 from loadsbroker.aws import EC2Collection
-from loadsbroker.dockerctrl import DOCKER_RETRY_EXC, DockerDaemon
+from loadsbroker.dockerctrl import (
+    DOCKER_RETRY_EXC,
+    LOADED,
+    SKIPPED,
+    DockerDaemon,
+    image_info,
+)
+from loadsbroker.exceptions import LoadsException
 from loadsbroker.ssh import makedirs
 from loadsbroker.util import join_host_port, retry
 
+# Failures of a pooled SSH connection, retried on a new one
+SSH_RETRY_EXC = (SSHException, EOFError, socket.error)
+
+# Reloads sysctl settings, as coreos doesn't apply them all on boot
+SYSCTL_RELOAD = "sudo sysctl -p /etc/sysctl.conf"
+
 # Default ping request options.
 _PING_DEFAULTS = {
     "method": "HEAD",
@@ -47,6 +63,9 @@ HEKA_NOINFLUX_PATH = os.path.join(os.path.dirname(__file__), "heka",
 with open(HEKA_NOINFLUX_PATH, "r") as f:
     HEKA_NOINFLUX_TEMPLATE = Template(f.read())
 
+# Where the Heka configuration is uploaded on the instances
+HEKA_CONFIG_REMOTE = "/home/core/heka/config.toml"
+
 
 class Ping:
     """Basic ping extension that fetches a HTTP URL to verify it
@@ -79,10 +98,33 @@ class Ping:
                     raise
 
 
+@retry(on_result=lambda res: not res)
+def _image_loaded(docker, container_name):
+    return docker.has_image(container_name)
+
+
 class SSH:
-    """SSH client to communicate with instances."""
-    def __init__(self, ssh_keyfile):
+    """SSH client to communicate with instances.
+
+    Connections are pooled per instance and kept alive, so the
+    extensions share a single transport to an instance rather than
+    paying a key exchange for every command. A pooled connection is
+    checked before use and reopened once it stopped responding;
+    :meth:`release` closes the connections of a collection's instances
+    once it's returned.
+
+    :param keepalive: Interval in seconds of the keep-alive packets
+                      sent over idle connections.
+
+    """
+    def __init__(self, ssh_keyfile, keepalive=30):
         self._ssh_keyfile = ssh_keyfile
+        self.keepalive = keepalive
+        # instance id -> SSHClient
+        self._clients = {}
+        # instance id -> lock held while (re)connecting
+        self._locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
 
     def connect(self, instance):
         """Opens an SSH connection to this instance."""
@@ -90,8 +132,71 @@ class SSH:
         client.set_missing_host_key_policy(sshclient.AutoAddPolicy())
         client.connect(instance.ip_address, username="core",
                        key_filename=self._ssh_keyfile)
+        client.get_transport().set_keepalive(self.keepalive)
         return client
 
+    @staticmethod
+    def _healthy(client):
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        return True
+
+    def client(self, instance):
+        """Returns the pooled connection to this instance, opening it if
+        there is none or it's no longer healthy. Blocks."""
+        with self._lock:
+            lock = self._locks[instance.id]
+
+        with lock:
+            client = self._clients.get(instance.id)
+            if client is not None and self._healthy(client):
+                return client
+            if client is not None:
+                logger.debug("Reconnecting to %s", instance.id)
+                client.close()
+            client = self._clients[instance.id] = self.connect(instance)
+            return client
+
+    def _close(self, instance_id):
+        with self._lock:
+            self._locks.pop(instance_id, None)
+            client = self._clients.pop(instance_id, None)
+        if client is not None:
+            client.close()
+
+    def discard(self, instance):
+        """Closes the pooled connection to this instance, if any."""
+        self._close(instance.id)
+
+    def execute(self, instance, func, *args, **kwargs):
+        """Calls ``func`` with the pooled connection to this instance,
+        then with a new connection if the pooled one failed. Blocks."""
+        client = self.client(instance)
+        try:
+            return func(client, *args, **kwargs)
+        except SSH_RETRY_EXC:
+            logger.debug("SSH connection to %s failed, retrying",
+                         instance.id, exc_info=True)
+            self.discard(instance)
+            return func(self.client(instance), *args, **kwargs)
+
+    def release(self, collection):
+        """Closes the connections to the instances of a collection, and
+        those of the instances removed from it that are gone."""
+        for inst in collection.instances:
+            self.discard(inst.instance)
+
+        with self._lock:
+            dead = [x for x, client in self._clients.items()
+                    if not self._healthy(client)]
+        for instance_id in dead:
+            self._close(instance_id)
+
     def _send_file(self, sftp, local_obj, remote_file):
         # Ensure the base directory for the remote file exists
         base_dir = os.path.dirname(remote_file)
@@ -102,54 +207,190 @@ class SSH:
 
     def upload_file(self, instance, local_obj, remote_file):
         """Upload a file to an instance. Blocks."""
-        client = self.connect(instance)
-        try:
+        def _upload(client):
+            local_obj.seek(0)
             sftp = client.open_sftp()
             try:
                 self._send_file(sftp, local_obj, remote_file)
             finally:
                 sftp.close()
-        finally:
-            client.close()
+        self.execute(instance, _upload)
 
-    async def reload_sysctl(self, collection):
-        def _reload(inst):
-            client = self.connect(inst.instance)
-            try:
-                stdin, stdout, stderr = client.exec_command(
-                    "sudo sysctl -p /etc/sysctl.conf")
-                output = stdout.channel.recv(4096)
-                stdin.close()
-                stdout.close()
-                stderr.close()
-                return output
-            finally:
-                client.close()
-        await collection.map(_reload)
+    def run_script(self, instance, script):
+        """Runs a :class:`~loadsbroker.ssh.ProvisionScript` on an
+        instance. Blocks.
+
+        :returns: List of the :class:`~loadsbroker.ssh.StepResult` of
+                  the script's steps.
+
+        """
+        def _run(client):
+            stdin, stdout, stderr = client.exec_command("sh -s")
+            stdin.write(script.render())
+            stdin.channel.shutdown_write()
+            output = stdout.read()
+            stdin.close()
+            stdout.close()
+            stderr.close()
+            return output
+        return script.results(self.execute(instance, _run))
+
+    async def provision(self, collection, build, optional=()):
+        """Runs a provision script on every instance of a collection,
+        one session per instance.
+
+        :param build: Function returning the
+                      :class:`~loadsbroker.ssh.ProvisionScript` of an
+                      :class:`~loadsbroker.aws.EC2Instance`.
+        :param optional: Names of the steps whose failure is only logged.
+        :returns: The results of the scripts, in the order of the
+                  collection's instances.
+        :raises LoadsException: When a step that isn't optional failed,
+                                or didn't run to completion, on any
+                                instance.
+
+        """
+        failed = []
+
+        def _provision(inst):
+            script = build(inst)
+            if not script:
+                return []
+            results = self.run_script(inst.instance, script)
+            for result in results:
+                if result.status == 0:
+                    continue
+                if result.name in optional:
+                    logger.debug("[%s] %s failed (%s): %s", inst.instance.id,
+                                 result.name, result.status, result.output)
+                    continue
+                logger.error("[%s] %s failed (%s): %s", inst.instance.id,
+                             result.name, result.status, result.output)
+                if inst.instance.id not in failed:
+                    failed.append(inst.instance.id)
+            return results
+        results = await collection.map(_provision)
+
+        if failed:
+            raise LoadsException("Provisioning failed on %s" %
+                                 ", ".join(failed))
+        return results
 
 
 class Docker:
     """Docker commands for AWS instances using :class:`DockerDaemon`"""
-    def __init__(self, ssh):
+    def __init__(self, ssh, load_concurrency=4, image_info_ttl=60,
+                 image_cache=None):
         self.sshclient = ssh
+        self.load_concurrency = load_concurrency
+        self.image_cache = image_cache
+        self.image_info_ttl = image_info_ttl
+        # URL -> (time fetched, ImageInfo)
+        self._image_infos = {}
+        # URL -> lock held while fetching its info
+        self._info_locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def image_info(self, container_url):
+        """The :class:`~loadsbroker.dockerctrl.ImageInfo` of an image
+        tarball, fetched once for all the instances loading it within
+        ``image_info_ttl`` seconds, or known to the image cache. Blocks."""
+        if self.image_cache is not None:
+            info = self.image_cache.info(container_url)
+            if info is not None:
+                return info
+
+        with self._lock:
+            lock = self._info_locks[container_url]
+
+        with lock:
+            fetched, info = self._image_infos.get(container_url,
+                                                  (None, None))
+            if fetched is None or \
+               time.time() - fetched > self.image_info_ttl:
+                info = image_info(container_url)
+                self._image_infos[container_url] = (time.time(), info)
+            return info
 
-    async def setup_collection(self, collection):
-        def setup_docker(ec2_instance):
-            instance, state = ec2_instance
-            if instance.ip_address is None:
-                docker_host = 'tcp://0.0.0.0:7890'
-            else:
-                docker_host = "tcp://%s:2375" % instance.ip_address
+    @staticmethod
+    def _progress(instance, sizes):
+        """Returns a function recording the bytes of the image tarballs
+        downloaded by an instance in ``instance.state.image_progress``,
+        logging each quarter of those whose size is known."""
+        progress = instance.state.image_progress = {}
+
+        def report(container_name, downloaded):
+            previous = progress.get(container_name, 0)
+            progress[container_name] = downloaded
+            size = sizes.get(container_name)
+            if size and previous * 4 // size < downloaded * 4 // size:
+                logger.debug("[%s] Downloaded %d%% of %s",
+                             instance.instance.id,
+                             min(100, downloaded * 100 // size),
+                             container_name)
+        return report
+
+    def _loads_args(self, images):
+        """Returns the digests keyed by URL, and the sizes keyed by name,
+        of the image tarballs among the images."""
+        digests = {}
+        sizes = {}
+        for container_name, container_url in images:
+            if container_url:
+                info = self.image_info(container_url)
+                digests[container_url] = info.digest
+                sizes[container_name] = info.size
+        return digests, sizes
+
+    @staticmethod
+    def setup_instance(ec2_instance):
+        """Attach a docker client to an instance."""
+        instance, state = ec2_instance
+        if instance.ip_address is None:
+            docker_host = 'tcp://0.0.0.0:7890'
+        else:
+            docker_host = "tcp://%s:2375" % instance.ip_address
 
-            if not hasattr(state, "docker"):
-                state.docker = DockerDaemon(host=docker_host)
-        await collection.map(setup_docker)
+        if not hasattr(state, "docker"):
+            state.docker = DockerDaemon(host=docker_host)
+
+    async def setup_collection(self, collection):
+        await collection.map(self.setup_instance)
 
     @staticmethod
     def not_responding_instances(collection):
         return [x for x in collection.instances
                 if not x.state.docker.responded]
 
+    @staticmethod
+    def _check_responding(inst):
+        try:
+            inst.state.docker.get_containers()
+            inst.state.docker.responded = True
+        except DOCKER_RETRY_EXC:
+            logger.debug("Docker not ready yet on %s",
+                         str(inst.instance.id))
+        except Exception as exc:
+            logger.debug("Got exception on %s: %r",
+                         str(inst.instance.id), exc)
+        return inst.state.docker.responded
+
+    async def wait_instance(self, collection, ec2_instance, interval=5,
+                            timeout=600):
+        """Waits till docker is available on an instance of the
+        collection.
+
+        :returns: Whether docker responded in time.
+
+        """
+        end = time.time() + timeout
+        while time.time() < end and ec2_instance in collection.instances:
+            if await collection.execute(self._check_responding,
+                                        ec2_instance):
+                return True
+            await collection.wait(interval)
+        return False
+
     async def wait(self, collection, interval=60, timeout=600):
         """Waits till docker is available on every instance in the
         collection."""
@@ -157,20 +398,9 @@ class Docker:
 
         not_responded = self.not_responding_instances(collection)
 
-        def get_container(inst):
-            try:
-                inst.state.docker.get_containers()
-                inst.state.docker.responded = True
-            except DOCKER_RETRY_EXC:
-                logger.debug("Docker not ready yet on %s",
-                             str(inst.instance.id))
-            except Exception as exc:
-                logger.debug("Got exception on %s: %r",
-                             str(inst.instance.id), exc)
-
         # Attempt to fetch until they've all responded
         while not_responded and time.time() < end:
-            await gen.multi([collection.execute(get_container, x)
+            await gen.multi([collection.execute(self._check_responding, x)
                              for x in not_responded])
 
             # Update the not_responded
@@ -204,38 +434,91 @@ class Docker:
                                    for x in collection.running_instances()])
         return any(results)
 
-    async def load_containers(self, collection, container_name, container_url):
-        """Loads's a container of the provided name to the instance."""
-        @retry(on_result=lambda res: not res)
-        def image_loaded(docker, container_name):
-            return docker.has_image(container_name)
+    def _load_images(self, instance, images):
+        """Loads several container images to an instance in one batch.
+        Blocks.
 
-        def load(instance):
-            def debug(msg):
-                logger.debug("[%s] %s" % (instance.instance.id, msg))
+        The ids of the images the instance holds are kept in
+        ``instance.state.images``, keyed by name/tag.
 
-            docker = instance.state.docker
+        :returns: Whether all the images were loaded.
 
-            has_container = docker.has_image(container_name)
-            if has_container and "latest" not in container_name:
-                return
+        """
+        def debug(msg):
+            logger.debug("[%s] %s" % (instance.instance.id, msg))
+
+        docker = instance.state.docker
+        loaded = instance.state.images = docker.get_images()
+        missing = [(name, url) for name, url in images
+                   if "latest" in name or name not in loaded]
+        if not missing:
+            return True
+
+        debug("Loading %s" % ", ".join(name for name, _ in missing))
+        digests, sizes = self._loads_args(missing)
+        results, output = self.sshclient.execute(
+            instance.instance, docker.load_images, missing,
+            self.load_concurrency, digests, self._progress(instance, sizes))
+        if output:
+            logger.debug(output)
+
+        all_loaded = True
+        for name, _ in missing:
+            if results[name] not in (LOADED, SKIPPED):
+                debug("Loading %s %s" % (name, results[name]))
+                all_loaded = False
+            elif not _image_loaded(docker, name):
+                debug("Docker does not have %s" % name)
+                all_loaded = False
+        instance.state.images = docker.get_images()
+        return all_loaded
+
+    async def cache_images(self, images, pin=False):
+        """Points the images with an URL at the image cache, once it holds
+        their tarballs. Images that can't be cached are loaded from their
+        origin.
+
+        :param images: List of ``(container_name, container_url)`` tuples.
+        :param pin: Keep the cached tarballs from being evicted until the
+                    returned images are passed to :meth:`release_images`.
 
-            if container_url:
-                debug("Importing %s" % container_url)
-                with self.sshclient.connect(instance.instance) as client:
-                    output = docker.import_container(client, container_url)
-                    if output:
-                        logger.debug(output)
-            else:
-                debug("Pulling %r" % container_name)
-                output = docker.pull_container(container_name)
+        """
+        if self.image_cache is None:
+            return images
 
-            if not image_loaded(docker, container_name):
-                debug("Docker does not have %s" % container_name)
-                return False
-            return output
+        async def cached(container_name, container_url):
+            if not container_url:
+                return container_name, container_url
+            try:
+                url = await self.image_cache.fetch(container_url, pin=pin)
+            except Exception:
+                logger.warning("Unable to cache %s, loading it from its "
+                               "origin.", container_url, exc_info=True)
+                url = container_url
+            return container_name, url
+        return await gen.multi([cached(*x) for x in images])
+
+    def release_images(self, images):
+        """Unpins the tarballs of images returned by :meth:`cache_images`."""
+        if self.image_cache is None:
+            return
+
+        for _, container_url in images:
+            self.image_cache.unpin(container_url)
+
+    async def load_images(self, collection, ec2_instance, images):
+        """Loads container images to an instance of the collection,
+        fetching up to ``load_concurrency`` of them at the same time.
+
+        :param images: List of ``(container_name, container_url)`` tuples.
 
-        await collection.map(load)
+        """
+        images = await self.cache_images(images, pin=True)
+        try:
+            return await collection.execute(self._load_images, ec2_instance,
+                                            images)
+        finally:
+            self.release_images(images)
 
     async def run_containers(self,
                              collection: EC2Collection,
@@ -346,13 +629,52 @@ class Heka:
         self.options = options
         self.influx = influx
 
+    def config_file(self, ec2_instance, database_name, series=None):
+        """The Heka configuration of an instance."""
+        series_name = ""
+        if series:
+            series_name = "%s." % series
+
+        hostname = "%s%s" % (
+            series_name,
+            ec2_instance.instance.ip_address.replace('.', '_')
+        )
+        if self.influx:
+            return HEKA_CONFIG_TEMPLATE.substitute(
+                remote_addr=join_host_port(self.options.host,
+                                           self.options.port),
+                remote_secure=self.options.secure and "true" or "false",
+                influx_addr=join_host_port(self.influx.host,
+                                           self.influx.port),
+                influx_db=database_name,
+                hostname=hostname)
+        return HEKA_NOINFLUX_TEMPLATE.substitute(
+            remote_addr=join_host_port(self.options.host,
+                                       self.options.port),
+            remote_secure=self.options.secure and "true" or "false",
+            hostname=hostname)
+
+    def provision(self, script, ec2_instance, database_name, series=None):
+        """Adds the upload of an instance's Heka configuration to its
+        provision script."""
+        if not self.options:
+            return
+        script.upload(self.config_file(ec2_instance, database_name, series),
+                      HEKA_CONFIG_REMOTE)
+
     async def start(self,
                     collection,
                     docker,
                     ping,
                     database_name,
-                    series=None):
-        """Launches Heka containers on all instances."""
+                    series=None,
+                    upload=True):
+        """Launches Heka containers on all instances.
+
+        :param upload: Whether to upload the configurations first, or
+                       they were uploaded with :meth:`provision`.
+
+        """
         if not self.options:
             logger.debug("Heka not configured")
             return
@@ -363,35 +685,14 @@ class Heka:
         }
         ports = {(8125, "udp"): 8125, 4352: 4352}
 
-        series_name = ""
-        if series:
-            series_name = "%s." % series
-
         # Upload heka config to all the instances
         def upload_files(inst):
-            hostname = "%s%s" % (
-                series_name,
-                inst.instance.ip_address.replace('.', '_')
-            )
-            if self.influx:
-                config_file = HEKA_CONFIG_TEMPLATE.substitute(
-                    remote_addr=join_host_port(self.options.host,
-                                               self.options.port),
-                    remote_secure=self.options.secure and "true" or "false",
-                    influx_addr=join_host_port(self.influx.host,
-                                               self.influx.port),
-                    influx_db=database_name,
-                    hostname=hostname)
-            else:
-                config_file = HEKA_NOINFLUX_TEMPLATE.substitute(
-                    remote_addr=join_host_port(self.options.host,
-                                               self.options.port),
-                    remote_secure=self.options.secure and "true" or "false",
-                    hostname=hostname)
+            config_file = self.config_file(inst, database_name, series)
             with StringIO(config_file) as fl:
                 self.sshclient.upload_file(inst.instance, fl,
-                                           "/home/core/heka/config.toml")
-        await collection.map(upload_files)
+                                           HEKA_CONFIG_REMOTE)
+        if upload:
+            await collection.map(upload_files)
 
         logger.debug("Launching Heka...")
         await docker.run_containers(collection, self.info.name,
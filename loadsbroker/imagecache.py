@@ -0,0 +1,234 @@
+"""Image Tarball Cache
+
+Every instance of a step loads the same image tarballs. Rather than
+each downloading them from their origin, such as S3, the broker
+downloads each tarball once into the :class:`ImageCache`, and the
+instances fetch it from the broker's web server, within the VPC.
+
+Tarballs are kept on disk with their MD5, served as their ETag, and
+evicted least recently used first once the cache holds more than its
+maximum size. Tarballs pinned while instances load them are never
+evicted. Cached tarballs are revalidated against their origin
+every ``revalidate`` seconds, and downloaded again if it changed.
+
+Origins are fetched with :mod:`urllib`, so ``file://`` URLs work as
+well, which is how the cache is tested.
+
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+import urllib.request
+from collections import Counter, OrderedDict
+
+from tornado import gen
+from tornado.platform.asyncio import to_tornado_future
+
+from loadsbroker import logger
+from loadsbroker.dockerctrl import ImageInfo, image_info
+
+
+# Default maximum size of the cached tarballs, in bytes
+CACHE_SIZE = 20 * 1024 ** 3
+
+# Seconds before the origin of a cached tarball is checked again
+REVALIDATE = 60
+
+# Size of the chunks tarballs are downloaded in
+CHUNK_SIZE = 1024 * 1024
+
+
+def _key(url):
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+
+class ImageCache:
+    """Caches image tarballs on disk, to serve them to the instances.
+
+    :param path: Directory of the cached tarballs. Tarballs cached by a
+                 previous broker are kept.
+    :param base_url: URL the instances reach the cache's web server at,
+                     the tarballs being served under ``/images/``.
+    :param max_size: Size in bytes above which tarballs are evicted.
+    :param executor: :class:`~loadsbroker.executor.FairExecutor`
+                     downloading the tarballs.
+
+    """
+    def __init__(self, path, base_url, executor, max_size=CACHE_SIZE,
+                 revalidate=REVALIDATE, timeout=30):
+        self.path = path
+        self.base_url = base_url.rstrip("/")
+        self.max_size = max_size
+        self.revalidate = revalidate
+        self.timeout = timeout
+        self._executor = executor
+        self._pending = {}
+        # key -> entry, least recently used first
+        self._entries = OrderedDict()
+        # key -> number of loads using the tarball
+        self._pins = Counter()
+        os.makedirs(path, exist_ok=True)
+        self._read()
+
+    def _read(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-len(".json")]
+            try:
+                with open(os.path.join(self.path, name)) as f:
+                    entry = json.load(f)
+                used = os.stat(self.file_path(key)).st_mtime
+            except (OSError, ValueError):
+                logger.warning("Ignoring unreadable cached image %s.", key,
+                               exc_info=True)
+                continue
+            entries.append((used, key, entry))
+
+        for _, key, entry in sorted(entries):
+            self._entries[key] = entry
+        self._evict()
+
+    @property
+    def size(self):
+        """Total size of the cached tarballs."""
+        return sum(x["size"] for x in self._entries.values())
+
+    def file_path(self, key):
+        return os.path.join(self.path, key)
+
+    def url(self, key):
+        """URL a cached tarball is served at."""
+        return "%s/images/%s" % (self.base_url, key)
+
+    def info(self, url):
+        """The :class:`~loadsbroker.dockerctrl.ImageInfo` of a tarball
+        given the URL it's served at, or None if it isn't cached."""
+        prefix = self.url("")
+        if not url.startswith(prefix):
+            return None
+        entry = self._entries.get(url[len(prefix):])
+        if entry is None:
+            return None
+        return ImageInfo(entry["md5"], entry["size"])
+
+    def get(self, key):
+        """Returns the entry of a cached tarball, as used, or None."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            try:
+                os.utime(self.file_path(key))
+            except OSError:
+                pass
+        return entry
+
+    async def fetch(self, url, pin=False):
+        """Ensure the tarball of an URL is cached and current, and return
+        the URL it's served at.
+
+        Concurrent fetches of an URL download it once.
+
+        :param pin: Keep the tarball from being evicted until
+                    :meth:`unpin` is called with the returned URL.
+
+        """
+        key = _key(url)
+        if pin:
+            self._pins[key] += 1
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = gen.convert_yielded(self._fetch(key, url))
+            self._pending[key] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(key, None))
+        try:
+            await pending
+        except BaseException:
+            if pin:
+                self._unpin(key)
+            raise
+        return self.url(key)
+
+    def unpin(self, url):
+        """Let a tarball pinned by :meth:`fetch` be evicted, given the URL
+        it's served at. Other URLs are ignored."""
+        prefix = self.url("")
+        if url and url.startswith(prefix):
+            self._unpin(url[len(prefix):])
+
+    def _unpin(self, key):
+        self._pins[key] -= 1
+        if self._pins[key] <= 0:
+            del self._pins[key]
+            self._evict()
+
+    def _run(self, url, func, *args):
+        return to_tornado_future(self._executor.submit(
+            ("image-cache", url), func, *args))
+
+    async def _fetch(self, key, url):
+        entry = self.get(key)
+        if entry is not None:
+            if time.time() - entry["checked"] < self.revalidate:
+                return
+
+            info = await self._run(url, image_info, url, self.timeout)
+            if info == (None, None):
+                logger.warning("Unable to revalidate image %s, using the "
+                               "cached one.", url)
+                return
+            if entry["origin"] == (info.digest or info.size):
+                entry["checked"] = time.time()
+                return
+            logger.debug("Image %s changed, downloading it again.", url)
+
+        logger.debug("Caching image %s.", url)
+        entry = await self._run(url, self._download, key, url)
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+        self._evict()
+
+    def _download(self, key, url):
+        """Downloads a tarball to the cache. Blocks."""
+        md5 = hashlib.md5()
+        with urllib.request.urlopen(url, timeout=self.timeout) as response:
+            digest = response.headers.get("ETag")
+            with tempfile.NamedTemporaryFile(dir=self.path,
+                                             delete=False) as f:
+                try:
+                    for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                        md5.update(chunk)
+                        f.write(chunk)
+                except BaseException:
+                    os.unlink(f.name)
+                    raise
+
+        size = os.path.getsize(f.name)
+        entry = dict(url=url, md5=md5.hexdigest(), size=size,
+                     origin=digest.strip('"') if digest else size,
+                     checked=time.time())
+        os.replace(f.name, self.file_path(key))
+        with open(self.file_path(key) + ".json", "w") as f:
+            json.dump(entry, f)
+        return entry
+
+    def _evict(self):
+        """Removes the least recently used tarballs over the maximum size,
+        keeping the last one and the pinned ones."""
+        size = self.size
+        for key in list(self._entries)[:-1]:
+            if size <= self.max_size:
+                break
+            if self._pins[key]:
+                continue
+            entry = self._entries.pop(key)
+            logger.debug("Evicting cached image %s.", entry["url"])
+            size -= entry["size"]
+            for path in (self.file_path(key), self.file_path(key) + ".json"):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
@@ -51,11 +51,45 @@ def _parse(sysargs=None):
                         type=str, default='root')
     parser.add_argument('--influx-secure', help='Use TLS for InfluxDB',
                         action='store_true', default=False)
+    parser.add_argument('--image-load-concurrency',
+                        help='Images loaded at once on an instance',
+                        type=int, default=4)
+    parser.add_argument('--warm-pool', help='Instances to keep ready, as '
+                        'REGION:INSTANCE_TYPE:COUNT', type=str,
+                        action='append', default=[])
+    parser.add_argument('--max-idle', help='Seconds before idle instances '
+                        'are terminated', type=int, default=600)
+    parser.add_argument('--max-workers', help='Threads running SSH and '
+                        'docker sessions', type=int, default=128)
+    parser.add_argument('--api-workers', help='Threads making EC2 API calls',
+                        type=int, default=16)
+    parser.add_argument('--download-workers', help='Threads downloading '
+                        'image tarballs to the cache', type=int, default=4)
+    parser.add_argument('--ami-cache', help='File caching the AMIs looked '
+                        'up in each region', type=str,
+                        default='/tmp/loads-amis.json')
+    parser.add_argument('--image-cache', help='Directory caching the image '
+                        'tarballs served to the instances', type=str,
+                        default='/tmp/loads-images')
+    parser.add_argument('--image-cache-url', help='URL of this broker, as '
+                        'reached by the instances, to serve them cached '
+                        'image tarballs', type=str, default=None)
+    parser.add_argument('--image-cache-size', help='Megabytes of image '
+                        'tarballs cached', type=int, default=20480)
     parser.add_argument('--initial-db', help="JSON file to initialize the db.",
                         type=str, default=os.path.join(
                             os.path.dirname(__file__), '..', 'pushgo.json'))
 
     args = parser.parse_args(sysargs)
+
+    warm_pool = {}
+    for spec in args.warm_pool:
+        try:
+            region, inst_type, count = spec.split(':')
+            warm_pool[region, inst_type] = int(count)
+        except ValueError:
+            parser.error("Invalid --warm-pool value: %r" % spec)
+    args.warm_pool = warm_pool
     return args, parser
 
 
@@ -96,7 +130,19 @@ def main(sysargs=None):
                                 aws_use_filters=not args.aws_skip_filters,
                                 aws_access_key=aws_access_key,
                                 aws_secret_key=aws_secret_key,
-                                initial_db=args.initial_db)
+                                initial_db=args.initial_db,
+                                image_load_concurrency=(
+                                    args.image_load_concurrency),
+                                warm_pool=args.warm_pool,
+                                max_idle=args.max_idle,
+                                max_workers=args.max_workers,
+                                api_workers=args.api_workers,
+                                download_workers=args.download_workers,
+                                ami_cache=args.ami_cache,
+                                image_cache=args.image_cache,
+                                image_cache_url=args.image_cache_url,
+                                image_cache_size=(
+                                    args.image_cache_size * 1024 ** 2))
 
     logger.debug('Listening on port %d...' % args.port)
     application.listen(args.port)
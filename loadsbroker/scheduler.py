@@ -0,0 +1,320 @@
+"""Step Scheduling
+
+Steps in a run change state at points in time that are known ahead of
+time: a step starts ``run_delay`` seconds after its run started, and
+stops ``run_max_time`` seconds after the step itself started.
+
+The :class:`StepScheduler` keeps a heap of pending :class:`Deadline`'s
+and arms a single IO loop timeout for the earliest one, so starts and
+stops happen on time without re-evaluating every step at each tick.
+Waiters are woken when a deadline passes, or when
+:meth:`StepScheduler.notify` is called because something else (an
+abort) happened.
+
+Whether the containers of a started step have all exited can't be
+known ahead of time, so steps are still polled for it: a ``CHECK``
+deadline every exit check interval, up to the step's ``STOP``
+deadline.
+
+A single :class:`RunSupervisor` owned by the broker drives the
+deadlines of every active run from one scheduler, so that the number
+of wakeups grows with the number of step transitions rather than with
+the number of runs.
+
+"""
+import heapq
+import itertools
+import math
+import time
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.locks import Event
+
+from loadsbroker import logger
+
+
+# Deadline actions
+START = "start"
+STOP = "stop"
+CHECK = "check"
+
+
+class Deadline(namedtuple("Deadline", "when seq action setlink manager")):
+    """A scheduled transition for a step.
+
+    ``when`` is a naive UTC datetime, matching the timestamps stored on
+    :class:`~loadsbroker.db.StepRecord`. ``seq`` breaks ties so that
+    deadlines falling at the same time fire in the order they were
+    scheduled. ``manager`` is the run manager owning the step, if any.
+
+    """
+
+
+class StepScheduler:
+    """Heap of step deadlines driven by the IO loop."""
+    def __init__(self, io_loop):
+        self._loop = io_loop
+        self._heap = []
+        self._seq = itertools.count()
+        self._cancelled = set()
+        self._timeout = None
+        self._wakeup = Event()
+
+    def __len__(self):
+        return len(self._heap) - len(self._cancelled)
+
+    def schedule(self, when, action, setlink, manager=None):
+        """Schedule an action for a step at the given UTC datetime.
+
+        :returns: The :class:`Deadline`, which can be passed to
+                  :meth:`cancel`.
+
+        """
+        deadline = Deadline(when, next(self._seq), action, setlink, manager)
+        heapq.heappush(self._heap, deadline)
+        if self._heap[0] is deadline:
+            self._arm()
+        return deadline
+
+    def schedule_in(self, seconds, action, setlink, manager=None):
+        """Schedule an action for a step ``seconds`` from now."""
+        when = datetime.utcnow() + timedelta(seconds=seconds)
+        return self.schedule(when, action, setlink, manager)
+
+    def cancel(self, deadline):
+        """Cancel a previously scheduled deadline."""
+        if deadline in self._heap:
+            self._cancelled.add(deadline.seq)
+
+    def cancel_step(self, setlink):
+        """Cancel all the pending deadlines of a step."""
+        for deadline in self._heap:
+            if deadline.setlink is setlink:
+                self._cancelled.add(deadline.seq)
+
+    def notify(self):
+        """Wake up any waiter immediately."""
+        self._wakeup.set()
+
+    @property
+    def next_deadline(self):
+        """The earliest pending deadline, or None."""
+        self._discard_cancelled()
+        return self._heap[0] if self._heap else None
+
+    def due(self, now=None):
+        """Pop and return all the deadlines that have passed."""
+        now = now or datetime.utcnow()
+        due = []
+        while self._heap and self._heap[0].when <= now:
+            deadline = heapq.heappop(self._heap)
+            if deadline.seq in self._cancelled:
+                self._cancelled.discard(deadline.seq)
+                continue
+            due.append(deadline)
+        self._arm()
+        return due
+
+    async def wait(self):
+        """Wait for a deadline to pass or for :meth:`notify`.
+
+        :returns: List of the :class:`Deadline`'s that are due, which
+                  may be empty if woken by :meth:`notify`.
+
+        """
+        due = self.due()
+        if due:
+            return due
+        await self._wakeup.wait()
+        self._wakeup.clear()
+        return self.due()
+
+    def _discard_cancelled(self):
+        while self._heap and self._heap[0].seq in self._cancelled:
+            self._cancelled.discard(heapq.heappop(self._heap).seq)
+
+    def _arm(self):
+        """Arm the IO loop timeout for the earliest deadline."""
+        if self._timeout is not None:
+            self._loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+        deadline = self.next_deadline
+        if deadline is None:
+            return
+
+        delay = (deadline.when - datetime.utcnow()).total_seconds()
+        self._timeout = self._loop.call_later(max(delay, 0),
+                                              self._wakeup.set)
+
+    def close(self):
+        """Drop all deadlines and disarm the IO loop timeout."""
+        self._heap = []
+        self._cancelled = set()
+        self._arm()
+
+
+class RunSupervisor:
+    """Supervises the steps of all the active runs of a broker.
+
+    Run managers register with :meth:`supervise` once their run is
+    running, and schedule their step deadlines through the
+    supervisor. A single loop waits on the shared
+    :class:`StepScheduler`, and on every tick:
+
+    * Hands each run the deadlines that came due for it, all runs
+      being processed concurrently. A run still busy with an earlier
+      batch (starting containers can take a while) gets its deadlines
+      queued until it is done.
+    * Finishes the runs that were aborted or have completed.
+    * Commits every database session touched since the last tick once.
+      Runs have sessions of their own, a failed commit only rolls back
+      the changes of its run.
+
+    Exit checks are polls over SSH, aligned on a grid of their interval
+    so that the checks of concurrent runs land on the same ticks rather
+    than each run waking up on its own. A step is no longer checked
+    once its stop deadline comes first.
+
+    """
+    def __init__(self, io_loop):
+        self._loop = io_loop
+        self.scheduler = StepScheduler(io_loop)
+        self._managers = {}
+        self._pending = defaultdict(list)
+        self._busy = set()
+        self._dirty = []
+        self._supervising = False
+        self.ticks = 0
+
+    def __len__(self):
+        return len(self._managers)
+
+    def supervise(self, manager):
+        """Supervise a running run until all its steps have completed,
+        or it was aborted.
+
+        :returns: Future resolving once the run is done.
+
+        """
+        future = Future()
+
+        # Runs without steps left would never see a deadline
+        if manager.abort or manager._steps_complete():
+            future.set_result(True)
+            return future
+
+        self._managers[manager] = future
+        for setlink in manager.step_links:
+            manager._schedule_step(setlink)
+
+        if not self._supervising:
+            self._supervising = True
+            self._loop.add_future(gen.convert_yielded(self._supervise()),
+                                  self._stopped)
+        self.notify()
+        return future
+
+    def schedule(self, manager, when, action, setlink):
+        """Schedule a step action of a run at a given UTC datetime."""
+        return self.scheduler.schedule(when, action, setlink, manager)
+
+    def schedule_check(self, manager, setlink, interval, until=None):
+        """Schedule an exit check of a step on the next multiple of
+        ``interval``, unless that's past ``until``, the UTC datetime the
+        step stops at anyway.
+
+        :returns: The :class:`Deadline`, or None if no check is needed.
+
+        """
+        now = time.time()
+        slot = math.floor(now / interval) * interval + interval
+        when = datetime.utcnow() + timedelta(seconds=slot - now)
+        if until is not None and when >= until:
+            return None
+        return self.scheduler.schedule(when, CHECK, setlink, manager)
+
+    def mark_dirty(self, session):
+        """Flag a database session as needing a commit on this tick."""
+        if not any(x is session for x in self._dirty):
+            self._dirty.append(session)
+
+    def notify(self):
+        """Wake the supervisor loop."""
+        self.scheduler.notify()
+
+    async def _supervise(self):
+        try:
+            await self._supervise_runs()
+        finally:
+            # Cleared as the loop ends, so that a run supervised from now
+            # on starts a new one
+            self._supervising = False
+
+    async def _supervise_runs(self):
+        while self._managers:
+            due = await self.scheduler.wait()
+            self.ticks += 1
+
+            for deadline in due:
+                if deadline.manager in self._managers:
+                    self._pending[deadline.manager].append(deadline)
+
+            for manager in list(self._managers):
+                if manager in self._busy:
+                    continue
+
+                if manager.abort or manager._steps_complete():
+                    self._finish(manager)
+                    continue
+
+                deadlines = self._pending.pop(manager, None)
+                if deadlines:
+                    self._dispatch(manager, deadlines)
+
+            self._commit()
+
+    def _stopped(self, future):
+        try:
+            future.result()
+        except Exception:
+            logger.error("Run supervisor died.", exc_info=True)
+            for manager in list(self._managers):
+                self._finish(manager)
+        self._commit()
+
+    def _dispatch(self, manager, deadlines):
+        """Process a batch of deadlines for a run in the background."""
+        self._busy.add(manager)
+
+        def processed(future):
+            self._busy.discard(manager)
+            try:
+                future.result()
+            except Exception:
+                logger.error("Error processing step deadlines.",
+                             exc_info=True)
+            self.notify()
+
+        self._loop.add_future(
+            gen.convert_yielded(manager._process_deadlines(deadlines)),
+            processed)
+
+    def _finish(self, manager):
+        for setlink in manager.step_links:
+            self.scheduler.cancel_step(setlink)
+        self._pending.pop(manager, None)
+        future = self._managers.pop(manager)
+        future.set_result(True)
+
+    def _commit(self):
+        dirty, self._dirty = self._dirty, []
+        for session in dirty:
+            try:
+                session.commit()
+            except Exception:
+                logger.error("Error committing run changes.", exc_info=True)
+                session.rollback()
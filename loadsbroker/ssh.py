@@ -1,7 +1,9 @@
 """Basic ssh utility functions"""
+import base64
 import os
+import shlex
 import stat
-from collections import deque
+from collections import deque, namedtuple
 
 from loadsbroker import logger
 
@@ -32,3 +34,94 @@ def makedirs(sftp, dirname, mode=511):
 
         if not stat.S_ISDIR(attrs.st_mode):
             raise OSError("%s exists and is not a directory" % dirname)
+
+
+# Line written after the output of each step of a provision script,
+# followed by the step's exit status
+STEP_MARKER = "__LOADS_STEP_DONE__"
+
+# Delimiter of the files uploaded by a provision script
+UPLOAD_DELIMITER = "__LOADS_UPLOAD__"
+
+StepResult = namedtuple("StepResult", "name status output")
+
+
+class ProvisionScript:
+    """Uploads and shell commands run on an instance in a single SSH
+    command, rather than a session per file or command.
+
+    Steps run in the order they're added, whether or not the previous
+    ones succeeded. The files are inlined in the script as base64.
+
+    """
+    def __init__(self):
+        # (name, shell command, stdin)
+        self.steps = []
+
+    def __len__(self):
+        return len(self.steps)
+
+    def run(self, name, command):
+        """Adds a shell command."""
+        self.steps.append((name, command, None))
+
+    def upload(self, data, remote_file, mode=None):
+        """Adds a file upload, creating the directories leading to it.
+
+        :param data: Content of the file, as str or bytes.
+
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        path = shlex.quote(remote_file)
+        command = "mkdir -p %s && base64 -d > %s" % (
+            shlex.quote(os.path.dirname(remote_file) or "."), path)
+        if mode is not None:
+            command += " && chmod %o %s" % (mode, path)
+        self.steps.append(("upload %s" % remote_file, command,
+                           base64.encodebytes(data).decode("ascii")))
+
+    def render(self):
+        """The shell script of the steps."""
+        lines = []
+        for _, command, stdin in self.steps:
+            if stdin is None:
+                lines.append("(%s) 2>&1 < /dev/null" % command)
+            else:
+                lines.append("(%s) 2>&1 <<'%s'" % (command, UPLOAD_DELIMITER))
+                lines.append(stdin.rstrip("\n"))
+                lines.append(UPLOAD_DELIMITER)
+            lines.append("printf '\\n%s %%d\\n' $?" % STEP_MARKER)
+        return "\n".join(lines) + "\n"
+
+    def results(self, output):
+        """Splits the output of the script into the results of its steps.
+
+        Steps that didn't report, as the session was cut short, have
+        a ``None`` status.
+
+        """
+        if isinstance(output, bytes):
+            output = output.decode("utf-8", "replace")
+
+        results = []
+        lines = []
+        names = iter(name for name, _, _ in self.steps)
+        for line in output.split("\n"):
+            if not line.startswith(STEP_MARKER + " "):
+                lines.append(line)
+                continue
+            # The marker starts on a new line, drop the one added
+            if lines and not lines[-1]:
+                lines.pop()
+            status = int(line[len(STEP_MARKER) + 1:])
+            results.append(StepResult(next(names), status,
+                                      "\n".join(lines)))
+            lines = []
+
+        # The output left belongs to the step that was interrupted
+        output = "\n".join(lines).strip("\n")
+        for name in names:
+            results.append(StepResult(name, None, output))
+            output = ""
+        return results
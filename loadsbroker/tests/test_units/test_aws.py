@@ -1,6 +1,10 @@
+import os
+import time
 import unittest
+from collections import Counter
 from datetime import datetime, timedelta
 
+from tornado import gen
 from tornado.testing import AsyncTestCase, gen_test
 from moto import mock_ec2
 import boto
@@ -99,6 +103,73 @@ class Test_get_ami(unittest.TestCase):
                           "m1.small")
 
 
+class Test_ami_cache(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        import tempfile
+        fd, self.path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        os.remove(self.path)
+        self.lookups = []
+
+    def tearDown(self):
+        super().tearDown()
+        import loadsbroker.aws
+        loadsbroker.aws.AWS_AMI_IDS = {k: {} for k in
+                                       loadsbroker.aws.AWS_REGIONS}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    async def _lookup(self, region):
+        from mock import Mock
+        self.lookups.append(region)
+        await gen.moment
+        images = []
+        for name, virt in [("CoreOS 1", "hvm"), ("CoreOS 2", "hvm"),
+                           ("CoreOS 2", "paravirtual")]:
+            image = Mock(id="ami-%d" % len(images),
+                         virtualization_type=virt)
+            image.name = name
+            images.append(image)
+        return images
+
+    def _makeOne(self, **kwargs):
+        from loadsbroker.aws import AMICache
+        return AMICache(self._lookup, self.path, **kwargs)
+
+    @gen_test
+    async def test_lookup_once(self):
+        from loadsbroker.aws import get_ami
+        cache = self._makeOne()
+        await gen.multi([cache.lookup("us-west-2"),
+                         cache.lookup("us-west-2")])
+        self.assertEqual(self.lookups, ["us-west-2"])
+        self.assertEqual(get_ami("us-west-2", "m3.large"), "ami-1")
+        self.assertEqual(get_ami("us-west-2", "m1.small"), "ami-2")
+
+        # Persisted for the next broker
+        cache = self._makeOne()
+        amis = await cache.lookup("us-west-2")
+        self.assertEqual(self.lookups, ["us-west-2"])
+        self.assertEqual(amis["hvm"].id, "ami-1")
+
+    @gen_test
+    async def test_expired(self):
+        cache = self._makeOne(ttl=0)
+        await cache.lookup("us-west-2")
+        await cache.lookup("us-west-2")
+        self.assertEqual(self.lookups, ["us-west-2", "us-west-2"])
+
+        # Expired AMIs are better than none
+        async def failing(region):
+            raise ValueError(region)
+        cache._lookup = failing
+        amis = await cache.lookup("us-west-2")
+        self.assertEqual(amis["paravirtual"].id, "ami-2")
+        with self.assertRaises(ValueError):
+            await cache.lookup("us-east-1")
+
+
 class Test_available_instance(unittest.TestCase):
     def setUp(self):
         # Nuke the backend
@@ -138,6 +209,32 @@ class Test_available_instance(unittest.TestCase):
             self.assertFalse(self._callFUT(instance))
 
 
+class Test_distribute(unittest.TestCase):
+    def test_shares(self):
+        from loadsbroker.aws import distribute
+        self.assertEqual(distribute(5, {"a": 40, "b": 60}),
+                         {"a": 2, "b": 3})
+        self.assertEqual(list(distribute(10, {"a": 1, "b": 1, "c": 1})
+                              .values()), [4, 3, 3])
+        self.assertEqual(distribute(0, {"a": 1}), {"a": 0})
+
+    def test_invalid_weights(self):
+        from loadsbroker.aws import distribute
+        from loadsbroker.exceptions import LoadsException
+        for weights in ({}, {"a": 0, "b": 0}, {"a": -1, "b": 2}):
+            self.assertRaises(LoadsException, distribute, 5, weights)
+
+
+class Test_instances_for(unittest.TestCase):
+    def test_rounding_leftovers(self):
+        from loadsbroker.aws import _instances_for
+        self.assertEqual(_instances_for(3, 0.1), 30)
+        self.assertEqual(_instances_for(0.1 + 0.2, 0.1), 3)
+        self.assertEqual(_instances_for(2.5), 3)
+        self.assertEqual(_instances_for(1e-16, 0.1), 0)
+        self.assertEqual(_instances_for(-1), 0)
+
+
 class Test_ec2_collection(AsyncTestCase):
     def setUp(self):
         super().setUp()
@@ -173,6 +270,30 @@ class Test_ec2_collection(AsyncTestCase):
             inst.instance.update()
         self.assertEqual(len(coll.instances), len(coll.dead_instances()))
 
+    @gen_test
+    async def test_api_calls_dont_wait_for_sessions(self):
+        import threading
+        from loadsbroker.aws import EC2Collection
+        from loadsbroker.executor import FairExecutor
+        conn = boto.connect_ec2()
+        sessions, api = FairExecutor(1), FairExecutor(1)
+        coll = EC2Collection("a", "b", conn, [], self.io_loop,
+                             executor=sessions, api_executor=api)
+        release = threading.Event()
+        try:
+            # A long session holds the only session thread
+            session = coll.execute(release.wait, 5)
+            self.assertEqual(await coll._ec2_call("us-east-1", len, "abc"),
+                             3)
+            self.assertFalse(session.done())
+            self.assertEqual(sessions.stats()["active"], 1)
+            self.assertEqual(api.stats()["completed"], 1)
+        finally:
+            release.set()
+            await session
+            sessions.shutdown()
+            api.shutdown()
+
     @gen_test
     async def test_remove_unresponsive_instances(self):
         conn = boto.connect_ec2()
@@ -202,6 +323,168 @@ class Test_ec2_collection(AsyncTestCase):
         for inst in coll.instances:
             self.assertEqual(inst.instance.state, "running")
 
+    @gen_test
+    async def test_instance_waiting_batches_refresh(self):
+        conn = boto.connect_ec2()
+        reservation = conn.run_instances("ami-1234abcd", 5)
+        coll = self._callFUT("a", "b", conn, reservation.instances)
+        describe = conn.get_only_instances
+        calls = []
+
+        def get_only_instances(instance_ids=None):
+            calls.append(instance_ids)
+            return describe(instance_ids=instance_ids)
+        conn.get_only_instances = get_only_instances
+
+        # A single call refreshes every pending instance
+        await coll.wait_for_running(interval=0.1)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(calls[0]),
+                         sorted(x.id for x in reservation.instances))
+        for inst in coll.instances:
+            self.assertEqual(inst.instance.state, "running")
+
+    @gen_test
+    async def test_instance_waiting_times_out(self):
+        conn = boto.connect_ec2()
+        reservation = conn.run_instances("ami-1234abcd", 2)
+        coll = self._callFUT("a", "b", conn, reservation.instances)
+        conn.get_only_instances = lambda instance_ids=None: []
+
+        result = await coll.wait_for_instance(coll.instances[0],
+                                              interval=0.05, timeout=0.2)
+        self.assertFalse(result)
+        self.assertEqual(len(coll._waited), 0)
+
+
+class Test_free_instances(unittest.TestCase):
+    def _instance(self, id, state="running", minutes_ago=0,
+                  inst_type="m1.small", region="us-west-2"):
+        from mock import Mock
+        launched = datetime.utcnow() - timedelta(minutes=minutes_ago)
+        inst = Mock(id=id, state=state, instance_type=inst_type,
+                    launch_time=launched.strftime('%Y-%m-%dT%H:%M:%S.%fZ'))
+        inst.region.name = region
+        return inst
+
+    def _callFUT(self, *instances):
+        from loadsbroker.aws import FreeInstances
+        free = FreeInstances()
+        for inst in instances:
+            free.add(inst)
+        return free
+
+    @freeze_time("2015-01-01 12:00:00")
+    def test_pop_order(self):
+        running = self._instance("i-1")
+        fresh = self._instance("i-2", "pending", minutes_ago=1)
+        stalled = self._instance("i-3", "pending", minutes_ago=10)
+        stopped = self._instance("i-4", "stopped")
+        other = self._instance("i-5", inst_type="m3.large")
+        free = self._callFUT(stalled, fresh, running, stopped, other)
+
+        self.assertEqual(free.pop("us-west-2", "m1.small", 5),
+                         [running, fresh])
+        self.assertEqual(free.count("us-west-2"), 3)
+        self.assertIn(stalled, free)
+        self.assertEqual(free.pop("us-west-2", "m1.small", 5), [])
+
+    @freeze_time("2015-01-01 12:00:00")
+    def test_pop_pending_by_launch_time(self):
+        newest = self._instance("i-1", "pending", minutes_ago=0)
+        older = self._instance("i-2", "pending", minutes_ago=1)
+        stalled = self._instance("i-3", "pending", minutes_ago=10)
+        free = self._callFUT(older, newest, stalled)
+
+        self.assertEqual(free.pop("us-west-2", "m1.small", 1), [newest])
+        self.assertEqual(free.pop("us-west-2", "m1.small", 5), [older])
+        self.assertEqual(list(free.drain().values()), [[stalled]])
+
+    @freeze_time("2015-01-01 12:00:00")
+    def test_pop_pending_skips_removed(self):
+        newest = self._instance("i-1", "pending", minutes_ago=0)
+        older = self._instance("i-2", "pending", minutes_ago=1)
+        free = self._callFUT(older, newest)
+        free.remove(newest)
+        self.assertEqual(free.pop("us-west-2", "m1.small", 5), [older])
+
+        # Re-added instances are only handed out once
+        free.add(newest)
+        free.add(newest)
+        self.assertEqual(free.pop("us-west-2", "m1.small", 5), [newest])
+        self.assertEqual(len(free), 0)
+        self.assertEqual(free.pop("us-west-2", "m1.small", 5), [])
+
+    def test_pop_image_first(self):
+        first = self._instance("i-1")
+        holder = self._instance("i-2")
+        free = self._callFUT(first)
+        free.add(holder, ["bbangert/pushtester:dev"])
+
+        self.assertEqual(free.pop("us-west-2", "m1.small", 1,
+                                  image="bbangert/pushtester:dev"), [holder])
+        self.assertEqual(free.pop("us-west-2", "m1.small", 1,
+                                  image="bbangert/pushtester:dev"), [first])
+        self.assertEqual(len(free), 0)
+
+    def test_drain(self):
+        east = self._instance("i-1", region="us-east-1")
+        west = self._instance("i-2")
+        free = self._callFUT(east, west)
+        self.assertEqual(free.drain(), {"us-east-1": [east],
+                                        "us-west-2": [west]})
+        self.assertEqual(len(free), 0)
+
+
+class Test_inventory(unittest.TestCase):
+    def _instance(self, id, region="us-west-2", **tags):
+        from mock import Mock
+        inst = Mock(id=id, tags=dict(tags))
+        inst.region.name = region
+        return inst
+
+    def _makeOne(self):
+        from loadsbroker.aws import Inventory
+        return Inventory()
+
+    def test_indexes(self):
+        inventory = self._makeOne()
+        first = self._instance("i-1", RunId="r1", Uuid="s1")
+        second = self._instance("i-2", RunId="r1", Uuid="s2")
+        free = self._instance("i-3", RunId="", Uuid="")
+        inventory.update([first, second, free])
+
+        self.assertEqual(len(inventory), 3)
+        self.assertIs(inventory.get("i-3"), free)
+        self.assertEqual(sorted(x.id for x in inventory.run_instances("r1")),
+                         ["i-1", "i-2"])
+        self.assertEqual(inventory.step_instances("s2"), [second])
+        self.assertEqual(inventory.run_instances(""), [])
+
+        # Tags set by the pool move the instances between runs
+        inventory.tag(["i-2", "i-3"], {"RunId": "r2", "Uuid": "s3"})
+        self.assertEqual(inventory.run_instances("r1"), [first])
+        self.assertEqual(len(inventory.run_instances("r2")), 2)
+        self.assertEqual(inventory.step_instances("s2"), [])
+
+        inventory.discard(["i-1", "i-4"])
+        self.assertNotIn("i-1", inventory)
+        self.assertEqual(inventory.run_instances("r1"), [])
+
+    def test_replace_region(self):
+        inventory = self._makeOne()
+        west = self._instance("i-1", RunId="r1")
+        east = self._instance("i-2", region="us-east-1", RunId="r1")
+        inventory.update([west, east])
+        self.assertIsNone(inventory.age())
+
+        swept = self._instance("i-3", RunId="r1")
+        inventory.replace("us-west-2", [swept])
+        self.assertEqual(sorted(x.id for x in inventory.instances()),
+                         ["i-2", "i-3"])
+        self.assertEqual(sorted(x.id for x in inventory.run_instances("r1")),
+                         ["i-2", "i-3"])
+
 
 class Test_ec2_pool(AsyncTestCase):
     def setUp(self):
@@ -221,8 +504,7 @@ class Test_ec2_pool(AsyncTestCase):
         # Wait for initialization to finish
         await pool.ready
         self.assertEqual(pool._recovered, {})
-        for _, val in pool._instances.items():
-            self.assertEqual(val, [])
+        self.assertEqual(len(pool._instances), 0)
 
     @gen_test(timeout=10)
     async def test_recovered_instances(self):
@@ -246,7 +528,36 @@ class Test_ec2_pool(AsyncTestCase):
         await pool.ready
 
         # Verify 5 instances recovered
-        self.assertEqual(len(pool._instances[first_region]), 5)
+        self.assertEqual(pool._instances.count(first_region), 5)
+
+    @gen_test(timeout=10)
+    async def test_recovery_survives_failed_region(self):
+        import loadsbroker.aws
+        from boto.exception import EC2ResponseError
+        from mock import patch
+        from loadsbroker.aws import EC2Pool
+        first_region = loadsbroker.aws.AWS_REGIONS[0]
+        conn = boto.ec2.connect_to_region(first_region)
+        reservation = conn.run_instances("ami-1234abcd", 2,
+                                         instance_type='m1.small')
+        for inst in reservation.instances:
+            inst.start()
+
+        recover_region = EC2Pool._recover_region
+
+        async def failing_region(pool, region):
+            if region != first_region:
+                raise EC2ResponseError(503, "Unavailable")
+            return await recover_region(pool, region)
+
+        with patch.object(EC2Pool, "_recover_region", failing_region):
+            pool = self._callFUT("br12")
+            await pool.ready
+
+        # The region that answered is recovered, the others are left to
+        # the sweep
+        self.assertEqual(pool._instances.count(first_region), 2)
+        self.assertEqual(len(pool._instances), 2)
 
     @gen_test
     async def test_allocates_instances_for_collection(self):
@@ -344,13 +655,13 @@ class Test_ec2_pool(AsyncTestCase):
         pool = self._callFUT("br12")
         await pool.ready
 
-        self.assertEqual(len(pool._instances[region]), 5)
+        self.assertEqual(pool._instances.count(region), 5)
 
         coll = await pool.request_instances("run_12", "12423", 5,
                                             inst_type="m1.small",
                                             region=region)
         self.assertEqual(len(coll.instances), 5)
-        self.assertEqual(len(pool._instances[region]), 0)
+        self.assertEqual(pool._instances.count(region), 0)
 
     @gen_test
     async def test_allocate_ignores_already_assigned(self):
@@ -378,7 +689,7 @@ class Test_ec2_pool(AsyncTestCase):
         pool = self._callFUT("br12")
         await pool.ready
 
-        self.assertEqual(len(pool._instances[region]), 0)
+        self.assertEqual(pool._instances.count(region), 0)
         self.assertEqual(len(pool._recovered[("asdf", "hjkl")]), 5)
         coll = await pool.request_instances("run_12", "12423", 5,
                                             inst_type="m1.small",
@@ -443,14 +754,473 @@ class Test_ec2_pool(AsyncTestCase):
 
         # Return them
         await pool.release_instances(coll)
-        self.assertEqual(len(pool._instances[region]), 5)
+        self.assertEqual(pool._instances.count(region), 5)
 
         # Acquire 5 again
         coll = await pool.request_instances("run_12", "42315", 5,
                                             inst_type="m1.small",
                                             region=region)
         self.assertEqual(len(coll.instances), 5)
-        self.assertEqual(len(pool._instances[region]), 0)
+        self.assertEqual(pool._instances.count(region), 0)
+
+    @gen_test(timeout=10)
+    async def test_image_affinity(self):
+        region = "us-west-2"
+        # Setup the AMI we need available to make instances
+        conn = boto.ec2.connect_to_region(region)
+        reservation = conn.run_instances('ami-1234abcd')
+        instance = reservation.instances[0]
+        conn.create_image(instance.id, "CoreOS stable")
+
+        pool = self._callFUT("br12")
+        await pool.ready
+
+        coll = await pool.request_instances("run_12", "12423", 4,
+                                            inst_type="m1.small",
+                                            region=region)
+        await coll.wait_for_running()
+        images = {"bbangert/pushtester:dev": "824823"}
+        for inst in coll.instances[2:]:
+            inst.state.images = images
+        holders = [x.instance for x in coll.instances[2:]]
+        await pool.release_instances(coll)
+
+        # The instances with the image are picked first, with their state
+        coll = await pool.request_instances("run_12", "42315", 2,
+                                            inst_type="m1.small",
+                                            region=region,
+                                            image="bbangert/pushtester:dev")
+        self.assertEqual([x.instance for x in coll.instances], holders)
+        self.assertEqual([x.state.images for x in coll.instances],
+                         [images, images])
+        self.assertEqual(pool._instances.count(region), 2)
+
+    @gen_test(timeout=10)
+    async def test_released_instances_keep_no_run_state(self):
+        region = "us-west-2"
+        # Setup the AMI we need available to make instances
+        conn = boto.ec2.connect_to_region(region)
+        reservation = conn.run_instances('ami-1234abcd')
+        instance = reservation.instances[0]
+        conn.create_image(instance.id, "CoreOS stable")
+
+        pool = self._callFUT("br12")
+        await pool.ready
+
+        coll = await pool.request_instances("run_12", "12423", 1,
+                                            inst_type="m1.small",
+                                            region=region)
+        await coll.wait_for_running()
+        state = coll.instances[0].state
+        state.docker = docker = object()
+        state.images = {"bbangert/pushtester:dev": "824823"}
+        state.dns_server = "172.17.0.2"
+        state.nonresponsive = True
+        state.phase = "ready"
+        state.image_progress = {"bbangert/pushtester:dev": 1024}
+        await pool.release_instances(coll)
+
+        # Reacquired by the next run with only its docker and images
+        coll = await pool.request_instances("run_13", "42315", 1,
+                                            inst_type="m1.small",
+                                            region=region)
+        state = coll.instances[0].state
+        self.assertIs(state.docker, docker)
+        self.assertEqual(state.images, {"bbangert/pushtester:dev": "824823"})
+        for name in ("dns_server", "nonresponsive", "phase",
+                     "image_progress"):
+            self.assertFalse(hasattr(state, name), name)
+
+    @gen_test(timeout=10)
+    async def test_warm_pool(self):
+        region = "us-west-2"
+        # Setup the AMI we need available to make instances
+        conn = boto.ec2.connect_to_region(region)
+        reservation = conn.run_instances('ami-1234abcd')
+        instance = reservation.instances[0]
+        conn.create_image(instance.id, "CoreOS stable")
+
+        async def warmer(collection):
+            for inst in collection.instances:
+                inst.state.images = {"warm": "1"}
+
+        # The pool fills up once ready
+        pool = self._callFUT("br12", warm_pool={(region, "m1.small"): 2},
+                             warmer=warmer)
+        await pool.ready
+        await pool._warming
+        warm = list(pool._warm[region, "m1.small"])
+        self.assertEqual(len(warm), 2)
+
+        # Warm instances are handed out first, and refilled
+        coll = await pool.request_instances("run_12", "12423", 3,
+                                            inst_type="m1.small",
+                                            region=region)
+        self.assertEqual(len(coll.instances), 3)
+        prepared = [x.instance for x in coll.instances
+                    if getattr(x.state, "images", None)]
+        self.assertEqual(prepared, warm)
+
+        await pool._warming
+        self.assertEqual(len(pool._warm[region, "m1.small"]), 2)
+
+    @gen_test(timeout=10)
+    async def test_failed_warming_returns_instances(self):
+        region = "us-west-2"
+        # Setup the AMI we need available to make instances
+        conn = boto.ec2.connect_to_region(region)
+        reservation = conn.run_instances('ami-1234abcd')
+        instance = reservation.instances[0]
+        conn.create_image(instance.id, "CoreOS stable")
+
+        async def warmer(collection):
+            raise ValueError("docker never came up")
+
+        pool = self._callFUT("br12", warm_pool={(region, "m1.small"): 2},
+                             warmer=warmer)
+        await pool.ready
+        with self.assertRaises(ValueError):
+            await pool._warming
+
+        # The instances are free for allocation rather than untracked
+        self.assertEqual(len(pool._warm[region, "m1.small"]), 0)
+        self.assertEqual(pool._instances.count(region), 2)
+
+    @gen_test(timeout=10)
+    async def test_reaping_idle_instances(self):
+        region = "us-west-2"
+        # Setup the AMI we need available to make instances
+        conn = boto.ec2.connect_to_region(region)
+        reservation = conn.run_instances('ami-1234abcd')
+        instance = reservation.instances[0]
+        conn.create_image(instance.id, "CoreOS stable")
+
+        pool = self._callFUT("br12", max_idle=60)
+        await pool.ready
+
+        coll = await pool.request_instances("run_12", "12423", 5,
+                                            inst_type="m1.small",
+                                            region=region)
+        await coll.wait_for_running()
+        await pool.release_instances(coll)
+        instances = [x.instance for x in coll.instances]
+
+        # Keep a floor of 2 instances
+        pool.warm_pool = {(region, "m1.small"): 2}
+
+        # Nothing is reaped until max_idle is over
+        await pool.reap_idle_instances()
+        self.assertEqual(pool._instances.count(region), 5)
+
+        for inst in instances[:4]:
+            pool._instances.remove(inst)
+            pool._instances.add(inst, idle_since=time.time() - 120)
+        await pool.reap_idle_instances()
+
+        # The last idle one and the one in use make the floor
+        self.assertEqual([x in pool._instances for x in instances],
+                         [False, False, False, True, True])
+        terminated = conn.get_only_instances(
+            instance_ids=[x.id for x in instances[:3]])
+        self.assertEqual(set(x.state for x in terminated), {"terminated"})
+
+    @gen_test
+    async def test_tagging_retries_missing_instances(self):
+        from boto.exception import EC2ResponseError
+        from mock import Mock, patch
+        pool = self._callFUT("br12")
+        await pool.ready
+
+        tagged = []
+        body = ("<Response><Errors><Error>"
+                "<Code>InvalidInstanceID.NotFound</Code>"
+                "<Message>The instance ID 'i-2' does not exist</Message>"
+                "</Error></Errors></Response>")
+
+        def create_tags(instance_ids, tags):
+            tagged.append(instance_ids)
+            if "i-2" in instance_ids and len(tagged) < 3:
+                raise EC2ResponseError(400, "Bad Request", body)
+
+        conn = Mock(create_tags=create_tags)
+        instances = [Mock(id=x) for x in ("i-1", "i-2", "i-3")]
+        with patch("loadsbroker.aws.TAG_BACKOFF", 0.01):
+            await pool._tag_instances(conn, instances, {"RunId": "asdf"},
+                                      "asdf")
+
+        # The instances found are tagged right away, the other is retried
+        self.assertEqual(tagged, [["i-1", "i-2", "i-3"], ["i-1", "i-3"],
+                                  ["i-2"]])
+        self.assertEqual(pool.api_calls["asdf"], 3)
+
+    async def _spot_pool(self, fulfilled):
+        """A pool whose spot requests get ``fulfilled`` instances."""
+        from mock import Mock
+        region = "us-west-2"
+        conn = boto.ec2.connect_to_region(region)
+        reservation = conn.run_instances('ami-1234abcd')
+        conn.create_image(reservation.instances[0].id, "CoreOS stable")
+
+        pool = self._callFUT("br12")
+        await pool.ready
+        pool._instances.drain()
+        pool.spot_interval = 0.01
+        pool.spot_timeout = 1
+
+        conn = await pool._region_conn(region)
+        launched = conn.run_instances('ami-1234abcd', fulfilled).instances
+        launched = iter([x.id for x in launched])
+        requests = {}
+        self.cancelled = []
+
+        def request_spot_instances(price, ami_id, count, **kwargs):
+            new = [Mock(id="sir-%d" % (len(requests) + i), state="open",
+                        instance_id=None) for i in range(count)]
+            requests.update((x.id, x) for x in new)
+            return new
+
+        def get_all_spot_instance_requests(request_ids):
+            # A request is fulfilled on each check, while instances last
+            for request_id in request_ids:
+                request = requests[request_id]
+                if request.state == "open":
+                    request.instance_id = next(launched, None)
+                    if request.instance_id:
+                        request.state = "active"
+                    else:
+                        request.status.code = "capacity-not-available"
+                    break
+            return [requests[x] for x in request_ids]
+
+        def cancel_spot_instance_requests(request_ids):
+            self.cancelled.extend(request_ids)
+            for request_id in request_ids:
+                requests[request_id].state = "cancelled"
+
+        conn.request_spot_instances = request_spot_instances
+        conn.get_all_spot_instance_requests = get_all_spot_instance_requests
+        conn.cancel_spot_instance_requests = cancel_spot_instance_requests
+        return pool
+
+    @gen_test
+    async def test_spot_allocation(self):
+        from loadsbroker.exceptions import LoadsException
+        pool = await self._spot_pool(2)
+        coll = await pool.request_instances("run_12", "12423", 3,
+                                            inst_type="m1.small",
+                                            region="us-west-2",
+                                            allocation="spot",
+                                            spot_price=0.05)
+        self.assertEqual(len(coll.instances), 2)
+        self.assertEqual(self.cancelled, ["sir-2"])
+        self.assertEqual(len(pool.inventory.instances()), 3)
+
+        with self.assertRaises(LoadsException):
+            await pool.request_instances("run_12", "12424", 1,
+                                         inst_type="m1.small",
+                                         region="us-west-2",
+                                         allocation="spot")
+
+    def _not_found(self, lookups, fail):
+        """Make the lookup of spot instances fail ``fail`` times."""
+        from boto.exception import EC2ResponseError
+        body = ("<Response><Errors><Error>"
+                "<Code>InvalidInstanceID.NotFound</Code>"
+                "<Message>The instance ID does not exist</Message>"
+                "</Error></Errors></Response>")
+        get_only_instances = lookups.get_only_instances
+        calls = []
+
+        def lookup(instance_ids):
+            calls.append(instance_ids)
+            if len(calls) <= fail:
+                raise EC2ResponseError(400, "Bad Request", body)
+            return get_only_instances(instance_ids=instance_ids)
+        lookups.get_only_instances = lookup
+        return calls
+
+    @gen_test
+    async def test_spot_lookup_retries(self):
+        from mock import patch
+        pool = await self._spot_pool(2)
+        conn = await pool._region_conn("us-west-2")
+        calls = self._not_found(conn, 2)
+
+        with patch("loadsbroker.aws.TAG_BACKOFF", 0.01):
+            coll = await pool.request_instances("run_12", "12423", 2,
+                                                inst_type="m1.small",
+                                                region="us-west-2",
+                                                allocation="spot",
+                                                spot_price=0.05)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(len(coll.instances), 2)
+
+    @gen_test
+    async def test_spot_lookup_failure_terminates(self):
+        from mock import patch
+        pool = await self._spot_pool(2)
+        conn = await pool._region_conn("us-west-2")
+        calls = self._not_found(conn, 100)
+
+        with patch("loadsbroker.aws.TAG_BACKOFF", 0.01):
+            coll = await pool.request_instances("run_12", "12423", 2,
+                                                inst_type="m1.small",
+                                                region="us-west-2",
+                                                allocation="spot",
+                                                spot_price=0.05)
+        self.assertEqual(len(calls), 6)
+        self.assertEqual(coll.instances, [])
+        terminated = [inst for res in conn.get_all_instances()
+                      for inst in res.instances
+                      if inst.state == "terminated"]
+        self.assertEqual(len(terminated), 2)
+
+    @gen_test
+    async def test_spot_fallback_allocation(self):
+        pool = await self._spot_pool(1)
+        coll = await pool.request_instances("run_12", "12423", 3,
+                                            inst_type="m1.small",
+                                            region="us-west-2",
+                                            allocation="spot-fallback",
+                                            spot_price=0.05)
+        self.assertEqual(len(coll.instances), 3)
+        self.assertEqual(self.cancelled, ["sir-1", "sir-2"])
+
+    @gen_test
+    async def test_held_capacity_is_weighted(self):
+        from mock import Mock
+        region = "us-west-2"
+        conn = boto.ec2.connect_to_region(region)
+        reservation = conn.run_instances("ami-1234abcd", 5,
+                                         instance_type="m1.small")
+        conn.create_image(reservation.instances[0].id, "CoreOS stable")
+        for inst in reservation.instances:
+            inst.start()
+        conn.create_tags([x.id for x in reservation.instances],
+                         {"Name": "loads-br12", "Project": "loads"})
+
+        pool = self._callFUT("br12")
+        await pool.ready
+        self.assertEqual(pool._instances.count(region), 5)
+        conn = await pool._region_conn(region)
+
+        # Two held instances worth two each cover the whole capacity
+        held = [Mock(instance_type="m1.xlarge") for _ in range(2)]
+        instances = await pool._request_location(
+            conn, None, 4, list(held), "run_12", "m1.small", None,
+            "on-demand", None, {"m1.xlarge": 2}, None, None)
+        self.assertEqual(instances, held)
+        self.assertEqual(pool._instances.count(region), 5)
+
+        # One of them leaves two free instances to take
+        instances = await pool._request_location(
+            conn, None, 4, held[:1], "run_12", "m1.small", None,
+            "on-demand", None, {"m1.xlarge": 2}, None, None)
+        self.assertEqual(len(instances), 3)
+        self.assertEqual(pool._instances.count(region), 3)
+
+    @gen_test
+    async def test_fractional_capacity_leftovers(self):
+        from collections import OrderedDict
+        region = "us-west-2"
+        pool = self._callFUT("br12")
+        await pool.ready
+        conn = await pool._region_conn(region)
+        requested = []
+
+        # m1.small only has one instance left
+        async def allocate_type(conn, count, inst_type, *args, **kwargs):
+            requested.append((inst_type, count))
+            return [inst_type] * (1 if inst_type == "m1.small" else count)
+        pool._allocate_type = allocate_type
+
+        weights = OrderedDict([("m1.small", 0.1), ("m1.xlarge", 0.1)])
+        instances = await pool._allocate_capacity(conn, 0.1 + 0.2, weights,
+                                                  region)
+        self.assertEqual(requested, [("m1.small", 3), ("m1.xlarge", 2)])
+        self.assertEqual(len(instances), 3)
+
+    @gen_test
+    async def test_instance_type_fallback(self):
+        from boto.exception import EC2ResponseError
+        region = "us-west-2"
+        conn = boto.ec2.connect_to_region(region)
+        reservation = conn.run_instances('ami-1234abcd')
+        conn.create_image(reservation.instances[0].id, "CoreOS stable")
+
+        pool = self._callFUT("br12")
+        await pool.ready
+        pool._instances.drain()
+
+        conn = await pool._region_conn(region)
+        run_instances = conn.run_instances
+        requested = []
+        body = ("<Response><Errors><Error>"
+                "<Code>InsufficientInstanceCapacity</Code>"
+                "<Message>Insufficient capacity.</Message>"
+                "</Error></Errors></Response>")
+
+        # m2.4xlarge is out of capacity, and only 3 m1.small are left
+        def limited(ami_id, min_count, max_count, instance_type, **kwargs):
+            requested.append((instance_type, max_count))
+            if instance_type == "m2.4xlarge":
+                raise EC2ResponseError(400, "Bad Request", body)
+            if instance_type == "m1.small":
+                max_count = min(max_count, 3)
+            return run_instances(ami_id, min_count=max_count,
+                                 max_count=max_count,
+                                 instance_type=instance_type, **kwargs)
+        conn.run_instances = limited
+
+        coll = await pool.request_instances(
+            "run_12", "12423", 4, inst_type="m2.4xlarge", region=region,
+            fallback_types={"m1.xlarge": 0.5, "m1.small": 0.25})
+
+        # The remaining capacity is spread over the fallback types, then
+        # the rest goes to the type that isn't saturated
+        self.assertEqual(requested[0], ("m2.4xlarge", 4))
+        self.assertEqual(sorted(requested[1:3]),
+                         [("m1.small", 8), ("m1.xlarge", 4)])
+        self.assertEqual(requested[3:], [("m1.xlarge", 3)])
+        types = Counter(x.instance.instance_type for x in coll.instances)
+        self.assertEqual(types, {"m1.xlarge": 7, "m1.small": 3})
+
+    @gen_test
+    async def test_multi_region_allocation(self):
+        for region in ("us-east-1", "us-west-2"):
+            conn = boto.ec2.connect_to_region(region)
+            reservation = conn.run_instances('ami-1234abcd')
+            conn.create_image(reservation.instances[0].id, "CoreOS stable")
+
+        pool = self._callFUT("br12")
+        await pool.ready
+        pool._instances.drain()
+        pool.use_filters = True
+
+        coll = await pool.request_instances(
+            "run_12", "12423", 5, inst_type="m1.small",
+            distribution={"us-east-1": 40, "us-west-2a": 30,
+                          "us-west-2b": 30})
+        regions = Counter(x.instance.region.name for x in coll.instances)
+        self.assertEqual(regions, {"us-east-1": 2, "us-west-2": 3})
+        zones = Counter(x.instance.placement for x in coll.instances
+                        if x.instance.region.name == "us-west-2")
+        self.assertEqual(zones, {"us-west-2a": 2, "us-west-2b": 1})
+        self.assertEqual(len(pool.inventory.run_instances("run_12")), 5)
+
+        # Instances are refreshed and removed in their own region
+        await coll.wait_for_running()
+        east = [x for x in coll.instances
+                if x.instance.region.name == "us-east-1"]
+        await coll.remove_instances(east[:1])
+        self.assertEqual(len(coll.instances), 4)
+        east = boto.ec2.connect_to_region("us-east-1")
+        tagged = east.get_only_instances(filters={"tag:RunId": "run_12"})
+        self.assertEqual(len(tagged), 1)
+
+        await pool.release_instances(coll)
+        self.assertEqual(pool._instances.count("us-east-1"), 1)
+        self.assertEqual(pool._instances.count("us-west-2"), 3)
 
     @gen_test
     async def test_reaping_all_instances(self):
@@ -474,8 +1244,66 @@ class Test_ec2_pool(AsyncTestCase):
 
         # Return them
         await pool.release_instances(coll)
-        self.assertEqual(len(pool._instances[region]), 5)
+        self.assertEqual(pool._instances.count(region), 5)
 
         # Now, reap them
         await pool.reap_instances()
-        self.assertEqual(len(pool._instances[region]), 0)
+        self.assertEqual(pool._instances.count(region), 0)
+        for inst in coll.instances:
+            self.assertNotIn(inst.instance.id, pool.inventory)
+
+    @gen_test(timeout=10)
+    async def test_terminating_instances(self):
+        region = "us-west-2"
+        pool = self._callFUT("br12")
+        await pool.ready
+        coll = await pool.request_instances("run_12", "12423", 3,
+                                            inst_type="m1.small",
+                                            region=region)
+        await pool.release_instances(coll)
+        instances = [x.instance for x in coll.instances]
+
+        calls = []
+        terminate = pool._terminate
+
+        async def count_terminate(region, instances):
+            calls.append(region)
+            await terminate(region, instances)
+        pool._terminate = count_terminate
+
+        terminated = await pool.terminate_instances(instances)
+        self.assertEqual(terminated, [x.id for x in instances])
+        self.assertEqual(calls, [region])
+        self.assertEqual(pool._instances.count(region), 0)
+        self.assertFalse(any(x.id in pool.inventory for x in instances))
+
+    @gen_test(timeout=10)
+    async def test_inventory_follows_allocations(self):
+        region = "us-west-2"
+        # Setup the AMI we need available to make instances
+        conn = boto.ec2.connect_to_region(region)
+        reservation = conn.run_instances('ami-1234abcd')
+        instance = reservation.instances[0]
+        conn.create_image(instance.id, "CoreOS stable")
+
+        pool = self._callFUT("br12")
+        await pool.ready
+        self.assertIn(instance.id, pool.inventory)
+        self.assertIsNotNone(pool.inventory.age())
+        pool.use_filters = True
+
+        coll = await pool.request_instances("run_12", "12423", 3,
+                                            inst_type="m1.small",
+                                            region=region)
+        ids = sorted(x.instance.id for x in coll.instances)
+        self.assertEqual(
+            sorted(x.id for x in pool.inventory.run_instances("run_12")), ids)
+        self.assertEqual(
+            sorted(x.id for x in pool.inventory.step_instances("12423")), ids)
+
+        await pool.release_instances(coll)
+        self.assertEqual(pool.inventory.run_instances("run_12"), [])
+
+        # A sweep finds what EC2 knows
+        await pool.sweep_inventory()
+        self.assertTrue(all(x in pool.inventory for x in ids))
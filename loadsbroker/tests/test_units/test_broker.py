@@ -1,8 +1,10 @@
 import os
+from datetime import datetime
 
 import boto
 from mock import Mock, PropertyMock, patch
 from moto import mock_ec2
+from tornado import gen
 from tornado.testing import AsyncTestCase, gen_test
 from loadsbroker.tests.util import (clear_boto_context, load_boto_context,
                                     create_image)
@@ -50,6 +52,7 @@ class Test_broker(AsyncTestCase):
 
         mock_run = Mock()
         type(mock_run).uuid = PropertyMock(return_value="asdf")
+        type(mock_run).plan = PropertyMock(return_value=Mock(steps=[]))
 
         type(mock_rm_inst).run = PropertyMock(return_value=mock_run)
 
@@ -60,6 +63,87 @@ class Test_broker(AsyncTestCase):
             uuid = broker.run_plan("bleh", create_db=False, owner='tarek')
             self.assertEqual(uuid, "asdf")
 
+    def test_recover_runs(self):
+        from tornado.concurrent import Future
+        from loadsbroker.db import Run, COMPLETED, INITIALIZING, RUNNING
+        broker = self._createFUT()
+        session = broker.db.session()
+        stale, allocated, running = Run(), Run(), Run()
+        running.state = RUNNING
+        running.started_at = datetime.utcnow()
+        session.add_all([stale, allocated, running])
+        session.commit()
+
+        broker.pool._recovered = {(allocated.uuid, "step"): [Mock()]}
+        ready = Future()
+        ready.set_result(None)
+        with patch('loadsbroker.broker.RunManager',
+                   new_callable=Mock) as mock_rm:
+            mock_rm.recover_run.return_value = (Mock(), Future())
+            broker._recover_runs(ready)
+
+        recovered = [x[1]["run_uuid"]
+                     for x in mock_rm.recover_run.call_args_list]
+        self.assertIn(allocated.uuid, recovered)
+        self.assertIn(running.uuid, recovered)
+        self.assertNotIn(stale.uuid, recovered)
+
+        # Every recovered run gets a session of its own
+        sessions = [x[1]["db_session"]
+                    for x in mock_rm.recover_run.call_args_list]
+        self.assertEqual(len(set(map(id, sessions))), len(sessions))
+
+        session.expire_all()
+        self.assertEqual(allocated.state, INITIALIZING)
+        self.assertEqual(stale.state, COMPLETED)
+        self.assertTrue(stale.aborted)
+        self.assertIsNotNone(stale.completed_at)
+        broker.shutdown()
+
+
+class Test_prepare_instance(AsyncTestCase):
+    def _collection(self):
+        collection = Mock()
+
+        async def wait_for_instance(ec2_instance):
+            return True
+        collection.wait_for_instance = wait_for_instance
+        return collection
+
+    def _docker(self, loaded):
+        docker = Mock()
+
+        async def wait_instance(*args, **kwargs):
+            return True
+
+        async def load_images(*args, **kwargs):
+            return loaded
+        docker.wait_instance = wait_instance
+        docker.load_images = load_images
+        return docker
+
+    @gen_test
+    async def test_ready(self):
+        from loadsbroker.broker import _prepare_instance
+        collection = self._collection()
+        inst = Mock()
+        collection.instances = [inst]
+        ready = await _prepare_instance(self._docker(True), collection, inst,
+                                        [("bbangert/heka:0.9", None)])
+        self.assertTrue(ready)
+        self.assertEqual(inst.state.phase, "ready")
+
+    @gen_test
+    async def test_images_failed_to_load(self):
+        from loadsbroker.broker import _prepare_instance
+        collection = self._collection()
+        inst = Mock()
+        collection.instances = [inst]
+        ready = await _prepare_instance(self._docker(False), collection,
+                                        inst, [("bbangert/heka:0.9", None)])
+        self.assertFalse(ready)
+        self.assertEqual(inst.state.phase, "failed")
+
 
 file_name = "/tmp/loads_test.db"
 db_uri = "sqlite:///" + file_name
@@ -119,9 +203,13 @@ class Test_run_manager(AsyncTestCase):
 
         async def return_none(*args, **kwargs):
             return None
+
+        async def return_true(*args, **kwargs):
+            return True
         helpers.docker.setup_collection = return_none
         helpers.docker.wait = return_none
-        helpers.docker.load_containers = return_none
+        helpers.docker.wait_instance = return_true
+        helpers.docker.load_images = return_true
         self.helpers = helpers
 
         run = Run.new_run(self.db_session, plan_uuid)
@@ -146,6 +234,172 @@ class Test_run_manager(AsyncTestCase):
         await rm._initialize()
         self.assertEqual(rm.state, RUNNING)
 
+    @gen_test(timeout=10)
+    async def test_initialize_per_step(self):
+        from tornado.concurrent import Future
+        from loadsbroker.db import RUNNING
+        rm = await self._createFUT()
+        blocked = Future()
+
+        async def wait_instance(collection, ec2_instance, **kwargs):
+            if collection is rm._set_links[1].ec2_collection:
+                await blocked
+            return True
+        self.helpers.docker.wait_instance = wait_instance
+
+        # The run starts running without waiting for the slow step
+        await rm._initialize()
+        self.assertEqual(rm.state, RUNNING)
+        first, second = rm._set_links
+        self.assertTrue(rm._step_ready(first))
+        self.assertFalse(rm._step_ready(second))
+
+        blocked.set_result(None)
+        await rm._step_inits[second]
+        self.assertTrue(rm._step_ready(second))
+
+    @gen_test(timeout=10)
+    async def test_cleanup_waits_for_initializing_steps(self):
+        from tornado.concurrent import Future
+        rm = await self._createFUT()
+        blocked = Future()
+
+        async def wait_instance(collection, ec2_instance, **kwargs):
+            if collection is rm._set_links[1].ec2_collection:
+                await blocked
+            return True
+        self.helpers.docker.wait_instance = wait_instance
+
+        await rm._initialize()
+        second = rm._step_inits[rm._set_links[1]]
+        released = []
+
+        async def release_instances(collection):
+            released.append(second.done())
+        rm._pool.release_instances = release_instances
+
+        cleanup = gen.convert_yielded(rm._cleanup())
+        for _ in range(10):
+            await gen.moment
+        self.assertFalse(cleanup.done())
+
+        blocked.set_result(None)
+        await cleanup
+        self.assertEqual(released, [True, True])
+
+    @gen_test(timeout=10)
+    async def test_background_errors_are_logged(self):
+        rm = await self._createFUT()
+
+        async def fail():
+            raise ValueError()
+
+        with patch("loadsbroker.broker.logger") as logger:
+            future = rm._in_background(fail(), "failing")
+            for _ in range(3):
+                await gen.moment
+        self.assertTrue(future.done())
+        self.assertEqual(logger.error.call_args[0][:2],
+                         ("Error %s for run %s.", "failing"))
+
+    @gen_test(timeout=10)
+    async def test_initialize_prunes_failed_instances(self):
+        from loadsbroker.db import RUNNING
+        rm = await self._createFUT()
+        failed = []
+
+        # Docker never comes up on the first instance
+        async def wait_instance(collection, ec2_instance, **kwargs):
+            if not failed:
+                failed.append(ec2_instance)
+            return ec2_instance is not failed[0]
+        self.helpers.docker.wait_instance = wait_instance
+
+        await rm._initialize()
+        await gen.multi(list(rm._step_inits.values()))
+        self.assertEqual(rm.state, RUNNING)
+        failing = failed[0]
+        self.assertEqual(failing.state.phase, "failed")
+        for setlink in rm._set_links:
+            instances = setlink.ec2_collection.instances
+            self.assertNotIn(failing, instances)
+            self.assertTrue(all(x.state.phase == "ready"
+                                for x in instances))
+
+    @gen_test(timeout=10)
+    async def test_initialize_without_ready_instances_aborts(self):
+        from loadsbroker.db import INITIALIZING
+        rm = await self._createFUT()
+        released = []
+
+        async def wait_instance(collection, ec2_instance, **kwargs):
+            return False
+        self.helpers.docker.wait_instance = wait_instance
+
+        async def release_instances(collection):
+            released.append(list(collection.instances))
+        rm._pool.release_instances = release_instances
+
+        await rm.start()
+        self.assertTrue(rm.abort)
+        self.assertEqual(rm.state, INITIALIZING)
+        self.assertIsNone(rm.run.started_at)
+        self.assertEqual(released, [[], []])
+
+    @gen_test(timeout=10)
+    async def test_initialize_below_configured_quorum_aborts(self):
+        rm = await self._createFUT()
+        for step in rm.run.plan.steps:
+            step.min_ready_fraction = 1.0
+        failed = []
+
+        async def wait_instance(collection, ec2_instance, **kwargs):
+            if not failed:
+                failed.append(ec2_instance)
+            return ec2_instance is not failed[0]
+        self.helpers.docker.wait_instance = wait_instance
+
+        async def release_instances(collection):
+            pass
+        rm._pool.release_instances = release_instances
+
+        await rm.start()
+        self.assertTrue(rm.abort)
+        self.assertIsNone(rm.run.started_at)
+
+    @gen_test(timeout=10)
+    async def test_initialize_quorum(self):
+        from tornado.concurrent import Future
+        rm = await self._createFUT()
+        for step in rm.run.plan.steps:
+            step.min_ready_fraction = 0.5
+            step.straggler_grace = 0
+        stalled = Future()
+
+        # Docker never comes up on every other instance
+        async def wait_instance(collection, ec2_instance, **kwargs):
+            if collection.instances.index(ec2_instance) % 2:
+                await stalled
+            return True
+        self.helpers.docker.wait_instance = wait_instance
+
+        await rm._initialize()
+        await gen.multi(list(rm._step_inits.values()))
+        for setlink in rm._set_links:
+            instances = setlink.ec2_collection.instances
+            self.assertEqual(len(instances), setlink.step.instance_count / 2)
+            self.assertTrue(all(x.state.phase == "ready"
+                                for x in instances))
+        stalled.set_result(None)
+
+    def test_quorum(self):
+        from loadsbroker.broker import _quorum
+        self.assertEqual(_quorum(10, None), 10)
+        self.assertEqual(_quorum(10, 0.95), 10)
+        self.assertEqual(_quorum(100, 0.95), 95)
+        self.assertEqual(_quorum(10, 0), 1)
+        self.assertEqual(_quorum(0, 0.5), 0)
+
     @gen_test(timeout=10)
     async def test_run(self):
         from loadsbroker.db import (
@@ -156,7 +410,7 @@ class Test_run_manager(AsyncTestCase):
         self.assertEqual(rm.state, INITIALIZING)
         await rm._initialize()
         self.assertEqual(rm.state, RUNNING)
-        rm.sleep_time = 0.5
+        rm.exit_check_interval = 0.5
 
         run_j = rm.run.json()
         self.assertEqual(run_j['plan_id'], 1)
@@ -165,7 +419,7 @@ class Test_run_manager(AsyncTestCase):
         # Zero out extra calls
         async def zero_out(*args, **kwargs):
             return None
-        self.helpers.ssh.reload_sysctl = zero_out
+        self.helpers.ssh.provision = zero_out
         self.helpers.heka.start = zero_out
         self.helpers.dns.start = zero_out
         self.helpers.docker.run_containers = zero_out
@@ -195,12 +449,12 @@ class Test_run_manager(AsyncTestCase):
         self.assertEqual(rm.state, INITIALIZING)
         await rm._initialize()
         self.assertEqual(rm.state, RUNNING)
-        rm.sleep_time = 0.5
+        rm.exit_check_interval = 0.5
 
         # Zero out extra calls
         async def zero_out(*args, **kwargs):
             return None
-        self.helpers.ssh.reload_sysctl = zero_out
+        self.helpers.ssh.provision = zero_out
         self.helpers.heka.start = zero_out
         self.helpers.dns.start = zero_out
         self.helpers.docker.run_containers = zero_out
@@ -223,3 +477,161 @@ class Test_run_manager(AsyncTestCase):
         self.assertEqual(result, None)
         self.assertEqual([s.ec2_collection.finished for s in rm._set_links],
                          [False, False])
+
+    @gen_test(timeout=10)
+    async def test_start_step_ignores_sysctl_failure(self):
+        from loadsbroker.extensions import SSH, Watcher
+        from loadsbroker.ssh import StepResult
+        rm = await self._createFUT()
+        await rm._initialize()
+        await gen.multi(list(rm._step_inits.values()))
+        setlink = rm._set_links[0]
+
+        ssh = self.helpers.ssh = SSH(ssh_keyfile="key")
+
+        def run_script(instance, script):
+            return [StepResult("reload sysctl", 255, "unknown key")]
+        ssh.run_script = run_script
+
+        async def zero_out(*args, **kwargs):
+            return None
+        self.helpers.watcher = Mock(spec=Watcher)
+        self.helpers.watcher.start = zero_out
+        self.helpers.heka.start = zero_out
+
+        started = []
+
+        async def run_containers(collection, *args, **kwargs):
+            started.append(collection)
+        self.helpers.docker.run_containers = run_containers
+
+        await rm._start_step(setlink)
+        self.assertEqual(started, [setlink.ec2_collection])
+
+    @gen_test(timeout=20)
+    async def test_maintain_count(self):
+        rm = await self._createFUT()
+        await rm._initialize()
+        await gen.multi(list(rm._step_inits.values()))
+        setlink = rm._set_links[0]
+        setlink.step.maintain_count = True
+        collection = setlink.ec2_collection
+        count = len(collection.instances)
+
+        started = []
+
+        async def start_step(setlink, collection=None):
+            started.append(collection)
+        rm._start_step = start_step
+
+        async def is_running(*args, **kwargs):
+            return True
+        self.helpers.docker.is_running = is_running
+
+        # Two instances die while the step runs
+        setlink.step_record.started_at = datetime.utcnow()
+        collection.started = True
+        dead = collection.instances[:2]
+        for inst in dead:
+            inst.state.nonresponsive = True
+        await rm._is_done(setlink)
+        await rm._replenishing[setlink]
+        await gen.moment
+
+        self.assertEqual(len(collection.instances), count)
+        self.assertFalse(any(x in collection.instances for x in dead))
+        self.assertEqual(len(started), 1)
+        replacements = started[0].instances
+        self.assertEqual(len(replacements), 2)
+        self.assertTrue(all(x.state.phase == "ready" for x in replacements))
+        self.assertEqual(rm._replenishing, {})
+
+    @gen_test(timeout=20)
+    async def test_cleanup_waits_for_replenishing(self):
+        from tornado.concurrent import Future
+        rm = await self._createFUT()
+        await rm._initialize()
+        await gen.multi(list(rm._step_inits.values()))
+        setlink = rm._set_links[0]
+        collection = setlink.ec2_collection
+        blocked = Future()
+        spare = collection.instances[-1].instance
+
+        async def replenish(collection, **kwargs):
+            await blocked
+            return collection.add_instances([spare])
+        rm._pool.replenish = replenish
+
+        removed = []
+
+        async def remove_instances(ec2_instances):
+            removed.extend(ec2_instances)
+            for inst in ec2_instances:
+                collection.instances.remove(inst)
+        collection.remove_instances = remove_instances
+
+        released = []
+
+        async def release_instances(collection):
+            released.append(list(collection.instances))
+        rm._pool.release_instances = release_instances
+
+        # The step stops while its replacements are being allocated
+        rm._maintain_count(setlink)
+        collection.finished = True
+        count = len(collection.instances)
+        cleanup = gen.convert_yielded(rm._cleanup())
+        for _ in range(10):
+            await gen.moment
+        self.assertFalse(cleanup.done())
+        self.assertEqual(released, [])
+
+        blocked.set_result(None)
+        await cleanup
+        await gen.moment
+        self.assertEqual(len(removed), 1)
+        self.assertEqual(len(released[0]), count)
+        self.assertEqual(rm._replenishing, {})
+
+    @gen_test(timeout=20)
+    async def test_recover_run(self):
+        from datetime import datetime
+        from loadsbroker.broker import RunManager
+        from loadsbroker.aws import EC2Pool
+        from loadsbroker.db import RUNNING
+        rm = await self._createFUT()
+        rm._pool.use_filters = True
+        await rm._initialize()
+        self.assertEqual(rm.state, RUNNING)
+
+        # Pretend the first step was started before the broker went away
+        first = rm._set_links[0]
+        first.step_record.started_at = datetime.utcnow()
+        self.db_session.commit()
+        counts = {x.step.uuid: len(x.ec2_collection.instances)
+                  for x in rm._set_links}
+
+        # A new pool recovers the instances tagged for the run
+        pool = EC2Pool("broker_1234", io_loop=self.io_loop,
+                       use_filters=False)
+        await pool.ready
+
+        loads = []
+
+        async def load_images(*args, **kwargs):
+            loads.append(args)
+            return True
+        self.helpers.docker.load_images = load_images
+
+        recovered = RunManager(self.helpers, self.db_session, pool,
+                               self.io_loop, rm.run)
+        recovered._recovering = True
+        await recovered._initialize()
+
+        self.assertEqual(recovered.state, RUNNING)
+        self.assertEqual({x.step.uuid: len(x.ec2_collection.instances)
+                          for x in recovered._set_links}, counts)
+        started = {x.step.uuid for x in recovered._set_links
+                   if x.ec2_collection.started}
+        self.assertEqual(started, {first.step.uuid})
+        self.assertEqual(loads, [])
@@ -0,0 +1,45 @@
+import unittest
+
+
+class Test_step(unittest.TestCase):
+    def _makeOne(self, **kwargs):
+        from loadsbroker.db import Step
+        return Step.from_json(name="step", instance_type="m1.small",
+                              **kwargs)
+
+    def test_distribution(self):
+        step = self._makeOne(instance_distribution={"us-east-1": 40,
+                                                    "us-west-2a": 60})
+        self.assertEqual(step.instance_distribution,
+                         {"us-east-1": 40, "us-west-2a": 60})
+        self.assertIsNone(self._makeOne().instance_distribution)
+
+    def test_invalid_distribution(self):
+        from loadsbroker.exceptions import LoadsException
+        for distribution in ({}, {"us-east-1": 0}, {"us-east-1": -1,
+                                                    "us-west-2": 2},
+                             {"us-east-1": "1"}, {"mars-north-1": 1},
+                             {"sa-east-1": 1}, {"sa-east-1a": 1}):
+            self.assertRaises(LoadsException, self._makeOne,
+                              instance_distribution=distribution)
+
+    def test_fallbacks(self):
+        from loadsbroker.exceptions import LoadsException
+        step = self._makeOne(instance_fallbacks={"m1.xlarge": 0.5})
+        self.assertEqual(step.instance_fallbacks, {"m1.xlarge": 0.5})
+        self.assertEqual(self._makeOne(instance_fallbacks={})
+                         .instance_fallbacks, {})
+        for fallbacks in ({"m1.xlarge": 0}, {"m1.xlarge": -1}):
+            self.assertRaises(LoadsException, self._makeOne,
+                              instance_fallbacks=fallbacks)
+
+    def test_spot_price(self):
+        from loadsbroker.exceptions import LoadsException
+        step = self._makeOne(allocation="spot", spot_price=0.05)
+        self.assertEqual(step.spot_price, 0.05)
+        self.assertIsNone(self._makeOne(allocation="on-demand").spot_price)
+        for allocation in ("spot", "spot-fallback"):
+            self.assertRaises(LoadsException, self._makeOne,
+                              allocation=allocation)
+        self.assertRaises(LoadsException, self._makeOne,
+                          allocation="reserved", spot_price=0.05)
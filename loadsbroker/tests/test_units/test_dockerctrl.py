@@ -0,0 +1,199 @@
+import hashlib
+import os
+import subprocess
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+
+from loadsbroker import dockerctrl
+from loadsbroker.dockerctrl import (
+    DockerDaemon,
+    import_command,
+    image_info,
+    load_images_command,
+    pull_command,
+)
+
+# Stands in for docker on the PATH, with images loaded from tarballs of
+# their name kept in $IMAGES
+FAKE_DOCKER = """#!/bin/sh
+image="$IMAGES/$(echo "$2" | tr / _)"
+case "$1" in
+  load) name=$(cat)
+        echo "$name" > "$IMAGES/$(echo "$name" | tr / _)"
+        echo "$1" >> "$IMAGES/calls" ;;
+  inspect) test -f "$image" ;;
+  pull) echo "$2" > "$image" ;;
+  rmi) rm "$image" ;;
+esac
+"""
+
+
+class TestLoadImagesCommand(unittest.TestCase):
+
+    def _commands(self, images, concurrency=4):
+        # Run the batch with sh printing each command instead of running it
+        cmd = load_images_command(images, concurrency)
+        self.assertTrue(cmd.endswith("-P %d sh -c" % concurrency))
+        output = subprocess.check_output(cmd + " 'printf \"%s\\0\" \"$0\"'",
+                                         shell=True)
+        return sorted(output.decode().split("\0")[:-1])
+
+    def test_import_and_pull(self):
+        commands = self._commands([("bbangert/heka:0.9", "http://x/heka.tar"),
+                                   ("kitcambridge/dnsmasq:latest", None)])
+        self.assertEqual(commands, sorted([
+            import_command("bbangert/heka:0.9", "http://x/heka.tar"),
+            pull_command("kitcambridge/dnsmasq:latest")]))
+
+    def test_quoting(self):
+        url = "http://x/a b.tar?c=1&d=2"
+        commands = self._commands([("a", url)], 1)
+        self.assertEqual(commands, [import_command("a", url)])
+        self.assertIn("url='%s'" % url, commands[0])
+
+
+class TestImportCommand(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        tmpdir = self.tmpdir.name
+        self.images = os.path.join(tmpdir, "images")
+        os.mkdir(self.images)
+        bin_dir = os.path.join(tmpdir, "bin")
+        os.mkdir(bin_dir)
+        docker = os.path.join(bin_dir, "docker")
+        with open(docker, "w") as f:
+            f.write(FAKE_DOCKER)
+        os.chmod(docker, 0o755)
+
+        self.tarball = os.path.join(tmpdir, "image.tar")
+        with open(self.tarball, "w") as f:
+            f.write("bbangert/heka:latest")
+        self.url = "file://" + self.tarball
+        with open(self.tarball, "rb") as f:
+            self.md5 = hashlib.md5(f.read()).hexdigest()
+
+        self.env = dict(os.environ, IMAGES=self.images,
+                        PATH=bin_dir + os.pathsep + os.environ["PATH"])
+        patcher = patch.object(dockerctrl, "IMAGE_DIGESTS",
+                               os.path.join(tmpdir, "digests"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _run(self, command):
+        proc = subprocess.run(["sh", "-c", command], env=self.env,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL)
+        return proc.returncode, proc.stdout.decode().splitlines()
+
+    def _loads(self):
+        try:
+            with open(os.path.join(self.images, "calls")) as f:
+                return len(f.readlines())
+        except FileNotFoundError:
+            return 0
+
+    def test_import(self):
+        command = import_command("bbangert/heka:latest", self.url, self.md5)
+        status, lines = self._run(command)
+        self.assertEqual(status, 0)
+        self.assertEqual(lines[-2:], [
+            "LOADS_PROGRESS bbangert/heka:latest 20",
+            "LOADS_DONE bbangert/heka:latest loaded"])
+        self.assertEqual(self._loads(), 1)
+
+        # Not downloaded again while the digest remains the same
+        status, lines = self._run(command)
+        self.assertEqual(lines, ["LOADS_DONE bbangert/heka:latest skipped"])
+        self.assertEqual(self._loads(), 1)
+
+        # But once it changes
+        command = import_command("bbangert/heka:latest", self.url, "v2-1")
+        status, lines = self._run(command)
+        self.assertEqual(lines[-1], "LOADS_DONE bbangert/heka:latest loaded")
+        self.assertEqual(self._loads(), 2)
+
+    def test_digest_mismatch(self):
+        command = import_command("bbangert/heka:latest", self.url, "0" * 32)
+        status, lines = self._run(command)
+        self.assertEqual(status, 1)
+        self.assertEqual(lines[-1],
+                         "LOADS_DONE bbangert/heka:latest digest mismatch")
+        # Loaded as it streamed, then removed
+        self.assertEqual(self._loads(), 1)
+        self.assertEqual(os.listdir(self.images), ["calls"])
+
+    def test_download_failure(self):
+        command = import_command("bbangert/heka:latest",
+                                 self.url + ".missing")
+        status, lines = self._run(command)
+        self.assertEqual(status, 1)
+        self.assertEqual(lines[-1],
+                         "LOADS_DONE bbangert/heka:latest download failed")
+
+    def test_image_missing(self):
+        command = import_command("bbangert/heka:0.9", self.url)
+        status, lines = self._run(command)
+        self.assertEqual(status, 1)
+        self.assertEqual(lines[-1],
+                         "LOADS_DONE bbangert/heka:0.9 image missing")
+
+    def test_pull(self):
+        status, lines = self._run(pull_command("kitcambridge/dnsmasq"))
+        self.assertEqual(status, 0)
+        self.assertEqual(lines, ["LOADS_DONE kitcambridge/dnsmasq loaded"])
+
+
+class TestRunLoads(unittest.TestCase):
+
+    def test_streaming(self):
+        client = Mock()
+        channel = client.get_transport.return_value.open_session.return_value
+        channel.makefile.return_value = iter([
+            "LOADS_PROGRESS a:1 0\n",
+            "LOADS_PROGRESS a:1 2048\n",
+            "Loaded image: a:1\n",
+            "LOADS_DONE a:1 loaded\n",
+            "LOADS_DONE b download failed\n"])
+        channel.recv_exit_status.return_value = 123
+
+        progress = []
+        results, output = DockerDaemon._run_loads(
+            client, "command", [("a:1", "http://x/a"), ("b", "http://x/b"),
+                                ("c", None)],
+            lambda *args: progress.append(args))
+
+        channel.set_combine_stderr.assert_called_once_with(True)
+        channel.exec_command.assert_called_once_with("command")
+        self.assertEqual(progress, [("a:1", 0), ("a:1", 2048)])
+        self.assertEqual(results, {"a:1": "loaded",
+                                   "b": "download failed",
+                                   "c": "exited with status 123"})
+        self.assertEqual(output, "Loaded image: a:1\n")
+        channel.close.assert_called_once_with()
+
+
+class TestImageInfo(unittest.TestCase):
+
+    def test_headers(self):
+        class Response:
+            headers = {"ETag": '"abcd"', "Content-Length": "1024"}
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+        with patch("urllib.request.urlopen", return_value=Response()) as op:
+            info = image_info("https://s3.amazonaws.com/loads/heka.tar.bz2")
+        self.assertEqual(info, ("abcd", 1024))
+        self.assertEqual(op.call_args[0][0].get_method(), "HEAD")
+
+    def test_unreachable(self):
+        self.assertEqual(image_info("file:///nonexistent/heka.tar"),
+                         (None, None))
@@ -0,0 +1,64 @@
+import threading
+import unittest
+
+
+class Test_fair_executor(unittest.TestCase):
+    def _makeOne(self, max_workers=1):
+        from loadsbroker.executor import FairExecutor
+        return FairExecutor(max_workers)
+
+    def test_result_and_exception(self):
+        executor = self._makeOne(2)
+        self.assertEqual(executor.submit(("run", "step"), pow, 2, 3)
+                         .result(timeout=1), 8)
+        with self.assertRaises(ZeroDivisionError):
+            executor.submit(("run", "step"), divmod, 1, 0).result(timeout=1)
+        self.assertEqual(executor.stats()["completed"], 2)
+        executor.shutdown()
+
+    def test_round_robin(self):
+        executor = self._makeOne()
+        started = threading.Event()
+        release = threading.Event()
+        done = []
+
+        def block():
+            started.set()
+            release.wait(1)
+
+        executor.submit(("other", None), block)
+        started.wait(1)
+
+        futures = [executor.submit(key, done.append, name) for key, name in [
+            (("a", "s1"), "a1"),
+            (("a", "s1"), "a2"),
+            (("a", "s1"), "a3"),
+            (("b", "s1"), "b1"),
+            (("a", "s2"), "c1"),
+        ]]
+        stats = executor.stats()
+        self.assertEqual(stats["active"], 1)
+        self.assertEqual(stats["queued"], 5)
+        self.assertEqual(stats["groups"], 2)
+        self.assertEqual(stats["clients"], 3)
+
+        # Runs take turns, and so do the steps within a run
+        release.set()
+        for future in futures:
+            future.result(timeout=1)
+        self.assertEqual(done, ["a1", "b1", "c1", "a2", "a3"])
+        self.assertEqual(executor.stats()["queued"], 0)
+        executor.shutdown()
+
+    def test_shutdown_cancels_queued(self):
+        executor = self._makeOne()
+        release = threading.Event()
+        running = executor.submit(("a", None), release.wait, 1)
+        queued = executor.submit(("a", None), len, "")
+        executor.shutdown(wait=False)
+        release.set()
+
+        self.assertTrue(running.result(timeout=1))
+        self.assertTrue(queued.cancelled())
+        with self.assertRaises(RuntimeError):
+            executor.submit(("a", None), len, "")
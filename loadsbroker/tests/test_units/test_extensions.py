@@ -0,0 +1,207 @@
+import unittest
+from unittest.mock import Mock, patch
+
+from paramiko.ssh_exception import SSHException
+
+
+class FakeInstance:
+    def __init__(self, id):
+        self.id = id
+        self.ip_address = "127.0.0.1"
+
+
+class FakeEC2Instance:
+    def __init__(self, id):
+        self.instance = FakeInstance(id)
+
+
+class FakeCollection:
+    def __init__(self, ids):
+        self.instances = [FakeEC2Instance(x) for x in ids]
+
+    async def map(self, func):
+        return [func(x) for x in self.instances]
+
+
+class Test_ssh(unittest.TestCase):
+    def _makeOne(self):
+        from loadsbroker.extensions import SSH
+        return SSH(ssh_keyfile="key")
+
+    def _client(self, active=True):
+        client = Mock()
+        client.get_transport.return_value.is_active.return_value = active
+        return client
+
+    def test_client_is_pooled(self):
+        ssh = self._makeOne()
+        inst = FakeInstance("i-1")
+        with patch.object(ssh, "connect", return_value=self._client()) as c:
+            first = ssh.client(inst)
+            self.assertIs(ssh.client(inst), first)
+            self.assertIsNot(ssh.client(FakeInstance("i-2")), None)
+        self.assertEqual(c.call_count, 2)
+
+    def test_unhealthy_client_reconnects(self):
+        ssh = self._makeOne()
+        inst = FakeInstance("i-1")
+        stale, fresh = self._client(active=False), self._client()
+        with patch.object(ssh, "connect", side_effect=[stale, fresh]):
+            ssh.client(inst)
+            self.assertIs(ssh.client(inst), fresh)
+        stale.close.assert_called_once_with()
+
+    def test_execute_retries_on_new_connection(self):
+        ssh = self._makeOne()
+        inst = FakeInstance("i-1")
+        broken, fresh = self._client(), self._client()
+        calls = []
+
+        def command(client, arg):
+            calls.append(client)
+            if client is broken:
+                raise SSHException("Connection dropped")
+            return arg
+
+        with patch.object(ssh, "connect", side_effect=[broken, fresh]):
+            self.assertEqual(ssh.execute(inst, command, "done"), "done")
+        self.assertEqual(calls, [broken, fresh])
+        broken.close.assert_called_once_with()
+
+    def test_execute_raises_other_errors(self):
+        ssh = self._makeOne()
+        inst = FakeInstance("i-1")
+
+        def command(client):
+            raise ValueError()
+
+        with patch.object(ssh, "connect", return_value=self._client()) as c:
+            self.assertRaises(ValueError, ssh.execute, inst, command)
+        self.assertEqual(c.call_count, 1)
+
+    def test_release(self):
+        ssh = self._makeOne()
+        clients = {x: self._client() for x in ("i-1", "i-2", "i-3")}
+        clients["i-3"].get_transport.return_value.is_active.return_value = \
+            False
+
+        with patch.object(ssh, "connect",
+                          side_effect=lambda inst: clients[inst.id]):
+            for instance_id in clients:
+                ssh.client(FakeInstance(instance_id))
+
+        ssh.release(FakeCollection(["i-1"]))
+        clients["i-1"].close.assert_called_once_with()
+        clients["i-3"].close.assert_called_once_with()
+        self.assertFalse(clients["i-2"].close.called)
+        self.assertEqual(list(ssh._clients), ["i-2"])
+
+    def test_provision_raises_on_failed_steps(self):
+        from tornado.ioloop import IOLoop
+        from loadsbroker.exceptions import LoadsException
+        from loadsbroker.ssh import StepResult
+        ssh = self._makeOne()
+        results = {
+            "i-1": [StepResult("upload", 0, "")],
+            "i-2": [StepResult("upload", 0, ""),
+                    StepResult("reload", None, "")],
+        }
+
+        def run_script(instance, script):
+            return results[instance.id]
+
+        with patch.object(ssh, "run_script", side_effect=run_script):
+            with self.assertRaises(LoadsException) as ctx:
+                IOLoop.current().run_sync(
+                    lambda: ssh.provision(FakeCollection(["i-1", "i-2"]),
+                                          lambda inst: "script"))
+            self.assertIn("i-2", str(ctx.exception))
+            self.assertNotIn("i-1", str(ctx.exception))
+
+            collection = FakeCollection(["i-1"])
+            self.assertEqual(
+                IOLoop.current().run_sync(
+                    lambda: ssh.provision(collection, lambda inst: "script")),
+                [results["i-1"]])
+
+            # Optional steps failing are only logged
+            collection = FakeCollection(["i-2"])
+            self.assertEqual(
+                IOLoop.current().run_sync(
+                    lambda: ssh.provision(collection, lambda inst: "script",
+                                          optional=("reload",))),
+                [results["i-2"]])
+
+
+class Test_docker(unittest.TestCase):
+    def _makeOne(self):
+        from loadsbroker.extensions import Docker
+        return Docker(Mock())
+
+    def test_image_info_is_cached(self):
+        from loadsbroker.dockerctrl import ImageInfo
+        docker = self._makeOne()
+        url = "https://s3.amazonaws.com/loads-docker-images/heka.tar.bz2"
+        info = ImageInfo("abcd", 1024)
+
+        with patch("loadsbroker.extensions.image_info",
+                   return_value=info) as fetch:
+            self.assertEqual(docker.image_info(url), info)
+            self.assertEqual(docker.image_info(url), info)
+            self.assertEqual(fetch.call_count, 1)
+
+            docker.image_info_ttl = -1
+            docker.image_info(url)
+            self.assertEqual(fetch.call_count, 2)
+
+    def test_progress(self):
+        docker = self._makeOne()
+        inst = FakeEC2Instance("i-1")
+        inst.state = Mock()
+        report = docker._progress(inst, {"heka": 1000})
+        report("heka", 100)
+        report("dnsmasq", 50)
+        self.assertEqual(inst.state.image_progress,
+                         {"heka": 100, "dnsmasq": 50})
+
+    def test_cache_images(self):
+        from tornado.ioloop import IOLoop
+        docker = self._makeOne()
+        docker.image_cache = Mock()
+
+        async def fetch(url, pin=False):
+            if "broken" in url:
+                raise OSError()
+            return "http://broker/images/" + url[-1]
+        docker.image_cache.fetch = fetch
+
+        images = IOLoop.current().run_sync(lambda: docker.cache_images(
+            [("a", "http://x/a"), ("b", None), ("c", "http://broken/c")]))
+        self.assertEqual(images, [("a", "http://broker/images/a"),
+                                  ("b", None),
+                                  ("c", "http://broken/c")])
+
+    def test_load_images_unpins(self):
+        from tornado.ioloop import IOLoop
+        docker = self._makeOne()
+        docker.image_cache = Mock()
+        collection = Mock()
+        pinned = []
+
+        async def fetch(url, pin=False):
+            pinned.append(pin)
+            return "http://broker/images/" + url[-1]
+        docker.image_cache.fetch = fetch
+
+        async def execute(func, ec2_instance, images):
+            self.assertFalse(docker.image_cache.unpin.called)
+            raise OSError()
+        collection.execute = execute
+
+        with self.assertRaises(OSError):
+            IOLoop.current().run_sync(lambda: docker.load_images(
+                collection, Mock(), [("a", "http://x/a"), ("b", None)]))
+        self.assertEqual(pinned, [True])
+        self.assertEqual([x[0] for x in
+                          docker.image_cache.unpin.call_args_list],
+                         [("http://broker/images/a",), (None,)])
@@ -0,0 +1,212 @@
+import hashlib
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from tornado import gen
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, gen_test
+from tornado.web import Application
+
+from loadsbroker.executor import FairExecutor
+
+
+class Test_image_cache(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.origin = os.path.join(self.tmpdir.name, "origin")
+        os.mkdir(self.origin)
+        self.executor = FairExecutor(4)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+    def _makeOne(self, **kwargs):
+        from loadsbroker.imagecache import ImageCache
+        return ImageCache(os.path.join(self.tmpdir.name, "cache"),
+                          "http://10.0.0.5:8080/", self.executor, **kwargs)
+
+    def _tarball(self, name, content):
+        path = os.path.join(self.origin, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return "file://" + path
+
+    @gen_test
+    async def test_fetch(self):
+        from loadsbroker.imagecache import _key
+        cache = self._makeOne()
+        url = self._tarball("heka.tar", b"heka")
+
+        with patch.object(cache, "_download",
+                          wraps=cache._download) as download:
+            served = await cache.fetch(url)
+            self.assertEqual(await cache.fetch(url), served)
+        self.assertEqual(download.call_count, 1)
+
+        key = _key(url)
+        self.assertEqual(served, "http://10.0.0.5:8080/images/" + key)
+        with open(cache.file_path(key), "rb") as f:
+            self.assertEqual(f.read(), b"heka")
+        self.assertEqual(cache.info(served),
+                         (hashlib.md5(b"heka").hexdigest(), 4))
+        self.assertIsNone(cache.info(url))
+
+    @gen_test
+    async def test_concurrent_fetches_download_once(self):
+        cache = self._makeOne()
+        url = self._tarball("heka.tar", b"heka")
+
+        with patch.object(cache, "_download",
+                          wraps=cache._download) as download:
+            urls = await gen.multi([cache.fetch(url) for _ in range(5)])
+        self.assertEqual(len(set(urls)), 1)
+        self.assertEqual(download.call_count, 1)
+
+    @gen_test
+    async def test_revalidate(self):
+        cache = self._makeOne(revalidate=0)
+        url = self._tarball("heka.tar", b"heka")
+        served = await cache.fetch(url)
+
+        # Unchanged
+        with patch.object(cache, "_download") as download:
+            await cache.fetch(url)
+        self.assertFalse(download.called)
+
+        self._tarball("heka.tar", b"heka 2")
+        await cache.fetch(url)
+        self.assertEqual(cache.info(served)[1], 6)
+
+        # The origin is gone, the cached tarball is used
+        os.unlink(os.path.join(self.origin, "heka.tar"))
+        await cache.fetch(url)
+        self.assertEqual(cache.info(served)[1], 6)
+
+    @gen_test
+    async def test_missing_origin(self):
+        cache = self._makeOne()
+        url = "file://" + os.path.join(self.origin, "missing.tar")
+        with self.assertRaises(OSError):
+            await cache.fetch(url)
+        self.assertEqual(os.listdir(cache.path), [])
+
+    @gen_test
+    async def test_lru_eviction(self):
+        cache = self._makeOne(max_size=10)
+        urls = [self._tarball(x, b"1234") for x in "abc"]
+        served = [await cache.fetch(x) for x in urls[:2]]
+
+        # Use the first one, the second one is evicted
+        await cache.fetch(urls[0])
+        await cache.fetch(urls[2])
+        self.assertIsNotNone(cache.info(served[0]))
+        self.assertIsNone(cache.info(served[1]))
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(len(os.listdir(cache.path)), 4)
+
+    @gen_test
+    async def test_pinned_entries_are_kept(self):
+        cache = self._makeOne(max_size=6)
+        urls = [self._tarball(x, b"1234") for x in "abc"]
+        pinned = await cache.fetch(urls[0], pin=True)
+        await cache.fetch(urls[0], pin=True)
+        served = await cache.fetch(urls[1])
+
+        # The least recently used one is pinned, the next one goes
+        await cache.fetch(urls[2])
+        self.assertIsNotNone(cache.info(pinned))
+        self.assertIsNone(cache.info(served))
+        self.assertEqual(cache.size, 8)
+
+        # Evicted once every load is done with it
+        cache.unpin(pinned)
+        self.assertIsNotNone(cache.info(pinned))
+        cache.unpin(pinned)
+        self.assertIsNone(cache.info(pinned))
+        self.assertEqual(cache.size, 4)
+        self.assertEqual(cache._pins, {})
+
+    @gen_test
+    async def test_failed_fetch_unpins(self):
+        cache = self._makeOne()
+        url = "file://" + os.path.join(self.origin, "missing.tar")
+        with self.assertRaises(OSError):
+            await cache.fetch(url, pin=True)
+        self.assertEqual(cache._pins, {})
+
+    @gen_test
+    async def test_reload(self):
+        cache = self._makeOne()
+        urls = [self._tarball(x, b"1234") for x in "ab"]
+        served = [await cache.fetch(x) for x in urls]
+        os.utime(cache.file_path(served[0].rsplit("/", 1)[1]),
+                 (time.time() + 10, time.time() + 10))
+
+        # The cache is brought back under its maximum size
+        cache = self._makeOne(max_size=4)
+        self.assertEqual(cache.size, 4)
+        self.assertIsNone(cache.info(served[1]))
+        self.assertIsNotNone(cache.info(served[0]))
+
+
+class Test_image_handler(AsyncHTTPTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.executor = FairExecutor(2)
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.executor.shutdown()
+        self.tmpdir.cleanup()
+
+    def get_app(self):
+        from loadsbroker.imagecache import ImageCache
+        from loadsbroker.webapp.views import ImageHandler
+
+        origin = os.path.join(self.tmpdir.name, "heka.tar")
+        with open(origin, "wb") as f:
+            f.write(b"0123456789")
+        self.cache = ImageCache(os.path.join(self.tmpdir.name, "cache"),
+                                "http://localhost", self.executor)
+
+        app = Application([(r"/images/([0-9a-f]+)", ImageHandler)])
+        app.broker = self
+        self.image_cache = self.cache
+        self.url = self.io_loop.run_sync(
+            lambda: self.cache.fetch("file://" + origin))
+        return app
+
+    def _path(self):
+        return self.url[len("http://localhost"):]
+
+    def test_get(self):
+        response = self.fetch(self._path())
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, b"0123456789")
+        self.assertEqual(response.headers["ETag"],
+                         '"%s"' % hashlib.md5(b"0123456789").hexdigest())
+
+    def test_head(self):
+        response = self.fetch(self._path(), method="HEAD")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers["Content-Length"], "10")
+
+    def test_range(self):
+        response = self.fetch(self._path(), headers={"Range": "bytes=2-5"})
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.body, b"2345")
+        self.assertEqual(response.headers["Content-Range"], "bytes 2-5/10")
+
+    def test_unknown(self):
+        response = self.fetch("/images/abcdef")
+        self.assertEqual(response.code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
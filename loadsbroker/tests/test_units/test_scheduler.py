@@ -0,0 +1,182 @@
+from datetime import datetime, timedelta
+
+from tornado.testing import AsyncTestCase, gen_test
+
+
+class Test_step_scheduler(AsyncTestCase):
+    def _makeOne(self):
+        from loadsbroker.scheduler import StepScheduler
+        return StepScheduler(self.io_loop)
+
+    def test_due_in_order(self):
+        from loadsbroker.scheduler import START, STOP
+        sched = self._makeOne()
+        now = datetime.utcnow()
+        sched.schedule(now - timedelta(seconds=1), STOP, "b")
+        sched.schedule(now - timedelta(seconds=2), START, "a")
+        sched.schedule(now + timedelta(hours=1), STOP, "c")
+
+        due = sched.due()
+        self.assertEqual([x.setlink for x in due], ["a", "b"])
+        self.assertEqual(len(sched), 1)
+        self.assertEqual(sched.next_deadline.setlink, "c")
+        sched.close()
+
+    def test_cancel(self):
+        from loadsbroker.scheduler import START, CHECK
+        sched = self._makeOne()
+        now = datetime.utcnow()
+        deadline = sched.schedule(now, START, "a")
+        sched.schedule(now, CHECK, "b")
+        sched.schedule(now, START, "b")
+        sched.cancel(deadline)
+        sched.cancel_step("b")
+
+        self.assertEqual(sched.due(), [])
+        self.assertIsNone(sched.next_deadline)
+
+    @gen_test(timeout=2)
+    async def test_wait_for_deadline(self):
+        from loadsbroker.scheduler import STOP
+        sched = self._makeOne()
+        sched.schedule_in(0.1, STOP, "a")
+
+        due = await sched.wait()
+        self.assertEqual([x.setlink for x in due], ["a"])
+
+    @gen_test(timeout=2)
+    async def test_notify_wakes_waiter(self):
+        from loadsbroker.scheduler import STOP
+        sched = self._makeOne()
+        sched.schedule_in(60, STOP, "a")
+        self.io_loop.call_later(0.1, sched.notify)
+
+        due = await sched.wait()
+        self.assertEqual(due, [])
+        self.assertEqual(len(sched), 1)
+        sched.close()
+
+
+class FakeManager:
+    def __init__(self, supervisor, session, steps):
+        self._supervisor = supervisor
+        self._db_session = session
+        self.step_links = steps
+        self.abort = False
+        self.done = set()
+
+    def _schedule_step(self, setlink):
+        from loadsbroker.scheduler import STOP
+        self._supervisor.scheduler.schedule_in(0.05, STOP, setlink, self)
+
+    def _steps_complete(self):
+        return self.done == set(self.step_links)
+
+    async def _process_deadlines(self, due):
+        for deadline in due:
+            self.done.add(deadline.setlink)
+        self._supervisor.mark_dirty(self._db_session)
+
+
+class Test_run_supervisor(AsyncTestCase):
+    def _makeOne(self):
+        from loadsbroker.scheduler import RunSupervisor
+        return RunSupervisor(self.io_loop)
+
+    @gen_test(timeout=2)
+    async def test_supervises_runs_together(self):
+        from mock import Mock
+        supervisor = self._makeOne()
+        sessions = [Mock(), Mock()]
+        first = FakeManager(supervisor, sessions[0], ["a", "b"])
+        second = FakeManager(supervisor, sessions[1], ["c"])
+
+        futures = [supervisor.supervise(first),
+                   supervisor.supervise(second)]
+        self.assertEqual(len(supervisor), 2)
+        await futures[0]
+        await futures[1]
+
+        self.assertEqual(len(supervisor), 0)
+        self.assertEqual(first.done, {"a", "b"})
+        self.assertEqual(second.done, {"c"})
+        # All the steps came due together, so the changes of each run
+        # were committed at once
+        self.assertEqual([x.commit.call_count for x in sessions], [1, 1])
+
+    @gen_test(timeout=2)
+    async def test_failed_commit_only_rolls_back_its_run(self):
+        from mock import Mock
+        supervisor = self._makeOne()
+        failing, session = Mock(), Mock()
+        failing.commit.side_effect = ValueError()
+        first = FakeManager(supervisor, failing, ["a"])
+        second = FakeManager(supervisor, session, ["b"])
+
+        await supervisor.supervise(first)
+        await supervisor.supervise(second)
+        self.assertEqual(failing.rollback.call_count, 1)
+        self.assertEqual(session.commit.call_count, 1)
+        self.assertFalse(session.rollback.called)
+
+    @gen_test(timeout=2)
+    async def test_run_without_steps(self):
+        from mock import Mock
+        supervisor = self._makeOne()
+        manager = FakeManager(supervisor, Mock(), [])
+
+        await supervisor.supervise(manager)
+        self.assertEqual(len(supervisor), 0)
+        self.assertFalse(supervisor._supervising)
+
+    @gen_test(timeout=2)
+    async def test_abort(self):
+        from mock import Mock
+        supervisor = self._makeOne()
+        manager = FakeManager(supervisor, Mock(), ["a"])
+        future = supervisor.supervise(manager)
+        manager.abort = True
+        supervisor.notify()
+
+        await future
+        self.assertEqual(manager.done, set())
+        self.assertIsNone(supervisor.scheduler.next_deadline)
+
+    @gen_test(timeout=2)
+    async def test_supervise_as_the_loop_ends(self):
+        from mock import Mock
+        supervisor = self._makeOne()
+        first = FakeManager(supervisor, Mock(), ["a"])
+        second = FakeManager(supervisor, Mock(), ["b"])
+        late = []
+
+        # Supervise a run once the loop returned, before the supervisor
+        # was called back
+        supervise = supervisor._supervise
+
+        async def supervise_then_add():
+            await supervise()
+            if not late:
+                late.append(supervisor.supervise(second))
+        supervisor._supervise = supervise_then_add
+
+        await supervisor.supervise(first)
+        await late[0]
+        self.assertEqual(second.done, {"b"})
+
+    def test_schedule_check(self):
+        from datetime import datetime, timedelta
+        from loadsbroker.scheduler import CHECK
+        supervisor = self._makeOne()
+        now = datetime.utcnow()
+
+        deadline = supervisor.schedule_check(None, "a", 15,
+                                             now + timedelta(minutes=5))
+        self.assertEqual(deadline.action, CHECK)
+        self.assertLessEqual(deadline.when, now + timedelta(seconds=15.1))
+
+        # The step stops before the next check would be due
+        self.assertIsNone(supervisor.schedule_check(
+            None, "b", 15, now + timedelta(seconds=-1)))
+        self.assertEqual(len(supervisor.scheduler), 1)
+        supervisor.scheduler.close()
@@ -0,0 +1,58 @@
+import os
+import subprocess
+import tempfile
+import unittest
+
+
+class Test_provision_script(unittest.TestCase):
+    def _makeOne(self):
+        from loadsbroker.ssh import ProvisionScript
+        return ProvisionScript()
+
+    def _run(self, script):
+        return subprocess.check_output(["sh", "-s"],
+                                       input=script.render().encode())
+
+    def test_steps(self):
+        script = self._makeOne()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            remote_file = os.path.join(tmpdir, "heka", "config.toml")
+            script.run("echo", "echo hello")
+            script.upload("[hekad]\nmaxprocs = 4\n", remote_file)
+            script.run("fail", "echo oops >&2; exit 3")
+            script.run("cat", "cat %s" % remote_file)
+
+            results = script.results(self._run(script))
+
+            with open(remote_file) as f:
+                self.assertEqual(f.read(), "[hekad]\nmaxprocs = 4\n")
+
+        self.assertEqual([(x.name, x.status) for x in results], [
+            ("echo", 0),
+            ("upload %s" % remote_file, 0),
+            ("fail", 3),
+            ("cat", 0)])
+        self.assertEqual(results[0].output, "hello")
+        self.assertEqual(results[2].output, "oops")
+        self.assertEqual(results[3].output, "[hekad]\nmaxprocs = 4")
+
+    def test_commands_dont_read_the_script(self):
+        script = self._makeOne()
+        script.run("cat", "cat")
+        script.run("after", "echo after")
+
+        results = script.results(self._run(script))
+        self.assertEqual([(x.status, x.output) for x in results],
+                         [(0, ""), (0, "after")])
+
+    def test_interrupted(self):
+        script = self._makeOne()
+        script.run("first", "true")
+        script.run("second", "sleep 60")
+        script.run("third", "true")
+
+        results = script.results(
+            b"\n__LOADS_STEP_DONE__ 0\npartial\n")
+        self.assertEqual(results[0].status, 0)
+        self.assertEqual(results[1:], [("second", None, "partial"),
+                                       ("third", None, "")])
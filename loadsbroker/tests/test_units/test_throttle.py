@@ -0,0 +1,99 @@
+from boto.exception import EC2ResponseError
+from tornado.concurrent import Future
+from tornado.testing import AsyncTestCase, gen_test
+
+
+def _throttled():
+    body = ("<Response><Errors><Error><Code>RequestLimitExceeded</Code>"
+            "<Message>Request limit exceeded.</Message>"
+            "</Error></Errors></Response>")
+    return EC2ResponseError(503, "Service Unavailable", body)
+
+
+def _execute(func, *args, **kwargs):
+    future = Future()
+    try:
+        future.set_result(func(*args, **kwargs))
+    except Exception as exc:
+        future.set_exception(exc)
+    return future
+
+
+class Test_region_throttle(AsyncTestCase):
+    def _makeOne(self, **kwargs):
+        from loadsbroker.throttle import RegionThrottle
+        return RegionThrottle(self.io_loop, **kwargs)
+
+    @gen_test(timeout=2)
+    async def test_burst_then_rate(self):
+        limiter = self._makeOne(rate=20.0, burst=2)
+        start = self.io_loop.time()
+        for _ in range(4):
+            await limiter.acquire()
+
+        # The first two go through at once, the others wait ~50ms each
+        elapsed = self.io_loop.time() - start
+        self.assertGreater(elapsed, 0.09)
+        self.assertEqual(limiter.calls, 4)
+        self.assertGreater(limiter.max_wait, 0)
+        self.assertEqual(limiter.waiting, 0)
+
+    def test_aimd(self):
+        limiter = self._makeOne(rate=4.0, min_rate=1.0, max_rate=4.5)
+        limiter.succeeded()
+        limiter.succeeded()
+        self.assertAlmostEqual(limiter.rate, 4.2)
+        limiter.backoff()
+        self.assertAlmostEqual(limiter.rate, 2.1)
+        limiter.backoff()
+        limiter.backoff()
+        self.assertEqual(limiter.rate, 1.0)
+        self.assertEqual(limiter.stats()["throttled"], 3)
+
+
+class Test_throttle(AsyncTestCase):
+    def _makeOne(self, **kwargs):
+        from loadsbroker.throttle import Throttle
+        return Throttle(self.io_loop, **kwargs)
+
+    @gen_test(timeout=2)
+    async def test_retries_throttled_calls(self):
+        throttle = self._makeOne(rate=100.0)
+        calls = []
+
+        def api_call(value):
+            calls.append(value)
+            if len(calls) < 3:
+                raise _throttled()
+            return value
+
+        result = await throttle.call("us-west-2", _execute, api_call, "ok")
+        self.assertEqual(result, "ok")
+        self.assertEqual(len(calls), 3)
+        stats = throttle.stats()
+        self.assertEqual(list(stats), ["us-west-2"])
+        self.assertEqual(stats["us-west-2"]["throttled"], 2)
+        self.assertLess(stats["us-west-2"]["rate"], 100.0)
+
+    @gen_test(timeout=2)
+    async def test_gives_up(self):
+        throttle = self._makeOne(attempts=2, rate=100.0)
+
+        def api_call():
+            raise _throttled()
+
+        with self.assertRaises(EC2ResponseError):
+            await throttle.call("us-west-2", _execute, api_call)
+
+    @gen_test(timeout=2)
+    async def test_other_errors_raise(self):
+        throttle = self._makeOne()
+        calls = []
+
+        def api_call():
+            calls.append(None)
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            await throttle.call("us-west-2", _execute, api_call)
+        self.assertEqual(len(calls), 1)
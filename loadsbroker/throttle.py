@@ -0,0 +1,153 @@
+"""AWS API Throttling
+
+EC2 rate limits API calls per account and region, and answers with
+``RequestLimitExceeded`` errors once over the limit. Every run shares
+the same limit, so the calls made for concurrent runs need to go
+through a single limiter per region rather than each retrying on its
+own.
+
+A :class:`RegionThrottle` is a token bucket whose rate adapts to the
+responses of the API (AIMD): every successful call increases the rate
+a little, every throttled call halves it and is queued again. The
+:class:`Throttle` holds the limiters of all the regions.
+
+"""
+from collections import defaultdict
+
+from boto.exception import EC2ResponseError
+from tornado import gen
+from tornado.locks import Lock
+
+from loadsbroker import logger
+
+
+# Error codes of throttled EC2 requests
+THROTTLE_CODES = ("RequestLimitExceeded", "Throttling")
+
+
+def is_throttled(exc):
+    """Whether an exception is EC2 throttling a request."""
+    return (isinstance(exc, EC2ResponseError) and
+            exc.error_code in THROTTLE_CODES)
+
+
+class RegionThrottle:
+    """Adaptive token bucket limiting the API calls made to a region.
+
+    :param rate: Initial number of calls per second.
+    :param burst: Number of calls that can be made at once after a
+                  quiet period.
+    :param increase: Calls per second added on each successful call.
+    :param decrease: Factor applied to the rate on each throttled call.
+
+    """
+    def __init__(self, io_loop, rate=5.0, burst=10, min_rate=0.5,
+                 max_rate=50.0, increase=0.1, decrease=0.5):
+        self._loop = io_loop
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self._tokens = burst
+        self._updated = io_loop.time()
+        self._lock = Lock()
+
+        # Metrics
+        self.waiting = 0
+        self.calls = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _refill(self):
+        now = self._loop.time()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """Wait for a token. Waiters are served in order."""
+        start = self._loop.time()
+        self.waiting += 1
+        try:
+            with (await self._lock.acquire()):
+                self._refill()
+                while self._tokens < 1:
+                    delay = (1 - self._tokens) / self.rate
+                    await gen.Task(self._loop.add_timeout,
+                                   self._loop.time() + delay)
+                    self._refill()
+                self._tokens -= 1
+        finally:
+            self.waiting -= 1
+
+        waited = self._loop.time() - start
+        self.calls += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def succeeded(self):
+        """Additive increase of the rate."""
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def backoff(self):
+        """Multiplicative decrease of the rate."""
+        self.throttled += 1
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self._tokens = min(self._tokens, 0)
+
+    def stats(self):
+        return {
+            "rate": self.rate,
+            "queue_depth": self.waiting,
+            "calls": self.calls,
+            "throttled": self.throttled,
+            "average_wait": self.total_wait / self.calls if self.calls else 0,
+            "max_wait": self.max_wait,
+        }
+
+
+class Throttle:
+    """Throttles the API calls of every region.
+
+    Calls throttled by EC2 are retried through the limiter up to
+    ``attempts`` times before the error is raised.
+
+    """
+    def __init__(self, io_loop, attempts=5, **options):
+        self._loop = io_loop
+        self.attempts = attempts
+        self._regions = defaultdict(
+            lambda: RegionThrottle(self._loop, **options))
+
+    def __getitem__(self, region):
+        return self._regions[region]
+
+    async def call(self, region, execute, func, *args, **kwargs):
+        """Run a blocking API call once the region's limiter allows it.
+
+        :param execute: Function running the blocking call, and returning
+                        a future, such as an executor's.
+
+        """
+        limiter = self._regions[region]
+        for attempt in range(self.attempts):
+            await limiter.acquire()
+            try:
+                result = await execute(func, *args, **kwargs)
+            except Exception as exc:
+                if not is_throttled(exc) or attempt == self.attempts - 1:
+                    raise
+                limiter.backoff()
+                logger.debug("EC2 API throttled in %s, slowing down to "
+                             "%.2f calls/s.", region, limiter.rate)
+            else:
+                limiter.succeeded()
+                return result
+
+    def stats(self):
+        """Limiter metrics, keyed by region."""
+        return {region: limiter.stats()
+                for region, limiter in self._regions.items()}
@@ -19,18 +19,18 @@ URL layout:
 
 ``/api/instances/*`` -> :class:`~InstanceHandler`
 
+``/images/*`` -> :class:`~loadsbroker.webapp.views.ImageHandler`
+
 """
 import json
 import os
 
 import tornado.web
-from tornado import gen
 from sqlalchemy.orm.exc import NoResultFound
 
 from loadsbroker import __version__, logger
 from loadsbroker.db import Run, COMPLETED, Project, Plan
 from loadsbroker.exceptions import LoadsException
-from loadsbroker.aws import AWS_REGIONS
 
 
 _DEFAULTS = {'user_data': os.path.join(os.path.dirname(__file__), 'aws.yml')}
@@ -104,6 +104,8 @@ class RootHandler(BaseHandler):
             offset = int(offset)
         self.response['runs'] = self.broker.get_runs(limit=limit,
                                                      offset=offset)
+        self.response['ec2_throttle'] = self.broker.pool.throttle.stats()
+        self.response['executors'] = self.broker.executor_stats()
         self.write_json()
 
 
@@ -125,7 +127,12 @@ class ProjectsHandler(BaseHandler):
 
         # now adding plans
         for plan in data['plans']:
-            new_plan = Plan.from_json(plan)
+            try:
+                new_plan = Plan.from_json(plan)
+            except LoadsException as exc:
+                session.rollback()
+                self.write_error(status=400, message=str(exc))
+                return
             project.plans.append(new_plan)
 
         session.commit()
@@ -146,14 +153,19 @@ class ProjectHandler(BaseHandler):
 
 
 class InstancesHandler(BaseHandler):
-    """Instances handler"""
+    """Instances handler
+
+    Instances are served from the pool's
+    :class:`~loadsbroker.aws.Inventory` rather than looked up in every
+    region on each request.
 
+    """
     async def prepare(self):
         super().prepare()
         pool = self.broker.pool
-        instancelist = await gen.multi(
-            [pool._recover_region(x) for x in AWS_REGIONS])
-        self.instancelist = instancelist
+        await pool.ready
+        self.pool = pool
+        self.inventory = pool.inventory
 
     def _instance_to_dict(self, instance):
         res = {}
@@ -168,41 +180,37 @@ class InstancesHandler(BaseHandler):
     def get(self):
         """Returns a list of instances"""
         res = {}
-        for instances in self.instancelist:
-            for instance in instances:
-                res[instance.id] = self._instance_to_dict(instance)
+        for instance in self.inventory.instances():
+            res[instance.id] = self._instance_to_dict(instance)
         self.response['instances'] = res
         self.write_json()
 
-    def delete(self):
-        terminated = []
-        for instances in self.instancelist:
-            for instance in instances:
-                instance.terminate()
-                terminated.append(instance.id)
-
-        self.response['terminated'] = terminated
+    async def delete(self):
+        self.response['terminated'] = await self.pool.terminate_instances(
+            self.inventory.instances())
         self.write_json()
 
 
 class InstanceHandler(InstancesHandler):
     """Instance handler"""
-    def _get_instance(self, id):
-        for instances in self.instancelist:
-            for instance in instances:
-                if instance.id == id:
-                    return instance
-
     def get(self, id):
         """Returns a list of instances"""
-        instance = self._get_instance(id)
+        instance = self.inventory.get(id)
+        if instance is None:
+            self.write_error(status=404, message='No such instance')
+            return
+
         self.response['instance'] = self._instance_to_dict(instance)
         self.write_json()
 
-    def delete(self, id):
+    async def delete(self, id):
         """Terminate an instance"""
-        instance = self._get_instance(id)
-        instance.terminate()
+        instance = self.inventory.get(id)
+        if instance is None:
+            self.write_error(status=404, message='No such instance')
+            return
+
+        await self.pool.terminate_instances([instance])
         self.write_json()
 
 
@@ -211,8 +219,9 @@ class RunHandler(BaseHandler):
     async def prepare(self):
         super().prepare()
         pool = self.broker.pool
-        instancelist = await [pool._recover_region(x) for x in AWS_REGIONS]
-        self.instancelist = instancelist
+        await pool.ready
+        self.pool = pool
+        self.inventory = pool.inventory
 
     def _instance_to_dict(self, instance):
         res = {}
@@ -224,7 +233,7 @@ class RunHandler(BaseHandler):
         res['placement'] = instance.placement
         return res
 
-    def delete(self, run_id, **kwargs):
+    async def delete(self, run_id, **kwargs):
         """Deleting a run does the following:
             - stops everything running
             - move the status to TERMINATED
@@ -256,13 +265,8 @@ class RunHandler(BaseHandler):
 
         # 3. kill instances if asked
         if 'terminate' in self.request.arguments:
-            terminated = []
-            for instances in self.instancelist:
-                for instance in instances:
-                    if instance.tags.get('RunId') == run_id:
-                        instance.terminate()
-                        terminated.append(instance.id)
-
+            terminated = await self.pool.terminate_instances(
+                self.inventory.run_instances(run_id))
             self.response['terminated'] = terminated
 
         self.write_json()
@@ -1,6 +1,6 @@
 from string import Template
 
-from tornado.web import StaticFileHandler
+from tornado.web import HTTPError, StaticFileHandler
 
 
 class GrafanaHandler(StaticFileHandler):
@@ -30,3 +30,27 @@ class GrafanaHandler(StaticFileHandler):
             await self.flush()
         else:
             await StaticFileHandler.get(self, self.path, include_body)
+
+
+class ImageHandler(StaticFileHandler):
+    """Serves the tarballs of the broker's
+    :class:`~loadsbroker.imagecache.ImageCache` to the instances, with
+    range requests support. The ETag of a tarball is its MD5."""
+    def initialize(self):
+        self.cache = self.application.broker.image_cache
+        if self.cache is not None:
+            super(ImageHandler, self).initialize(self.cache.path)
+
+    def get(self, key, include_body=True):
+        entry = self.cache and self.cache.get(key)
+        if entry is None:
+            raise HTTPError(404)
+        self.md5 = entry["md5"]
+        return super(ImageHandler, self).get(key, include_body)
+
+    def compute_etag(self):
+        # Rather than hashing the tarball
+        return '"%s"' % self.md5
+
+    def get_content_type(self):
+        return "application/octet-stream"